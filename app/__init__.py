@@ -16,7 +16,7 @@ from werkzeug.wrappers import BaseResponse
 
 from .config import Config
 from .forms import LoginForm, LogOutForm, CreateSubForm
-from .models import db_init_app, rconn, User
+from .models import db_init_app, rconn
 from .auth import auth_provider, email_validation_is_required
 from .views import do, subs as sub, api3, jwt
 from .views.auth import bp as auth
@@ -30,8 +30,10 @@ from .views.mod import bp as mod
 from .views.errors import bp as errors
 from .views.messages import bp as messages
 
-from . import misc, forms, caching, storage
+from . import misc, forms, caching, storage, profiler
 from .notifications import notifications
+from .search import search_engine
+from .pagecache import page_cache
 from .socketio import socketio
 from .misc import SiteAnon, engine, re_amention, mail, talisman, limiter
 from .misc import logging_init_app, get_locale, babel
@@ -106,6 +108,7 @@ def create_app(config=None):
     logging_init_app(app)
     limiter.init_app(app)
     notifications.init_app(app)
+    search_engine.init_app(app)
 
     # app.wsgi_app = ProfilerMiddleware(app.wsgi_app)
 
@@ -171,6 +174,8 @@ def create_app(config=None):
     def before_request():
         """ Called before the request is processed. Used to time the request """
         g.start = time.time()
+        # Sub bundles are only kept for one request (see misc.get_sub_bundle).
+        g.pop("sub_bundles", None)
 
     @app.after_request
     def after_request(response):
@@ -182,6 +187,8 @@ def create_app(config=None):
         if not hasattr(g, "pqc"):
             g.pqc = 0
         app.logger.info("%s (%s ms, %s queries)", response.status, diff, g.pqc)
+        if "query_log" in g:
+            profiler.record_request(request.endpoint, g.pop("query_log"))
         if not app.debug:
             return response  # We won't do this if we're in production mode
         if app.config["THROAT_CONFIG"].app.development:
@@ -206,6 +213,9 @@ def create_app(config=None):
             response.headers["content-length"] = len(response.response[0])
         return response
 
+    # After the hooks above, so pages served from the cache are timed too.
+    page_cache.init_app(app)
+
     @app.context_processor
     def utility_processor():
         """ Here we set some useful stuff for templates """
@@ -236,9 +246,9 @@ def load_user(user_id):
     unique identifier. Required for the 'remember me' functionality.
     The unique identifier is the user_id and their number of password resets."""
     splits = user_id.split("$")
-    user = User.get(User.uid == splits[0])
+    user = misc.load_user(splits[0])
     resets = 0 if len(splits) == 1 else int(splits[1])
-    if resets == user.resets:
-        return misc.load_user(user.uid)
+    if user is not None and resets == user.resets:
+        return user
     else:
         return None
@@ -22,6 +22,7 @@ from .models import (
     SubSubscriber,
 )
 from .misc import logger
+from .search import search_engine
 from . import misc
 
 
@@ -135,6 +136,7 @@ class AuthProvider:
         )
         self.set_user_auth_source(user, auth_source)
         self._set_email_verified(user, verified_email)
+        search_engine.user_names.publish(user.name)
         return user
 
     @staticmethod
@@ -201,6 +203,7 @@ class AuthProvider:
                 raise AuthError
             # Invalidate other existing login sessions.
             User.update(resets=User.resets + 1).where(User.uid == user.uid).execute()
+            misc.invalidate_user_snapshot(user.uid)
             theuser = misc.load_user(user.uid)
             login_user(theuser, remember=session.get("remember_me", False))
 
@@ -240,6 +243,7 @@ class AuthProvider:
                 raise AuthError
         user.save()
         User.update(resets=User.resets + 1).where(User.uid == user.uid).execute()
+        misc.invalidate_user_snapshot(user.uid)
 
     @staticmethod
     def get_pending_email(user):
@@ -298,6 +302,7 @@ class AuthProvider:
         user.email = email
         user.save()
         self._set_email_verified(user)
+        misc.invalidate_user_snapshot(user.uid)
 
     @staticmethod
     def is_email_verified(user):
@@ -409,6 +414,7 @@ class AuthProvider:
         user.status = new_status
         user.save()
         User.update(resets=User.resets + 1).where(User.uid == user.uid).execute()
+        misc.invalidate_user_snapshot(user.uid)
 
     def actually_delete_user(self, user):
         # Used by automatic tests to clean up test realm on server.
@@ -73,7 +73,7 @@ class Badges:
     @staticmethod
     # Removes a badge from a user
     def revoke_badge(uid, bid):
-        UserMetadata.delete().where(UserMetadata.key =="badge") & (UserMetadata.uid == uid) & (UserMetadata.value == str(bid))).execute()
+        UserMetadata.delete().where((UserMetadata.key == "badge") & (UserMetadata.uid == uid) & (UserMetadata.value == str(bid))).execute()
 
     @staticmethod
     def unassign_userbadge(uid, bid):
@@ -56,6 +56,13 @@ cfg_defaults = {  # key => default value
         "archive_post_after": 60,
         "trusted_proxy_count": 0,
         "custom_hot_sort": False,
+        "vote_write_behind": False,
+        "home_feed": {
+            "enabled": False,
+            "max_entries": 1000,
+            "ttl": 86400,
+            "max_feeds_per_sub": 1000,
+        },
         "recent_activity": {
             "enabled": True,
             "defaults_only": False,
@@ -66,7 +73,35 @@ cfg_defaults = {  # key => default value
         "logo": "app/static/img/throat-logo.svg",
     },
     "auth": {"provider": "LOCAL", "require_valid_emails": False, "keycloak": {}},
-    "cache": {"type": "null"},
+    "cache": {
+        "type": "null",
+        "markdown_ttl": 604800,
+        "markdown_lru_size": 2048,
+        "user_snapshot_ttl": 300,
+        "sub_bundle_ttl": 60,
+        "sub_bundle_lru_size": 512,
+        "fragment_lru_size": 4096,
+        "counter_ttl": 86400,
+    },
+    "page_cache": {
+        "enabled": False,
+        "ttl": 15,
+        "stale_ttl": 120,
+        "max_age": 0,
+        "endpoints": [
+            "home.index",
+            "home.hot",
+            "home.new",
+            "home.top",
+            "home.all_hot",
+            "home.all_new",
+            "home.all_top",
+            "sub.view_sub_hot",
+            "sub.view_sub_new",
+            "sub.view_sub_top",
+            "sub.view_post",
+        ],
+    },
     "mail": {},
     "storage": {
         "provider": "LOCAL",
@@ -99,6 +134,16 @@ cfg_defaults = {  # key => default value
     "ratelimit": {"default": "60/minute"},
     "notifications": {"fcm_api_key": None},
     "matrix": {"enabled": False},
+    "search": {"provider": "DATABASE", "name_index_refresh": 5},
+    "profiler": {"enabled": False, "slow_query_ms": 100, "repeat_threshold": 5},
+    "offload": {"workers": 2, "max_queue": 20, "timeout": 30},
+    "fetch": {
+        "max_concurrent": 20,
+        "max_per_host": 4,
+        "bad_host_ttl": 300,
+        "metadata_ttl": 86400,
+    },
+    "jobs": {"enabled": False},
 }
 
 
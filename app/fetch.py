@@ -0,0 +1,261 @@
+""" Fetches pages and images from other sites, for thumbnails and titles. """
+import cgi
+import hashlib
+import os
+import time
+from collections import Counter
+from contextlib import contextmanager
+from urllib.parse import urlparse, urlsplit, urlunsplit
+import gevent
+import gevent.event
+import gevent.lock
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from .config import config
+from .models import rconn
+
+
+class Fetcher:
+    """Makes GET requests through a pooled session that is shared by all
+    the greenlets of the process. Limits how many requests run at once,
+    in total and to each host, and remembers for a while (in Redis, so all
+    the workers know) the hosts that couldn't be connected to, to fail fast
+    instead of waiting for them to time out again. Slow or large responses
+    don't count, since anyone can link to one on any host."""
+
+    user_agent = "Throat/1 (Phuks)"
+    bad_host_prefix = "fetch:bad:"
+
+    def __init__(self):
+        self.pid = None
+        self.session = None
+        self.slots = None
+        self.host_slots = {}
+        self.host_users = Counter()
+
+    def _setup(self):
+        # Called again in forked children, so they don't share connections.
+        self.pid = os.getpid()
+        per_host = int(config.fetch.max_per_host)
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = self.user_agent
+        adapter = HTTPAdapter(pool_connections=100, pool_maxsize=per_host)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.slots = gevent.lock.BoundedSemaphore(int(config.fetch.max_concurrent))
+        self.host_slots = {}
+        self.host_users = Counter()
+
+    @contextmanager
+    def _slot(self, host, timeout):
+        if not self.slots.acquire(timeout=timeout):
+            raise ValueError("too many fetches")
+        try:
+            if host not in self.host_slots:
+                self.host_slots[host] = gevent.lock.BoundedSemaphore(
+                    int(config.fetch.max_per_host)
+                )
+            sem = self.host_slots[host]
+            self.host_users[host] += 1
+            try:
+                if not sem.acquire(timeout=timeout):
+                    raise ValueError("too many fetches to " + host)
+                try:
+                    yield
+                finally:
+                    sem.release()
+            finally:
+                self.host_users[host] -= 1
+                if not self.host_users[host]:
+                    del self.host_users[host]
+                    del self.host_slots[host]
+        finally:
+            self.slots.release()
+
+    def is_bad_host(self, host):
+        return bool(rconn.exists(self.bad_host_prefix + host))
+
+    def mark_bad_host(self, host):
+        rconn.setex(self.bad_host_prefix + host, int(config.fetch.bad_host_ttl), 1)
+
+    @staticmethod
+    def is_connect_failure(e):
+        """ Whether the request failed because the host couldn't be connected to """
+        if isinstance(e, requests.exceptions.ConnectTimeout):
+            return True
+        reason = getattr(e.args[0], "reason", None) if e.args else None
+        return isinstance(e, requests.exceptions.ConnectionError) and isinstance(
+            reason, NewConnectionError
+        )
+
+    def get(
+        self,
+        url,
+        receive_timeout=10,
+        max_size=25000000,
+        mimetypes=None,
+        partial_read=False,
+    ):
+        """Gets stuff from the internet, with timeouts, content type and
+        size restrictions.  If partial_read is True it will return
+        approximately the first max_size bytes, otherwise it will raise an
+        error if max_size is exceeded. Returns the response and the body."""
+        if self.pid != os.getpid():
+            self._setup()
+        try:
+            host = (urlparse(url).hostname or "").lower()
+        except ValueError:
+            raise ValueError("invalid url")
+        if not host:
+            raise ValueError("invalid url")
+        if self.is_bad_host(host):
+            raise ValueError("host recently unreachable")
+
+        with self._slot(host, receive_timeout):
+            try:
+                r = self.session.get(url, stream=True, timeout=receive_timeout)
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+            ) as e:
+                if self.is_connect_failure(e):
+                    self.mark_bad_host(host)
+                raise ValueError("error fetching")
+            except:  # noqa
+                raise ValueError("error fetching")
+            with r:
+                r.raise_for_status()
+                return r, self._read(
+                    r, receive_timeout, max_size, mimetypes, partial_read
+                )
+
+    def _read(self, r, receive_timeout, max_size, mimetypes, partial_read):
+        length = int(r.headers.get("Content-Length") or 0)
+        if length > max_size and not partial_read:
+            raise ValueError("response too large")
+
+        if mimetypes is not None:
+            mtype, _ = cgi.parse_header(r.headers.get("Content-Type", ""))
+            if mtype not in mimetypes:
+                raise ValueError("wrong content type")
+
+        # Fill a buffer of the announced size in place, and only grow it if
+        # the server sends more than it said.
+        buf = bytearray(min(length, max_size))
+        size = 0
+        start = time.time()
+        for chunk in r.iter_content(65536):
+            if time.time() - start > receive_timeout:
+                raise ValueError("timeout reached")
+            gevent.sleep(0)  # Otherwise this loop can block other greenlets
+
+            end = size + len(chunk)
+            if end <= len(buf):
+                buf[size:end] = chunk
+            else:
+                del buf[size:]
+                buf += chunk
+            size = end
+            if size > max_size:
+                if partial_read:
+                    break
+                raise ValueError("response too large")
+        del buf[size:]
+        return bytes(buf)
+
+
+def normalize_url(url):
+    """Returns `url` with the scheme and host lowercased and without the
+    default port, user info or fragment, so different ways of writing the
+    same address share their cached metadata."""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or "").lower()
+    if parts.port and parts.port != {"http": 80, "https": 443}.get(scheme):
+        netloc += f":{parts.port}"
+    return urlunsplit((scheme, netloc, parts.path or "/", parts.query, ""))
+
+
+class UrlMetadataCache:
+    """What we learned about the pages people link to: their title, the
+    URL of their og:image and the name of the thumbnail made for them.
+    Kept in Redis for `fetch.metadata_ttl` seconds, so links posted again
+    don't have to be fetched and parsed again by any worker."""
+
+    prefix = "urlmeta:"
+    lock_timeout = 30
+
+    def __init__(self):
+        self.inflight = {}
+
+    def key(self, url):
+        return self.prefix + hashlib.sha1(normalize_url(url).encode()).hexdigest()
+
+    def get(self, url):
+        try:
+            values = rconn.hgetall(self.key(url))
+        except ValueError:
+            return {}
+        return {k.decode(): v.decode() for k, v in values.items()}
+
+    def set(self, url, **values):
+        key = self.key(url)
+        pipe = rconn.pipeline()
+        pipe.hset(key, mapping=values)
+        pipe.expire(key, int(config.fetch.metadata_ttl))
+        pipe.execute()
+
+    def once(self, url, field, func):
+        """Returns the cached `field` of `url`, or the result of `func()`,
+        which is cached if it isn't empty. If another greenlet or worker is
+        already running `func` for the same URL and field, waits for it
+        instead of running it again. Exceptions raised by `func` are raised
+        in every greenlet of this process waiting for it."""
+        try:
+            key = self.key(url)
+        except ValueError:
+            return func()
+        value = rconn.hget(key, field)
+        if value:
+            return value.decode()
+
+        flight = (key, field)
+        if flight in self.inflight:
+            return self.inflight[flight].get()
+        result = self.inflight[flight] = gevent.event.AsyncResult()
+        try:
+            value = self._once_shared(url, key, field, func)
+        except Exception as e:
+            result.set_exception(e)
+            raise
+        else:
+            result.set(value)
+            return value
+        finally:
+            del self.inflight[flight]
+
+    def _once_shared(self, url, key, field, func):
+        lock = f"{key}:lock:{field}"
+        owner = rconn.set(lock, 1, nx=True, ex=self.lock_timeout)
+        if not owner:
+            # Another worker is on it. Wait for its result, or do it
+            # ourselves if it takes too long or fails.
+            deadline = time.time() + self.lock_timeout
+            while time.time() < deadline and rconn.exists(lock):
+                gevent.sleep(0.2)
+                value = rconn.hget(key, field)
+                if value:
+                    return value.decode()
+        try:
+            value = func()
+            if value:
+                self.set(url, **{field: value})
+            return value
+        finally:
+            if owner:
+                rconn.delete(lock)
+
+
+fetcher = Fetcher()
+url_metadata = UrlMetadataCache()
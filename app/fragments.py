@@ -0,0 +1,95 @@
+""" Keeps rendered pieces of templates, marked with `@cache(...)`, in memory. """
+import hashlib
+import time
+from collections import Counter, OrderedDict
+from flask import current_app, has_request_context
+from flask_babel import get_locale
+from .config import config
+from .models import rconn
+
+STATS_KEY = "fragments:stats"
+
+
+class FragmentCache:
+    """An in-process LRU of rendered template fragments, sized by
+    `cache.fragment_lru_size` (0 turns it off). Templates use it through
+    the `@cache` statement added by misc.FragmentCacheExtension::
+
+        @cache("top-posts", func.getTodaysTopPosts(), ttl=300):
+          ...
+        @end
+
+    The fragment is kept for `ttl` seconds and rendered again before that
+    if any of the dependencies (or the locale) change, so they must
+    include everything the fragment shows. The first one, usually a
+    string, names the fragment in the hit and miss counters, which are
+    added up in Redis every `flush_interval` seconds."""
+
+    flush_interval = 10
+
+    def __init__(self):
+        self.lru = OrderedDict()
+        self.counts = Counter()
+        self.flushed = time.time()
+
+    def key(self, deps):
+        locale = str(get_locale()) if has_request_context() else ""
+        return hashlib.sha1(repr((locale, deps)).encode()).hexdigest()
+
+    def begin(self, w, pos, name, *deps, ttl=60):
+        """Writes the cached fragment with `w` and returns nothing to run
+        if there is one, or returns what `end` needs once the fragment
+        starting at `pos` has been rendered."""
+        if not int(config.cache.fragment_lru_size):
+            return ((None, pos, ttl, name),)
+        key = self.key((name, deps))
+        try:
+            self.lru.move_to_end(key)
+            expires, html = self.lru[key]
+        except KeyError:
+            expires = 0
+        if expires > time.time():
+            self.count(name, "hits")
+            w(html)
+            return ()
+        self.count(name, "misses")
+        return ((key, pos, ttl, name),)
+
+    def end(self, buf, fragment):
+        key, pos, ttl, name = fragment
+        if key is None:
+            return
+        self.lru[key] = (time.time() + ttl, "".join(buf[pos:]))
+        while len(self.lru) > int(config.cache.fragment_lru_size):
+            try:
+                self.lru.popitem(last=False)
+            except KeyError:
+                break
+
+    def count(self, name, outcome):
+        self.counts[f"{name}:{outcome}"] += 1
+        if time.time() - self.flushed > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        counts, self.counts = self.counts, Counter()
+        self.flushed = time.time()
+        try:
+            pipe = rconn.pipeline(transaction=False)
+            for field, count in counts.items():
+                pipe.hincrby(STATS_KEY, field, count)
+            pipe.execute()
+        except Exception as e:
+            current_app.logger.warning("Could not record fragment stats: %s", e)
+
+
+def get_stats():
+    """ Returns the hits and misses of each fragment, added up over all the web workers """
+    stats = {}
+    for key, value in rconn.hgetall(STATS_KEY).items():
+        name, outcome = key.decode().rsplit(":", 1)
+        stats.setdefault(name, {"hits": 0, "misses": 0})[outcome] = int(value)
+    return stats
+
+
+fragment_cache = FragmentCache()
@@ -0,0 +1,241 @@
+""" Background jobs, kept in Redis and run by `flask worker`. """
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from contextlib import contextmanager
+import gevent
+from flask import current_app
+from .config import config
+from .models import rconn
+
+PREFIX = "jobs:"
+JOBS = {}  # Job name => (function, queue, retries)
+
+
+def job(queue="default", retries=3):
+    """Registers a function as a job that can be passed to `enqueue`. Its
+    arguments must be JSON serializable. A job that raises is retried up
+    to `retries` times, waiting longer each time, and then moved to the
+    dead letter list."""
+
+    def decorator(func):
+        JOBS[func.__name__] = (func, queue, retries)
+        return func
+
+    return decorator
+
+
+def enqueue(func, *args):
+    """Runs the job `func(*args)` in the background. With `jobs.enabled` it
+    is queued for `flask worker`, otherwise it runs in a new greenlet of
+    this process (or right away when testing)."""
+    name = func.__name__
+    _, queue, _ = JOBS[name]
+    if config.jobs.enabled:
+        payload = {
+            "id": uuid.uuid4().hex,
+            "name": name,
+            "queue": queue,
+            "args": args,
+            "attempts": 0,
+            "enqueued": time.time(),
+        }
+        rconn.lpush(f"{PREFIX}queue:{queue}", json.dumps(payload))
+    elif config.app.testing:
+        func(*args)
+    else:
+        gevent.spawn(_run_in_app, current_app._get_current_object(), func, args)
+
+
+def _run_in_app(app, func, args):
+    with app.app_context():
+        func(*args)
+
+
+class Worker:
+    """Takes jobs from the queues, in order of priority, and runs them.
+    Jobs being run are kept in a list of this worker's, and put back in
+    their queues by the next worker to start if this one dies."""
+
+    backoff = 10  # Seconds before the first retry, doubled on each retry
+    dead_max = 1000  # Dead jobs kept
+    heartbeat_ttl = 30
+
+    def __init__(self, app, queues):
+        self.app = app
+        self.queues = queues
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self.processing = f"{PREFIX}processing:{self.name}"
+        self.heartbeat = 0
+        self.stopping = False
+
+    def recover(self):
+        """ Puts back the jobs of workers that stopped without finishing them """
+        for key in rconn.scan_iter(match=f"{PREFIX}processing:*"):
+            name = key.decode()[len(f"{PREFIX}processing:") :]
+            if rconn.exists(f"{PREFIX}worker:{name}"):
+                continue
+            while True:
+                payload = rconn.rpop(key)
+                if payload is None:
+                    break
+                queue = json.loads(payload)["queue"]
+                rconn.rpush(f"{PREFIX}queue:{queue}", payload)
+
+    def beat(self):
+        if time.time() - self.heartbeat > self.heartbeat_ttl / 3:
+            rconn.setex(f"{PREFIX}worker:{self.name}", self.heartbeat_ttl, 1)
+            self.heartbeat = time.time()
+
+    @contextmanager
+    def beating(self):
+        """Keeps the heartbeat going while a job runs, so other workers don't
+        take this one for dead and run the job again."""
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.heartbeat_ttl / 3):
+                try:
+                    self.beat()
+                except Exception as e:
+                    self.app.logger.warning("Could not send heartbeat: %s", e)
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def promote_delayed(self):
+        """ Moves the jobs waiting to be retried whose time has come back to their queues """
+        due = rconn.zrangebyscore(f"{PREFIX}delayed", 0, time.time(), start=0, num=100)
+        for payload in due:
+            # Only the worker that removes it gets to queue it.
+            if rconn.zrem(f"{PREFIX}delayed", payload):
+                queue = json.loads(payload)["queue"]
+                rconn.rpush(f"{PREFIX}queue:{queue}", payload)
+
+    def fetch(self, timeout):
+        for queue in self.queues:
+            payload = rconn.rpoplpush(f"{PREFIX}queue:{queue}", self.processing)
+            if payload is not None:
+                return payload
+        if timeout:
+            return rconn.brpoplpush(
+                f"{PREFIX}queue:{self.queues[0]}", self.processing, timeout
+            )
+        return None
+
+    def work_once(self, timeout=0):
+        """Runs one job, waiting up to `timeout` seconds for one. Returns
+        False if there was nothing to do."""
+        self.beat()
+        self.promote_delayed()
+        payload = self.fetch(timeout)
+        if payload is None:
+            return False
+        self.run(payload)
+        return True
+
+    def run(self, payload):
+        data = json.loads(payload)
+        stats = f"{PREFIX}stats:{data['queue']}"
+        start = time.time()
+        rconn.hincrbyfloat(stats, "latency_ms", (start - data["enqueued"]) * 1000)
+        try:
+            func, _, retries = JOBS[data["name"]]
+        except KeyError:
+            func, retries = None, 0
+        try:
+            if func is None:
+                raise KeyError(f"Unknown job {data['name']}")
+            with self.app.app_context(), self.beating():
+                func(*data["args"])
+        except Exception:
+            error = traceback.format_exc()
+            self.app.logger.warning("Job %s failed: %s", data["name"], error)
+            data["attempts"] += 1
+            data["error"] = error
+            pipe = rconn.pipeline()
+            pipe.hincrby(stats, "failed", 1)
+            if data["attempts"] > retries:
+                pipe.lpush(f"{PREFIX}dead", json.dumps(data))
+                pipe.ltrim(f"{PREFIX}dead", 0, self.dead_max - 1)
+                pipe.hincrby(stats, "dead", 1)
+            else:
+                retry_at = time.time() + self.backoff * 2 ** (data["attempts"] - 1)
+                data["enqueued"] = retry_at
+                pipe.zadd(f"{PREFIX}delayed", {json.dumps(data): retry_at})
+                pipe.hincrby(stats, "retried", 1)
+        else:
+            pipe = rconn.pipeline()
+            pipe.hincrby(stats, "processed", 1)
+        pipe.hincrbyfloat(stats, "runtime_ms", (time.time() - start) * 1000)
+        pipe.lrem(self.processing, 1, payload)
+        pipe.execute()
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def work(self, burst=False, periodic=()):
+        """Runs jobs until `stop` is called, or until there are no jobs
+        left if `burst` is set. `periodic` is a list of (function, interval
+        in seconds) to call every so often between jobs."""
+        self.recover()
+        last_run = [0] * len(periodic)
+        while not self.stopping:
+            for i, (func, interval) in enumerate(periodic):
+                if time.time() - last_run[i] >= interval:
+                    with self.app.app_context():
+                        func()
+                    last_run[i] = time.time()
+            if not self.work_once(timeout=0 if burst else 1) and burst:
+                break
+        rconn.delete(f"{PREFIX}worker:{self.name}")
+
+
+def get_stats():
+    """ Returns the depth and the totals of every queue """
+    queues = {queue for _, queue, _ in JOBS.values()}
+    for key in rconn.scan_iter(match=f"{PREFIX}stats:*"):
+        queues.add(key.decode()[len(f"{PREFIX}stats:") :])
+    result = {}
+    for queue in sorted(queues):
+        values = {
+            k.decode(): float(v)
+            for k, v in rconn.hgetall(f"{PREFIX}stats:{queue}").items()
+        }
+        done = values.get("processed", 0) + values.get("failed", 0)
+        result[queue] = {
+            "depth": rconn.llen(f"{PREFIX}queue:{queue}"),
+            "processed": int(values.get("processed", 0)),
+            "failed": int(values.get("failed", 0)),
+            "retried": int(values.get("retried", 0)),
+            "dead": int(values.get("dead", 0)),
+            "avg_latency_ms": round(values.get("latency_ms", 0) / max(done, 1), 1),
+            "avg_runtime_ms": round(values.get("runtime_ms", 0) / max(done, 1), 1),
+        }
+    return {
+        "queues": result,
+        "delayed": rconn.zcard(f"{PREFIX}delayed"),
+        "dead": rconn.llen(f"{PREFIX}dead"),
+    }
+
+
+def retry_dead():
+    """ Puts the dead jobs back in their queues. Returns how many. """
+    count = 0
+    while True:
+        payload = rconn.rpop(f"{PREFIX}dead")
+        if payload is None:
+            return count
+        data = json.loads(payload)
+        data["attempts"] = 0
+        rconn.lpush(f"{PREFIX}queue:{data['queue']}", json.dumps(data))
+        count += 1
@@ -8,9 +8,10 @@ import random
 import time
 import os
 import re
-import gevent
 import ipaddress
-from collections import defaultdict
+import hashlib
+import pickle
+from collections import defaultdict, OrderedDict
 
 from bs4 import BeautifulSoup
 import tinycss2
@@ -78,13 +79,15 @@ from .models import (
 from .models import SubMod, SubBan, SubPostCommentHistory, SubPostMetadata
 
 from .storage import file_url, thumbnail_url
-from peewee import JOIN, fn, SQL, NodeList, Value
+from . import jobs, offload
+from .fragments import fragment_cache
+from peewee import JOIN, Case, fn, SQL, NodeList, Value
 import logging
 import logging.config
 from werkzeug.local import LocalProxy
 
 from wheezy.template.engine import Engine
-from wheezy.template.ext.core import CoreExtension
+from wheezy.template.ext.core import CoreExtension, stmt_token
 from wheezy.template.loader import FileLoader
 
 # Regex that matches VALID user and sub names
@@ -109,10 +112,42 @@ class EscapeExtension(object):
     builder_rules = [("var", build_var)]
 
 
+def build_fragment_cache(builder, lineno, token, value):
+    assert token == "cache"
+    stmt, nodes = value
+    args = stmt[stmt.index("(") + 1 : stmt.rindex(")")]
+    fragment = f"_fragment{lineno}"
+    builder.add(lineno, f"for {fragment} in _fragment_cache.begin(w, len(_b), {args}):")
+    builder.start_block()
+    builder.build_block(nodes)
+    builder.add(builder.lineno + 1, f"_fragment_cache.end(_b, {fragment})")
+    builder.end_block()
+    return True
+
+
+def configure_fragment_cache_parser(parser):
+    parser.compound_tokens.append("cache")
+
+
+def clean_fragment_cache_source(source):
+    return re.sub(r"(^|\n)[ ]+@cache\(", r"\1@cache(", source)
+
+
+class FragmentCacheExtension(object):
+    """Adds `@cache(name, dependencies..., ttl=seconds):` ... `@end` to
+    templates, to reuse what's in between. See fragments.FragmentCache."""
+
+    lexer_rules = {90: (re.compile(r"@((cache)\(.*?(?<!\\))(\n|$)", re.S), stmt_token)}
+    preprocessors = [clean_fragment_cache_source]
+    parser_configs = [configure_fragment_cache_parser]
+    builder_rules = [("cache", build_fragment_cache)]
+
+
 engine = Engine(
     loader=FileLoader([os.path.split(__file__)[0] + "/html"]),
-    extensions=[EscapeExtension(), CoreExtension()],
+    extensions=[EscapeExtension(), FragmentCacheExtension(), CoreExtension()],
 )
+engine.global_vars["_fragment_cache"] = fragment_cache
 
 mail = Mail()
 
@@ -124,9 +159,9 @@ talisman = Talisman()
 class SiteUser(object):
     """ Representation of a site user. Used on the login manager. """
 
-    def __init__(self, userclass=None, subs=(), prefs=()):
+    def __init__(self, userclass=None, subs=(), prefs=(), is_a_mod=False, level=None):
         self.user = userclass
-        self.notifications = self.user.get("notifications", 0)
+        self._notifications = None
         self.open_reports = self.user.get("open_reports", 0)
         self.name = self.user["name"]
         self.uid = self.user["uid"]
@@ -167,11 +202,8 @@ class SiteUser(object):
         # True if the user is an admin, even without authing with TOTP
         self.can_admin = "admin" in self.prefs
 
-        try:
-            SubMod.select().where(SubMod.user == self.uid).get()
-            self.is_a_mod = True
-        except SubMod.DoesNotExist:
-            self.is_a_mod = False
+        self.is_a_mod = is_a_mod
+        self.level = level or get_user_level(self.uid, self.score)
 
         if time.time() - session.get("apriv", 0) < 7200 or not config.site.enable_totp:
             self.admin = "admin" in self.prefs
@@ -182,16 +214,19 @@ class SiteUser(object):
         if config.site.allow_uploads and config.site.upload_min_level == 0:
             self.canupload = True
         elif config.site.allow_uploads and (
-            config.site.upload_min_level <= get_user_level(self.uid, self.score)[0]
+            config.site.upload_min_level <= self.level[0]
         ):
             self.canupload = True
 
+    @property
+    def notifications(self):
+        """ Number of unread notifications and messages, counted on first use """
+        if self._notifications is None:
+            self._notifications = get_unread_total(self.uid)
+        return self._notifications
+
     def can_pm_users(self):
-        return (
-            config.site.send_pm_to_user_min_level
-            <= get_user_level(self.uid, self.score)[0]
-            or self.admin
-        )
+        return config.site.send_pm_to_user_min_level <= self.level[0] or self.admin
 
     def __repr__(self):
         return "<SiteUser {0}>".format(self.uid)
@@ -278,10 +313,9 @@ class SiteUser(object):
         """ Returns true if user selects to block sub styles """
         return "nostyles" in self.prefs
 
-    @cache.memoize(300)
     def get_user_level(self):
         """ Returns the level and xp of a user. """
-        return get_user_level(self.uid, self.score)
+        return self.level
 
     def get_top_bar(self):
         return self.top_bar
@@ -297,20 +331,19 @@ class SiteUser(object):
             umd.save()
         except UserMetadata.DoesNotExist:
             UserMetadata.create(uid=self.uid, key=key, value=value)
+        invalidate_user_snapshot(self.uid)
 
     @cache.memoize(30)
     def get_global_stylesheet(self):
+        """ Returns the URL of the stylesheet of the sub chosen as the user's theme, if any """
         if self.subtheme:
             try:
-                css = (
-                    SubStylesheet.select()
-                    .join(Sub)
-                    .where(fn.Lower(Sub.name) == self.subtheme.lower())
-                    .get()
-                )
-            except SubStylesheet.DoesNotExist:
+                sub = Sub.get(fn.Lower(Sub.name) == self.subtheme.lower())
+            except Sub.DoesNotExist:
                 return ""
-            return css.content
+            digest = getSubData(sub.sid)["stylesheet_hash"]
+            if digest:
+                return url_for("sub.view_sub_css", sub=sub.name, digest=digest)
         return ""
 
 
@@ -478,7 +511,50 @@ md = m.Markdown(
 )
 
 
+# In-process LRU in front of the Redis markdown cache, keyed by
+# markdown_cache_key.
+_markdown_lru = OrderedDict()
+
+
+def markdown_cache_key(text):
+    """Returns the content address of `text` in the markdown cache. Rendered
+    output depends on the sub prefix (mentions are turned into links) so it
+    is hashed along with the text."""
+    digest = hashlib.sha256(
+        f"{config.site.sub_prefix}\0{text}".encode("utf-8", "surrogatepass")
+    ).hexdigest()
+    return "md-" + digest
+
+
 def our_markdown(text):
+    """Renders `text` with render_markdown, going through an in-process LRU
+    and then Redis before actually rendering."""
+    if not text:
+        return render_markdown(text)
+    key = markdown_cache_key(text)
+    try:
+        _markdown_lru.move_to_end(key)
+        return _markdown_lru[key]
+    except KeyError:
+        pass
+
+    html = rconn.get(key)
+    if html is None:
+        html = render_markdown(text)
+        rconn.setex(key, value=html, time=int(config.cache.markdown_ttl))
+    else:
+        html = html.decode()
+
+    _markdown_lru[key] = html
+    while len(_markdown_lru) > int(config.cache.markdown_lru_size):
+        try:
+            _markdown_lru.popitem(last=False)
+        except KeyError:
+            break
+    return html
+
+
+def render_markdown(text):
     """Here we create a custom markdown function where we load all the
     extensions we need."""
 
@@ -659,6 +735,13 @@ def send_email(to, subject, text_content, html_content, sender=None):
 def send_email_with_smtp(sender, recipients, subject, text_content, html_content):
     if not isinstance(recipients, list):
         recipients = [recipients]
+    jobs.enqueue(
+        send_smtp_email_async, sender, recipients, subject, text_content, html_content
+    )
+
+
+@jobs.job("mail")
+def send_smtp_email_async(sender, recipients, subject, text_content, html_content):
     msg = EmailMessage(
         subject,
         sender=sender,
@@ -666,15 +749,7 @@ def send_email_with_smtp(sender, recipients, subject, text_content, html_content
         body=text_content,
         html=html_content,
     )
-    if config.app.testing:
-        send_smtp_email_async(current_app, msg)
-    else:
-        gevent.spawn(send_smtp_email_async, current_app._get_current_object(), msg)
-
-
-def send_smtp_email_async(app, msg):
-    with app.app_context():
-        mail.send(msg)
+    mail.send(msg)
 
 
 def send_email_with_sendgrid(sender, to, subject, html_content):
@@ -752,6 +827,7 @@ def workWithMentions(data, receivedby, post, _sub, cid=None, c_user=current_user
                         sender=c_user.uid,
                         target=user.uid,
                     )
+                bump_counter("notifications", user.uid)
                 socketio.emit(
                     "notification",
                     {"count": get_notification_count(user.uid)},
@@ -992,6 +1068,7 @@ def postListQueryBase(
             SubPost.posted,
             SubPost.deleted,
             SubPost.score,
+            SubPost.hot,
             SubPost.ptype,
             SubPost.distinguish,
             SubPost.thumbnail,
@@ -1039,6 +1116,7 @@ def postListQueryBase(
             SubPost.posted,
             SubPost.deleted,
             SubPost.score,
+            SubPost.hot,
             SubPost.ptype,
             SubPost.distinguish,
             SubPost.thumbnail,
@@ -1093,25 +1171,278 @@ def postListQueryHome(noDetail=False, nofilter=False):
         )
 
 
-def getPostList(baseQuery, sort, page):
-    if sort == "top":
-        posts = baseQuery.order_by(SubPost.score.desc()).paginate(page, 25)
-    elif sort == "new":
-        posts = baseQuery.order_by(SubPost.pid.desc()).paginate(page, 25)
+# Columns each post listing is sorted by (descending). The post id is
+# always last so the order is total and can be resumed from a cursor.
+POST_SORT_KEYS = {
+    "new": (SubPost.pid,),
+    "top": (SubPost.score, SubPost.pid),
+    "hot": (SubPost.hot, SubPost.pid),
+}
+
+
+def getPostList(baseQuery, sort, page, after=None):
+    """Returns a page of 25 posts from `baseQuery`. If `after` is a cursor
+    (see post_cursor) the page starts right after the post it points to and
+    `page` is ignored, so deep pages don't have to skip rows with OFFSET."""
+    if sort not in POST_SORT_KEYS:
+        sort = "hot"
+    keys = POST_SORT_KEYS[sort]
+    posts = baseQuery.order_by(*[key.desc() for key in keys])
+    values = parse_post_cursor(after, sort) if after else None
+    if values is not None:
+        return posts.where(keyset_condition(keys, values)).limit(25)
+    return posts.paginate(page, 25)
+
+
+def keyset_condition(keys, values):
+    """Returns the condition for rows after `values` when sorting by `keys`
+    descending. The redundant bound on the first key lets the database
+    start a range scan of the (keys...) index there."""
+    if len(keys) == 1:
+        return keys[0] < values[0]
+    return (keys[0] <= values[0]) & _keyset_condition(keys, values)
+
+
+def _keyset_condition(keys, values):
+    if len(keys) == 1:
+        return keys[0] < values[0]
+    return (keys[0] < values[0]) | (
+        (keys[0] == values[0]) & _keyset_condition(keys[1:], values[1:])
+    )
+
+
+def post_cursor(post, sort):
+    """Returns an opaque cursor that points to `post` (a dict with the
+    columns in POST_SORT_KEYS) in a listing sorted by `sort`."""
+    if sort not in POST_SORT_KEYS:
+        sort = "hot"
+    values = [sort] + [post[key.name] for key in POST_SORT_KEYS[sort]]
+    cursor = base64.urlsafe_b64encode(json.dumps(values).encode())
+    return cursor.decode().rstrip("=")
+
+
+def parse_post_cursor(cursor, sort):
+    """Returns the sort key values stored in `cursor`, or None if it is not
+    a valid cursor for a listing sorted by `sort`."""
+    if sort not in POST_SORT_KEYS:
+        sort = "hot"
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        return None
+    if (
+        not isinstance(values, list)
+        or len(values) != len(POST_SORT_KEYS[sort]) + 1
+        or values[0] != sort
+    ):
+        return None
+    values = values[1:]
+    for value in values:
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return None
+    return values
+
+
+def next_post_cursor(posts, sort):
+    """ Returns the cursor of the page after `posts`, or None if it was the last one """
+    if len(posts) < 25:
+        return None
+    return post_cursor(posts[-1], sort)
+
+
+# Materialized home feeds (`site.home_feed`). Every set of subscriptions
+# has a sorted set of its newest, hottest and top posts for each sort in
+# "home-feed:<digest>:<sort>", capped at `max_entries` and rebuilt every
+# `ttl` seconds. The digests of the feeds that include a sub are kept in
+# "home-feed-digests:<sid>", scored by the time the feed expires and capped at
+# `max_feeds_per_sub`, so new posts, votes and deletions can be pushed to
+# the feeds that show them. Votes only move posts already in a feed.
+HOME_FEED_UPDATE = """
+redis.call("zremrangebyscore", KEYS[1], "-inf", ARGV[9])
+local digests = redis.call("zrange", KEYS[1], 0, -1)
+local scores = {new = ARGV[2], hot = ARGV[3], top = ARGV[4]}
+local nsfw = ARGV[5] == "1"
+local remove = ARGV[6] == "1"
+local size = tonumber(ARGV[7])
+local add = ARGV[8] == "1"
+for _, digest in ipairs(digests) do
+    for sort, score in pairs(scores) do
+        local key = "home-feed:" .. digest .. ":" .. sort
+        if remove or (nsfw and string.sub(digest, 1, 1) == "0") then
+            redis.call("zrem", key, ARGV[1])
+        elseif not add then
+            redis.call("zadd", key, "XX", score, ARGV[1])
+        elseif redis.call("exists", key) == 1 then
+            redis.call("zadd", key, score, ARGV[1])
+            redis.call("zremrangebyrank", key, 0, -size - 1)
+        end
+    end
+end
+"""
+
+
+def home_feed_member(pid):
+    # Zero padded so posts with the same score are ordered by pid, like in SQL
+    return f"{int(pid):012d}"
+
+
+def home_feed_digest():
+    """ Identifies the home feed of the current user's subscriptions """
+    subs = ",".join(sorted(current_user.subsid))
+    nsfw = "1" if "nsfw" in current_user.prefs else "0"
+    return nsfw + ":" + hashlib.sha1(subs.encode()).hexdigest()[:20]
+
+
+def build_home_feed(digest, sort):
+    """ Materializes the current user's home feed for `sort` """
+    keys = POST_SORT_KEYS[sort]
+    posts = SubPost.select(SubPost.pid, keys[0].alias("score")).where(
+        (SubPost.sid << current_user.subsid) & (SubPost.deleted == 0)
+    )
+    if digest[0] == "0":
+        posts = posts.where(SubPost.nsfw == 0)
+    posts = posts.order_by(*[key.desc() for key in keys])
+    posts = posts.limit(int(config.site.home_feed.max_entries)).dicts()
+
+    key = f"home-feed:{digest}:{sort}"
+    ttl = int(config.site.home_feed.ttl)
+    pipe = rconn.pipeline()
+    for sid in current_user.subsid:
+        pipe.zadd("home-feed-digests:" + sid, {digest: time.time() + ttl})
+        pipe.expire("home-feed-digests:" + sid, ttl)
+    pipe.delete(key)
+    members = {home_feed_member(x["pid"]): x["score"] or 0 for x in posts}
+    if members:
+        pipe.zadd(key, members)
+        pipe.expire(key, ttl)
+    pipe.execute()
+    trim_home_feed_subs(current_user.subsid)
+
+
+def trim_home_feed_subs(sids):
+    """Keeps the `max_feeds_per_sub` feeds of each sub that were built
+    last. The others are dropped, to be built again when they're viewed."""
+    limit = int(config.site.home_feed.max_feeds_per_sub)
+    pipe = rconn.pipeline(transaction=False)
+    for sid in sids:
+        pipe.zcard("home-feed-digests:" + sid)
+    for sid, count in zip(sids, pipe.execute()):
+        if count <= limit:
+            continue
+        key = "home-feed-digests:" + sid
+        evicted = rconn.zrange(key, 0, count - limit - 1)
+        pipe = rconn.pipeline()
+        pipe.zrem(key, *evicted)
+        for digest in evicted:
+            for sort in POST_SORT_KEYS:
+                pipe.delete(f"home-feed:{digest.decode()}:{sort}")
+        pipe.execute()
+
+
+def get_home_feed_page(sort, page, after=None):
+    """Returns the pids in a page of the current user's home feed, or None
+    if the page isn't in the materialized feed."""
+    digest = home_feed_digest()
+    key = f"home-feed:{digest}:{sort}"
+    if not rconn.exists(key):
+        build_home_feed(digest, sort)
+
+    start = (page - 1) * 25
+    values = parse_post_cursor(after, sort) if after else None
+    if values is not None:
+        rank = rconn.zrevrank(key, home_feed_member(values[-1]))
+        if rank is None:
+            return None
+        start = rank + 1
+
+    pipe = rconn.pipeline()
+    pipe.zcard(key)
+    pipe.zrevrange(key, start, start + 24)
+    size, members = pipe.execute()
+    # Posts past the end of the feed may have been trimmed from it
+    if start + 25 > size and size >= int(config.site.home_feed.max_entries):
+        return None
+    return [int(x) for x in members]
+
+
+def getHomePostList(sort, page, after=None):
+    """Returns a page of the home page posts, like getPostList does for
+    postListQueryHome. Uses the materialized home feed if enabled."""
+    if sort not in POST_SORT_KEYS:
+        sort = "hot"
+    if (
+        config.site.home_feed.enabled
+        and current_user.is_authenticated
+        and current_user.subsid
+    ):
+        pids = get_home_feed_page(sort, page, after)
+        if pids is not None:
+            return (
+                postListQueryBase(isSubMod=current_user.can_admin)
+                .where(SubPost.pid << pids)
+                .order_by(*[key.desc() for key in POST_SORT_KEYS[sort]])
+            )
+    return getPostList(postListQueryHome(), sort, page, after)
+
+
+def update_home_feeds(*pids, added=False):
+    """Updates the position of the given posts in the materialized home
+    feeds that show them, or removes them if they were deleted. Must be
+    called after creating, voting, deleting or un-deleting posts. Set
+    `added` when the posts may be missing from feeds that should show
+    them (new, un-deleted or no longer NSFW posts) to push them there."""
+    if not config.site.home_feed.enabled or not pids:
+        return
+    posts = SubPost.select(
+        SubPost.pid,
+        SubPost.sid,
+        SubPost.hot,
+        SubPost.score,
+        SubPost.nsfw,
+        SubPost.deleted,
+    ).where(SubPost.pid << pids)
+    for post in posts:
+        rconn.eval(
+            HOME_FEED_UPDATE,
+            1,
+            "home-feed-digests:" + post.sid_id,
+            home_feed_member(post.pid),
+            post.pid,
+            repr(post.hot),
+            post.score or 0,
+            int(bool(post.nsfw)),
+            int(bool(post.deleted)),
+            int(config.site.home_feed.max_entries),
+            int(added),
+            time.time(),
+        )
+
+
+def post_epoch_expression():
+    """ Returns a SQL expression for the post's creation time in seconds """
+    if "Postgresql" in config.database.engine:
+        return fn.EXTRACT(NodeList((SQL("EPOCH FROM"), SubPost.posted)))
+    elif "SqliteDatabase" in config.database.engine:
+        return fn.strftime("%s", SubPost.posted).cast("integer")
     else:
-        if "Postgresql" in config.database.engine:
-            posted = fn.EXTRACT(NodeList((SQL("EPOCH FROM"), SubPost.posted)))
-        elif "SqliteDatabase" in config.database.engine:
-            posted = fn.datetime(SubPost.posted, "unixepoch")
-        else:
-            posted = fn.Unix_Timestamp(SubPost.posted)
+        return fn.Unix_Timestamp(SubPost.posted)
 
-        if config.site.custom_hot_sort:
-            hot = fn.HOT(SubPost.score, posted)
-        else:
-            hot = SubPost.score * 20 + (posted - 1134028003) / 1500
-        posts = baseQuery.order_by(hot.desc()).limit(100).paginate(page, 25)
-    return posts
+
+def hot_rank_expression():
+    """Returns the SQL expression used to calculate a post's hot rank.
+    The result is stored in `SubPost.hot` so the hot listings only have
+    to read the index on that column."""
+    posted = post_epoch_expression()
+    if config.site.custom_hot_sort:
+        return fn.HOT(SubPost.score, posted)
+    return SubPost.score * 20 + (posted - 1134028003) / 1500.0
+
+
+def update_hot_rank(*pids, added=False):
+    """Recalculates the stored hot rank of the given posts, and their
+    position in the materialized home feeds (see update_home_feeds)."""
+    SubPost.update(hot=hot_rank_expression()).where(SubPost.pid << pids).execute()
+    update_home_feeds(*pids, added=added)
 
 
 @cache.memoize(600)
@@ -1135,57 +1466,48 @@ def getAnnouncement():
         return False
 
 
-@cache.memoize(5)
 def getWikiPid(sid):
     """ Returns a list of wickied SubPosts """
-    x = (
-        SubMetadata.select(SubMetadata.value)
-        .where(SubMetadata.sid == sid)
-        .where(SubMetadata.key == "wiki")
-        .dicts()
-    )
-    return [int(y["value"]) for y in x]
+    return get_sub_bundle(sid)["wiki_pids"]
 
 
-@cache.memoize(60)
 def getStickyPid(sid):
     """ Returns a list of stickied SubPosts """
-    x = (
-        SubMetadata.select(SubMetadata.value)
-        .where(SubMetadata.sid == sid)
-        .where(SubMetadata.key == "sticky")
-        .dicts()
-    )
-    return [int(y["value"]) for y in x]
+    return get_sub_bundle(sid)["sticky_pids"]
 
 
-@cache.memoize(60)
 def getStickies(sid):
-    posts = postListQueryBase().join(
-        SubMetadata,
-        on=(
-            (SubPost.sid == SubMetadata.sid)
-            & (SubPost.pid == SubMetadata.value.cast("int"))
-            & (SubMetadata.key == "sticky")
-        ),
-    )
-    posts = posts.where(SubPost.sid == sid)
-    posts = posts.order_by(SubMetadata.xid.asc()).dicts()
-    return list(posts)
+    """Returns the sub's stickied posts, without the ones the current user
+    filters out, and with their votes on them."""
+    if current_user.is_authenticated and sid in current_user.blocksid:
+        return []
+    posts = [dict(post) for post in get_sub_bundle(sid)["stickies"]]
+    if (not current_user.is_authenticated) or ("nsfw" not in current_user.prefs):
+        posts = [post for post in posts if not post["nsfw"]]
+    if current_user.is_authenticated and posts:
+        votes = dict(
+            SubPostVote.select(SubPostVote.pid, SubPostVote.positive)
+            .where(
+                (SubPostVote.uid == current_user.uid)
+                & (SubPostVote.pid << [post["pid"] for post in posts])
+            )
+            .tuples()
+        )
+        for post in posts:
+            post["positive"] = votes.get(post["pid"])
+    return posts
 
 
-def load_user(user_id):
-    mcount = Message.select(fn.Count(Message.mid)).where(
-        (Message.receivedby == user_id)
-        & (Message.mtype == 1)
-        & Message.read.is_null(True)
-    )
-    ncount = Notification.select(fn.Count(Notification.id)).where(
-        (Notification.target == user_id) & Notification.read.is_null(True)
-    )
+def get_user_snapshot(uid):
+    """Returns everything load_user needs to build a SiteUser, from Redis if
+    it is there. Must be invalidated with invalidate_user_snapshot whenever
+    the user, their subscriptions, preferences or mod status change. Score
+    and level may lag behind by up to `cache.user_snapshot_ttl` seconds."""
+    snapshot = rconn.get("user-snapshot:" + uid)
+    if snapshot is not None:
+        return json.loads(snapshot)
+
     user = User.select(
-        mcount.alias("messages"),
-        ncount.alias("notifications"),
         User.given,
         User.score,
         User.name,
@@ -1195,35 +1517,61 @@ def load_user(user_id):
         User.language,
         User.resets,
     )
-    user = user.where(User.uid == user_id).dicts().get()
-    user["notifications"] += user["messages"]
+    user = user.where(User.uid == uid).dicts().get()
+
+    prefs = UserMetadata.select(UserMetadata.key, UserMetadata.value).where(
+        UserMetadata.uid == uid
+    )
+    prefs = prefs.where((UserMetadata.value == "1") | (UserMetadata.key == "subtheme"))
+
+    subs = (
+        SubSubscriber.select(SubSubscriber.sid, Sub.name, SubSubscriber.status)
+        .join(Sub, on=(Sub.sid == SubSubscriber.sid))
+        .switch(SubSubscriber)
+        .where(SubSubscriber.uid == uid)
+    )
+    subs = subs.order_by(SubSubscriber.order.asc())
+
+    snapshot = {
+        "user": user,
+        "subs": list(subs.dicts()),
+        "prefs": list(prefs.dicts()),
+        "is_a_mod": SubMod.select().where(SubMod.user == uid).exists(),
+        "level": get_user_level(uid, user["score"]),
+    }
+    rconn.setex(
+        "user-snapshot:" + uid,
+        value=json.dumps(snapshot),
+        time=int(config.cache.user_snapshot_ttl),
+    )
+    return snapshot
+
+
+def invalidate_user_snapshot(*uids):
+    """ Makes the next load_user of these users rebuild their snapshot """
+    if uids:
+        rconn.delete(*["user-snapshot:" + uid for uid in uids])
+
+
+def load_user(user_id):
+    try:
+        snapshot = get_user_snapshot(user_id)
+    except User.DoesNotExist:
+        return None
+    user = snapshot["user"]
 
     # This is the only user attribute needed by the error templates, so stash
     # it in the session so that future errors in this session won't have to
     # load the user to show them the correct language.
     session["language"] = user["language"]
 
-    if request.path == "/socket.io/":
-        return SiteUser(user, [], [])
-    else:
-        prefs = UserMetadata.select(UserMetadata.key, UserMetadata.value).where(
-            UserMetadata.uid == user_id
-        )
-        prefs = prefs.where(
-            (UserMetadata.value == "1") | (UserMetadata.key == "subtheme")
-        ).dicts()
-
-        try:
-            subs = (
-                SubSubscriber.select(SubSubscriber.sid, Sub.name, SubSubscriber.status)
-                .join(Sub, on=(Sub.sid == SubSubscriber.sid))
-                .switch(SubSubscriber)
-                .where(SubSubscriber.uid == user_id)
-            )
-            subs = subs.order_by(SubSubscriber.order.asc()).dicts()
-            return SiteUser(user, subs, prefs)
-        except User.DoesNotExist:
-            return None
+    return SiteUser(
+        user,
+        snapshot["subs"],
+        snapshot["prefs"],
+        is_a_mod=snapshot["is_a_mod"],
+        level=tuple(snapshot["level"]),
+    )
 
 
 def user_is_loaded():
@@ -1251,45 +1599,108 @@ def get_locale_fallback():
     )
 
 
-def get_modmail_count(uid):
+def count_unread_notifications(uid):
+    return (
+        Notification.select()
+        .where((Notification.target == uid) & Notification.read.is_null(True))
+        .count()
+    )
+
+
+def count_unread_messages(uid):
+    return (
+        Message.select()
+        .where(
+            (Message.mtype == 1)
+            & (Message.receivedby == uid)
+            & Message.read.is_null(True)
+        )
+        .count()
+    )
+
+
+def count_open_reports(sid):
     post_report_count = (
         SubPostReport.select()
         .join(SubPost)
-        .join(Sub)
-        .join(SubMod)
-        .where((SubMod.user == uid) & SubPostReport.open)
+        .where((SubPost.sid == sid) & SubPostReport.open)
         .count()
     )
     comment_report_count = (
         SubPostCommentReport.select()
         .join(SubPostComment)
         .join(SubPost)
-        .join(Sub)
-        .join(SubMod)
-        .where((SubMod.user == uid) & SubPostCommentReport.open)
+        .where((SubPost.sid == sid) & SubPostCommentReport.open)
         .count()
     )
-
     return post_report_count + comment_report_count
 
 
+# Counters kept in Redis, and the functions that count them from scratch.
+# "notifications" and "messages" are kept per uid and "reports" per sid.
+COUNTERS = {
+    "notifications": count_unread_notifications,
+    "messages": count_unread_messages,
+    "reports": count_open_reports,
+}
+
+# Only increments counters that are already loaded. Otherwise the next
+# get_counters counts from the database, which already has the change.
+INCR_IF_EXISTS = """
+if redis.call("exists", KEYS[1]) == 1 then
+    return redis.call("incrby", KEYS[1], ARGV[1])
+end
+"""
+
+
+def get_counters(kind, idents):
+    """Returns the values of the `kind` counters of `idents`, counting the
+    ones that aren't in Redis from the database. Counters expire after
+    `cache.counter_ttl` seconds so any drift is eventually fixed."""
+    keys = [f"counter:{kind}:{ident}" for ident in idents]
+    values = rconn.mget(keys) if keys else []
+    result = []
+    for key, ident, value in zip(keys, idents, values):
+        if value is None:
+            value = COUNTERS[kind](ident)
+            rconn.set(key, value, ex=int(config.cache.counter_ttl), nx=True)
+        result.append(max(int(value), 0))
+    return result
+
+
+def get_counter(kind, ident):
+    return get_counters(kind, [ident])[0]
+
+
+def bump_counter(kind, ident, delta=1):
+    """ Adds `delta` to a counter. Call it after changing the database. """
+    rconn.eval(INCR_IF_EXISTS, 1, f"counter:{kind}:{ident}", delta)
+
+
+def reset_counter(kind, ident):
+    """Makes the next get_counter count from the database again. Used after
+    changes that are hard to turn into a delta, like marking all as read."""
+    rconn.delete(f"counter:{kind}:{ident}")
+
+
+def get_modmail_count(uid):
+    sids = [
+        sid for sid, in SubMod.select(SubMod.sub).where(SubMod.user == uid).tuples()
+    ]
+    return sum(get_counters("reports", sids))
+
+
+def get_unread_total(uid):
+    """ Returns the number of unread notifications and messages of a user """
+    return get_counter("notifications", uid) + get_counter("messages", uid)
+
+
 def get_notification_count(uid):
-    notifications = (
-        Notification.select()
-        .where((Notification.target == uid) & Notification.read.is_null(True))
-        .count()
-    )
-    messages = (
-        Message.select()
-        .where(
-            (Message.mtype == 1)
-            & (Message.receivedby == uid)
-            & Message.read.is_null(True)
-        )
-        .count()
-    )
-    modmail = get_modmail_count(uid)
-    return {"notifications": notifications, "messages": messages, "modmail": modmail}
+    return {
+        "notifications": get_counter("notifications", uid),
+        "messages": get_counter("messages", uid),
+        "modmail": get_modmail_count(uid),
+    }
 
 
 def get_errors(form, first=False):
@@ -1591,58 +2002,21 @@ def getUserComments(uid, page):
 
 
 def getSubMods(sid):
-    modsquery = (
-        SubMod.select(User.uid, User.name, SubMod.power_level)
-        .join(User, on=(User.uid == SubMod.uid))
-        .where(SubMod.sid == sid)
-    )
-    modsquery = modsquery.where((User.status == 0) & (~SubMod.invite))
-
-    owner, mods, janitors, owner_uids, janitor_uids, mod_uids = ({}, {}, {}, [], [], [])
-    for i in modsquery:
-        if i.power_level == 0:
-            owner[i.uid] = i.user.name
-            owner_uids.append(i.uid)
-        elif i.power_level == 1:
-            mods[i.uid] = i.user.name
-            mod_uids.append(i.uid)
-        elif i.power_level == 2:
-            janitors[i.uid] = i.user.name
-            janitor_uids.append(i.uid)
-
-    if not owner:
-        owner["0"] = config.site.placeholder_account
-    return {
-        "owners": owner,
-        "mods": mods,
-        "janitors": janitors,
-        "all": owner_uids + janitor_uids + mod_uids,
-    }
+    return get_sub_bundle(sid)["mods"]
 
 
 def notify_mods(sid):
-    """ Send the sub mods an updated open report count. """
-    reports = (
-        SubPostReport.select(fn.Count(SubPostReport.id))
-        .join(SubPost)
-        .where((SubPost.sid == sid) & SubPostReport.open)
-    )
-    comments = (
-        SubPostCommentReport.select(fn.Count(SubPostCommentReport.id))
-        .join(SubPostComment)
-        .join(SubPost)
-        .where((SubPost.sid == sid) & SubPostCommentReport.open)
-    )
-    mods = SubMod.select(
-        SubMod.uid, reports.alias("reports"), comments.alias("comments")
-    ).where(SubMod.sub == sid)
+    """Recounts the sub's open reports and sends the sub mods the updated
+    count. Must be called after opening or closing reports."""
+    count = count_open_reports(sid)
+    rconn.set(f"counter:reports:{sid}", count, ex=int(config.cache.counter_ttl))
 
-    for mod in mods:
+    for mod in SubMod.select(SubMod.uid).where(SubMod.sub == sid):
         socketio.emit(
             "mod-notification",
-            {"update": [sid, mod.reports + mod.comments]},
+            {"update": [sid, count]},
             namespace="/snt",
-            room="user" + mod.uid,
+            room="user" + mod.uid_id,
         )
 
 
@@ -1656,10 +2030,29 @@ ptype_names = {
 }
 
 
-def getSubData(sid, simple=False, extra=False):
-    sdata = SubMetadata.select().where(SubMetadata.sid == sid)
+# In-process LRU in front of the sub bundles kept in Redis, keyed by
+# (sid, version).
+_sub_bundle_lru = OrderedDict()
+
+
+def sub_bundle_key(sid, version):
+    return f"sub-bundle:{sid}:{version}"
+
+
+def invalidate_sub_bundle(sid):
+    """Makes every process build the sub's bundle again the next time it is
+    needed. Must be called after changing the sub's metadata, mods, rules,
+    user flair choices, stickies or stylesheet."""
+    rconn.incr("sub-version:" + sid)
+    if has_app_context():
+        g.pop("sub_bundles", None)
+
+
+def build_sub_bundle(sid):
+    """ Reads everything getSubData and friends return about a sub from the database """
     data = {"xmod2": [], "sticky": []}
-    for p in sdata:
+    sticky_pids, wiki_pids = [], []
+    for p in SubMetadata.select().where(SubMetadata.sid == sid):
         if p.key in ["tag", "mod2i", "xmod2", "sticky"]:
             if data.get(p.key):
                 data[p.key].append(p.value)
@@ -1667,49 +2060,152 @@ def getSubData(sid, simple=False, extra=False):
                 data[p.key] = [p.value]
         else:
             data[p.key] = p.value
+        if p.key == "sticky":
+            sticky_pids.append(int(p.value))
+        elif p.key == "wiki":
+            wiki_pids.append(int(p.value))
+    data.setdefault("wiki", "")
+
+    data["xmods"] = []
+    if data["xmod2"]:
+        data["xmods"] = list(
+            User.select(User.uid, User.name)
+            .where((User.uid << data["xmod2"]) & (User.status == 0))
+            .dicts()
+        )
 
-    if not simple:
-        try:
-            data["wiki"]
-        except KeyError:
-            data["wiki"] = ""
-
-        if extra:
-            if data.get("xmod2"):
-                try:
-                    data["xmods"] = (
-                        User.select(User.uid, User.name)
-                        .where((User.uid << data["xmod2"]) & (User.status == 0))
-                        .dicts()
-                    )
-                except User.DoesNotExist:
-                    data["xmods"] = []
+    try:
+        creator = (
+            User.select(User.uid, User.name, User.status)
+            .where(User.uid == data.get("mod"))
+            .dicts()
+            .get()
+        )
+    except User.DoesNotExist:
+        creator = None
 
-        try:
-            creator = (
-                User.select(User.uid, User.name, User.status)
-                .where(User.uid == data.get("mod"))
-                .dicts()
-                .get()
-            )
-        except User.DoesNotExist:
-            creator = {"uid": "0", "name": "Nobody"}
-        data["creator"] = (
-            creator
-            if creator.get("status", None) == 0
-            else {"uid": "0", "name": _("[Deleted]")}
+    try:
+        data["stylesheet_hash"] = get_stylesheet_hash(
+            SubStylesheet.select(SubStylesheet.xid, SubStylesheet.content_hash)
+            .where(SubStylesheet.sid == sid)
+            .get()
         )
+    except SubStylesheet.DoesNotExist:
+        data["stylesheet_hash"] = ""
 
-        try:
-            data["stylesheet"] = SubStylesheet.get(SubStylesheet.sid == sid).content
-        except SubStylesheet.DoesNotExist:
-            data["stylesheet"] = ""
+    data["rules"] = list(
+        SubRule.select(SubRule.rid, SubRule.text)
+        .where(SubRule.sid == sid)
+        .order_by(SubRule.rid)
+        .dicts()
+    )
 
-        try:
-            data["rules"] = SubRule.select().join(Sub).where(Sub.sid == sid)
-        except SubRule.DoesNotExist:
-            data["rules"] = ""
+    modsquery = (
+        SubMod.select(User.uid, User.name, SubMod.power_level)
+        .join(User, on=(User.uid == SubMod.uid))
+        .where(SubMod.sid == sid)
+    )
+    modsquery = modsquery.where((User.status == 0) & (~SubMod.invite))
+
+    owner, mods, janitors, owner_uids, janitor_uids, mod_uids = ({}, {}, {}, [], [], [])
+    for i in modsquery:
+        if i.power_level == 0:
+            owner[i.uid] = i.user.name
+            owner_uids.append(i.uid)
+        elif i.power_level == 1:
+            mods[i.uid] = i.user.name
+            mod_uids.append(i.uid)
+        elif i.power_level == 2:
+            janitors[i.uid] = i.user.name
+            janitor_uids.append(i.uid)
+
+    if not owner:
+        owner["0"] = config.site.placeholder_account
 
+    # The stickies are shared by all users, so they are read without their
+    # votes or filters; getStickies adds those.
+    stickies = postListQueryBase(noDetail=True, nofilter=True).join(
+        SubMetadata,
+        on=(
+            (SubPost.sid == SubMetadata.sid)
+            & (SubPost.pid == SubMetadata.value.cast("int"))
+            & (SubMetadata.key == "sticky")
+        ),
+    )
+    stickies = stickies.where(SubPost.sid == sid)
+    stickies = stickies.order_by(SubMetadata.xid.asc()).dicts()
+
+    flair_choices = (
+        SubUserFlairChoice.select(SubUserFlairChoice.id, SubUserFlairChoice.flair)
+        .where(SubUserFlairChoice.sid == sid)
+        .dicts()
+    )
+
+    return {
+        "data": data,
+        "creator": creator,
+        "mods": {
+            "owners": owner,
+            "mods": mods,
+            "janitors": janitors,
+            "all": owner_uids + janitor_uids + mod_uids,
+        },
+        "sticky_pids": sticky_pids,
+        "wiki_pids": wiki_pids,
+        "stickies": list(stickies),
+        "flair_choices": list(flair_choices),
+    }
+
+
+def get_sub_bundle(sid):
+    """Returns all the sub-level data shown on sub and post pages, built by
+    build_sub_bundle. Bundles are cached in Redis and in an in-process LRU
+    under the version bumped by invalidate_sub_bundle, for up to
+    `cache.sub_bundle_ttl` seconds (stickies' scores may lag behind by as
+    much), and kept for the rest of the request, so once it is cached a
+    page only needs to read the version. Don't modify the result."""
+    bundles = g.setdefault("sub_bundles", {}) if has_request_context() else {}
+    if sid in bundles:
+        return bundles[sid]
+
+    version = int(rconn.get("sub-version:" + sid) or 0)
+    key = (sid, version)
+    now = time.time()
+    try:
+        _sub_bundle_lru.move_to_end(key)
+        bundle = _sub_bundle_lru[key]
+    except KeyError:
+        bundle = None
+    if bundle is None or bundle["expires"] < now:
+        cached = rconn.get(sub_bundle_key(sid, version))
+        bundle = pickle.loads(cached) if cached is not None else None
+        if bundle is None or bundle["expires"] < now:
+            ttl = int(config.cache.sub_bundle_ttl)
+            bundle = build_sub_bundle(sid)
+            bundle["expires"] = now + ttl
+            rconn.setex(sub_bundle_key(sid, version), ttl, pickle.dumps(bundle))
+        _sub_bundle_lru[key] = bundle
+        while len(_sub_bundle_lru) > int(config.cache.sub_bundle_lru_size):
+            try:
+                _sub_bundle_lru.popitem(last=False)
+            except KeyError:
+                break
+
+    bundles[sid] = bundle
+    return bundle
+
+
+def getSubData(sid, simple=False, extra=False):
+    """Returns the sub's metadata, along with its wiki, moderator invites,
+    creator, stylesheet hash and rules. `simple` and `extra` are no longer
+    needed: everything comes from the sub bundle."""
+    bundle = get_sub_bundle(sid)
+    data = dict(bundle["data"])
+    creator = bundle["creator"]
+    if creator is not None and creator["status"] == 0:
+        data["creator"] = creator
+    else:
+        data["creator"] = {"uid": "0", "name": _("[Deleted]")}
     return data
 
 
@@ -1808,6 +2304,30 @@ def validate_css(css, sid):
         return _("Invalid CSS"), 0, 0
 
 
+def stylesheet_content_hash(content):
+    """Returns the hash of a validated sub stylesheet that goes in the URL
+    it is served from, or "" if it is empty."""
+    if not content:
+        return ""
+    return hashlib.sha256(content.encode("utf-8", "surrogatepass")).hexdigest()[:20]
+
+
+def get_stylesheet_hash(sheet):
+    """Returns the content hash of the SubStylesheet `sheet`, working it
+    out and saving it for stylesheets saved before hashes were stored."""
+    if sheet.content_hash is None:
+        content = (
+            SubStylesheet.select(SubStylesheet.content)
+            .where(SubStylesheet.xid == sheet.xid)
+            .scalar()
+        )
+        sheet.content_hash = stylesheet_content_hash(content)
+        SubStylesheet.update(content_hash=sheet.content_hash).where(
+            SubStylesheet.xid == sheet.xid
+        ).execute()
+    return sheet.content_hash
+
+
 @cache.memoize(3)
 def get_security_questions():
     """ Returns a list of tuples containing security questions and answers """
@@ -1828,7 +2348,7 @@ def pick_random_security_question():
 def create_message(mfrom, to, subject, content, link, mtype):
     """ Creates a message. """
     posted = datetime.utcnow()
-    return Message.create(
+    message = Message.create(
         sentby=mfrom,
         receivedby=to,
         subject=subject,
@@ -1837,6 +2357,9 @@ def create_message(mfrom, to, subject, content, link, mtype):
         posted=posted,
         mtype=mtype,
     )
+    if mtype == 1:
+        bump_counter("messages", to)
+    return message
 
 
 try:
@@ -2011,25 +2534,37 @@ def create_reportlog(
         CommentReportLog.create(action=action, uid=uid, id=obj_id, desc=original_report)
 
 
+def link_domain(link):
+    """Returns the host name of the URL `link`, lowercased and without port
+    or trailing dot. This is what is stored in SubPost.domain."""
+    try:
+        host = urlparse(link).hostname
+    except ValueError:
+        return None
+    if not host:
+        return None
+    return host.rstrip(".")[:255] or None
+
+
 def is_domain_banned(addr, domain_type):
     if domain_type == "link":
         key = "banned_domain"
-        netloc = urlparse(addr).netloc
+        netloc = link_domain(addr) or ""
     elif domain_type == "email":
         key = "banned_email_domain"
-        netloc = addr.split("@")[1]
+        netloc = addr.split("@")[1].lower()
     else:
         raise RuntimeError
 
-    bans = SiteMetadata.select().where(SiteMetadata.key == key)
-    banned_domains, banned_domains_b = ([], [])
-    for ban in bans:
-        banned_domains.append(ban.value)
-        banned_domains_b.append("." + ban.value)
-
-    if (netloc in banned_domains) or (netloc.endswith(tuple(banned_domains_b))):
-        return True
-    return False
+    # A ban also applies to all the subdomains of the banned domain, so
+    # look for the host and every domain above it.
+    labels = netloc.split(".")
+    domains = [".".join(labels[i:]) for i in range(len(labels))]
+    return (
+        SiteMetadata.select()
+        .where((SiteMetadata.key == key) & (fn.Lower(SiteMetadata.value) << domains))
+        .exists()
+    )
 
 
 def captchas_required():
@@ -2039,13 +2574,18 @@ def captchas_required():
         return True
 
 
+def captcha_image(text):
+    """ Returns a base64 encoded captcha image of `text` """
+    data = ImageCaptcha(width=250, height=70).generate(text)
+    return base64.b64encode(data.getvalue()).decode()
+
+
 def create_captcha():
     """Generates a captcha image.
     Returns a tuple with a token and the base64 encoded image"""
     if not captchas_required() or config.app.testing:
         return None
     token = str(uuid.uuid4())
-    captchagen = ImageCaptcha(width=250, height=70)
     if random.randint(1, 50) == 1:
         captcha = random.choice(
             [
@@ -2083,8 +2623,10 @@ def create_captcha():
             for _ in range(random.randint(4, 6))
         )
 
-    data = captchagen.generate(captcha.upper())
-    b64captcha = base64.b64encode(data.getvalue()).decode()
+    try:
+        b64captcha = offload.pool.run(captcha_image, captcha.upper())
+    except offload.OffloadError:
+        b64captcha = captcha_image(captcha.upper())
     captcha = captcha.replace(" ", "").replace("0", "o")
 
     rconn.setex("cap-" + token, value=captcha, time=300)  # captcha valid for 5 minutes.
@@ -2104,6 +2646,18 @@ def validate_captcha(token, response):
     return False
 
 
+def build_comment_tree(comments):
+    """Builds a comment tree from a flat list of comments (which must have
+    at least `cid` and `parentcid`) in a single pass. Every comment gets a
+    `children` list, sorted in the same order as `comments`. Returns the
+    top level comments."""
+    children = defaultdict(list)
+    for comment in comments:
+        comment["children"] = children[comment["cid"]]
+        children[comment["parentcid"]].append(comment)
+    return children[None]
+
+
 def get_comment_tree(
     pid,
     sid,
@@ -2137,39 +2691,20 @@ def get_comment_tree(
         )
     sticky_cid = postmeta.get("sticky_cid")
 
-    def build_tree(tuff, rootcid=None):
-        """ Builds a comment tree """
-        res = []
-        for i in tuff[::]:
-            if i["parentcid"] == rootcid:
-                tuff.remove(i)
-                i["children"] = build_tree(tuff, rootcid=i["cid"])
-                res.append(i)
-        return res
-
     # 2 - Build bare comment tree
-    comment_tree = build_tree(list(comments))
+    comments = list(comments)
+    comment_tree = build_comment_tree(comments)
 
     # 2.1 - get only a branch of the tree if necessary
     if root:
-
-        def select_branch(commentslst, rootcid):
-            """ Finds a branch with a certain root and returns a new tree """
-            for i in commentslst:
-                if i["cid"] == rootcid:
-                    return i
-                k = select_branch(i["children"], rootcid)
-                if k:
-                    return k
-
-        comment_tree = select_branch(comment_tree, root)
+        comment_tree = next((x for x in comments if x["cid"] == root), None)
         if comment_tree:
             # include the parent of the root for context.
             if comment_tree["parentcid"] is None or not provide_context:
                 comment_tree = [comment_tree]
             else:
                 orig_root = [
-                    x for x in list(comments) if x["cid"] == comment_tree["parentcid"]
+                    x for x in comments if x["cid"] == comment_tree["parentcid"]
                 ]
                 orig_root[0]["children"] = [comment_tree]
                 comment_tree = orig_root
@@ -2373,13 +2908,75 @@ def get_notif_count():
     Temporary till we get rid of the old template
      @deprecated
     """
-    return (
-        Notification.select()
-        .where(
-            (Notification.target == current_user.uid) & Notification.read.is_null(True)
-        )
-        .count()
-    )
+    return get_counter("notifications", current_user.uid)
+
+
+def for_update(query):
+    """ Makes `query` lock the rows it selects, if the database can do that """
+    return query.for_update() if db.for_update else query
+
+
+VOTE_DELTA_PREFIX = "vote-delta:"
+VOTE_DELTA_DIRTY = "vote-delta:dirty"
+
+
+def queue_vote_deltas(deltas):
+    """Adds counter deltas to Redis instead of writing them to the database,
+    for `site.vote_write_behind`. `deltas` is a list of (model, id, {field:
+    delta}). Returns the pending deltas, including these ones, in the same
+    shape. They are applied by flush_vote_deltas."""
+    pipe = rconn.pipeline()
+    for model, ident, fields in deltas:
+        key = f"{VOTE_DELTA_PREFIX}{model._meta.table_name}:{ident}"
+        for field, delta in fields.items():
+            pipe.hincrby(key, field, delta)
+        pipe.sadd(VOTE_DELTA_DIRTY, key)
+    result = iter(pipe.execute())
+    pending = []
+    for model, ident, fields in deltas:
+        pending.append((model, ident, {field: next(result) for field in fields}))
+        next(result)
+    return pending
+
+
+def flush_vote_deltas(batch=1000):
+    """Writes the counter deltas queued by queue_vote_deltas to the database
+    in a single transaction and returns how many rows were updated."""
+    models = {m._meta.table_name: m for m in (SubPost, SubPostComment, User)}
+    keys = rconn.spop(VOTE_DELTA_DIRTY, batch)
+    if not keys:
+        return 0
+
+    pipe = rconn.pipeline()
+    for key in keys:
+        pipe.hgetall(key)
+        pipe.delete(key)
+    result = pipe.execute()[::2]
+
+    deltas = []
+    for key, fields in sorted(zip(keys, result)):
+        if fields:
+            table, ident = key.decode()[len(VOTE_DELTA_PREFIX) :].split(":", 1)
+            fields = {k.decode(): int(v) for k, v in fields.items()}
+            deltas.append((models[table], ident, fields))
+
+    try:
+        with db.atomic():
+            for model, ident, fields in deltas:
+                model.update(
+                    {
+                        getattr(model, f): getattr(model, f) + d
+                        for f, d in fields.items()
+                    }
+                ).where(model._meta.primary_key == ident).execute()
+            pids = [int(ident) for model, ident, _ in deltas if model is SubPost]
+            if pids:
+                update_hot_rank(*pids)
+    except Exception:
+        # Put them back so they are not lost
+        queue_vote_deltas(deltas)
+        raise
+    return len(deltas)
 
 
 def cast_vote(uid, target_type, pcid, value):
@@ -2406,6 +3003,7 @@ def cast_vote(uid, target_type, pcid, value):
 
     if target_type == "post":
         target_model = SubPost
+        vote_model = SubPostVote
         try:
             target = SubPost.select(
                 SubPost.uid,
@@ -2423,17 +3021,10 @@ def cast_vote(uid, target_type, pcid, value):
         if target.deleted:
             return jsonify(msg=_("You can't vote on deleted posts")), 400
 
-        try:
-            qvote = (
-                SubPostVote.select()
-                .where(SubPostVote.pid == pcid)
-                .where(SubPostVote.uid == uid)
-                .get()
-            )
-        except SubPostVote.DoesNotExist:
-            qvote = False
+        qvote = SubPostVote.select().where(SubPostVote.pid == pcid)
     elif target_type == "comment":
         target_model = SubPostComment
+        vote_model = SubPostCommentVote
         try:
             target = SubPostComment.select(
                 SubPostComment.uid,
@@ -2460,15 +3051,7 @@ def cast_vote(uid, target_type, pcid, value):
         if target.status:
             return jsonify(msg=_("You can't vote on deleted comments")), 400
 
-        try:
-            qvote = (
-                SubPostCommentVote.select()
-                .where(SubPostCommentVote.cid == pcid)
-                .where(SubPostCommentVote.uid == uid)
-                .get()
-            )
-        except SubPostCommentVote.DoesNotExist:
-            qvote = False
+        qvote = SubPostCommentVote.select().where(SubPostCommentVote.cid == pcid)
     else:
         return jsonify(msg=_("Invalid target")), 400
 
@@ -2482,77 +3065,75 @@ def cast_vote(uid, target_type, pcid, value):
 
     positive = True if voteValue == 1 else False
     undone = False
+    write_behind = config.site.vote_write_behind
+
+    with db.atomic():
+        # Lock the users involved, always in the same order so concurrent
+        # votes can't deadlock. Locking the voter also keeps them from
+        # racing themselves into casting two votes. With write-behind the
+        # author's row isn't written to here, so it is left alone.
+        lock_uids = [uid] if write_behind else [uid, target.uid_id]
+        for_update(
+            User.select(User.uid).where(User.uid << lock_uids).order_by(User.uid)
+        ).execute()
+        qvote = for_update(qvote.where(vote_model.uid == uid)).first()
 
-    if qvote is not False:
-        if bool(qvote.positive) == (True if voteValue == 1 else False):
+        if qvote is not None and bool(qvote.positive) == positive:
             qvote.delete_instance()
-
-            if positive:
-                upd_q = target_model.update(
-                    score=target_model.score - voteValue,
-                    upvotes=target_model.upvotes - 1,
-                )
-            else:
-                upd_q = target_model.update(
-                    score=target_model.score - voteValue,
-                    downvotes=target_model.downvotes - 1,
-                )
             new_score = -voteValue
+            upvotes, downvotes = (-1, 0) if positive else (0, -1)
+            given = -voteValue
             undone = True
-            User.update(score=User.score - voteValue).where(
-                User.uid == target.uid
-            ).execute()
-            User.update(given=User.given - voteValue).where(User.uid == uid).execute()
-        else:
+        elif qvote is not None:
             qvote.positive = positive
             qvote.save()
-
-            if positive:
-                upd_q = target_model.update(
-                    score=target_model.score + (voteValue * 2),
-                    upvotes=target_model.upvotes + 1,
-                    downvotes=target_model.downvotes - 1,
-                )
+            new_score = voteValue * 2
+            upvotes, downvotes = (1, -1) if positive else (-1, 1)
+            given = voteValue
+        else:  # First vote cast on post
+            now = datetime.utcnow()
+            if target_type == "post":
+                SubPostVote.create(pid=pcid, uid=uid, positive=positive, datetime=now)
             else:
-                upd_q = target_model.update(
-                    score=target_model.score + (voteValue * 2),
-                    upvotes=target_model.upvotes - 1,
-                    downvotes=target_model.downvotes + 1,
+                SubPostCommentVote.create(
+                    cid=pcid, uid=uid, positive=positive, datetime=now
                 )
-            new_score = voteValue * 2
-            User.update(score=User.score + (voteValue * 2)).where(
-                User.uid == target.uid
-            ).execute()
-            User.update(given=User.given + voteValue).where(User.uid == uid).execute()
-    else:  # First vote cast on post
-        now = datetime.utcnow()
-        if target_type == "post":
-            SubPostVote.create(pid=pcid, uid=uid, positive=positive, datetime=now)
-        else:
-            SubPostCommentVote.create(
-                cid=pcid, uid=uid, positive=positive, datetime=now
-            )
-
-        if positive:
-            upd_q = target_model.update(
-                score=target_model.score + voteValue, upvotes=target_model.upvotes + 1
-            )
-        else:
-            upd_q = target_model.update(
-                score=target_model.score + voteValue,
-                downvotes=target_model.downvotes + 1,
-            )
-        new_score = voteValue
-        User.update(score=User.score + voteValue).where(
-            User.uid == target.uid
-        ).execute()
-        User.update(given=User.given + voteValue).where(User.uid == uid).execute()
+            new_score = voteValue
+            upvotes, downvotes = (1, 0) if positive else (0, 1)
+            given = voteValue
+
+        deltas = [
+            (
+                target_model,
+                target.id,
+                {"score": new_score, "upvotes": upvotes, "downvotes": downvotes},
+            ),
+            (User, target.uid_id, {"score": new_score}),
+            (User, uid, {"given": given}),
+        ]
+        if not write_behind:
+            for model, ident, fields in deltas:
+                model.update(
+                    {
+                        getattr(model, f): getattr(model, f) + d
+                        for f, d in fields.items()
+                    }
+                ).where(model._meta.primary_key == ident).execute()
+            if target_type == "post":
+                update_hot_rank(target.id)
+
+    target_score = target.score + new_score
+    author_score = target.uid.score
+    if write_behind:
+        # Show the scores as they will be once the deltas are flushed
+        deltas = queue_vote_deltas(deltas)
+        target_score = target.score + deltas[0][2]["score"]
+        author_score += deltas[1][2]["score"]
 
     if target_type == "post":
-        upd_q.where(SubPost.pid == target.id).execute()
         socketio.emit(
             "threadscore",
-            {"pid": target.id, "score": target.score + new_score},
+            {"pid": target.id, "score": target_score},
             namespace="/snt",
             room=target.id,
         )
@@ -2562,22 +3143,174 @@ def cast_vote(uid, target_type, pcid, value):
             {
                 "pid": target.id,
                 "status": voteValue if not undone else 0,
-                "score": target.score + new_score,
+                "score": target_score,
             },
             namespace="/snt",
             room="user" + uid,
         )
-    else:
-        upd_q.where(SubPostComment.cid == target.id).execute()
 
     socketio.emit(
         "uscore",
-        {"score": target.uid.score + new_score},
+        {"score": author_score},
         namespace="/snt",
         room="user" + target.uid_id,
     )
 
-    return jsonify(score=target.score + new_score, rm=undone)
+    return jsonify(score=target_score, rm=undone)
+
+
+UNDO_VOTES_PREFIX = "undo-votes:"
+
+
+def get_undo_votes_progress(uid):
+    """Returns the status ("running", "done" or "failed") of the removal of
+    the votes of `uid`, with the number of votes to remove and removed so
+    far."""
+    progress = rconn.hgetall(UNDO_VOTES_PREFIX + uid)
+    return {
+        k.decode(): v.decode() if k == b"status" else int(v)
+        for k, v in progress.items()
+    }
+
+
+def _remove_votes(uid, key, own_posts, batch):
+    """ Does the work of undo_votes. Returns the posts and users whose scores changed. """
+    pids, authors = set(), set()
+    for vote, target, target_key, vote_key, keep_own in (
+        (SubPostVote, SubPost, SubPost.pid, SubPostVote.pid, True),
+        (
+            SubPostCommentVote,
+            SubPostComment,
+            SubPostComment.cid,
+            SubPostCommentVote.cid,
+            False,
+        ),
+    ):
+        last = 0
+        while True:
+            with db.atomic():
+                xids = [
+                    xid
+                    for xid, in vote.select(vote.xid)
+                    .where((vote.uid == uid) & (vote.xid > last))
+                    .order_by(vote.xid)
+                    .limit(batch)
+                    .tuples()
+                ]
+                if not xids:
+                    break
+                last = xids[-1]
+                if keep_own:
+                    xids = [
+                        xid
+                        for xid, in vote.select(vote.xid)
+                        .where((vote.xid << xids) & ~(vote_key << own_posts))
+                        .tuples()
+                    ]
+                in_batch = vote.xid << xids
+
+                # Votes on posts or comments that were deleted are just removed.
+                targets = (
+                    vote.select(vote_key, target.uid)
+                    .join(target, on=(target_key == vote_key))
+                    .where(in_batch)
+                    .distinct()
+                    .tuples()
+                )
+                idents, target_authors = set(), set()
+                for ident, author in targets:
+                    idents.add(ident)
+                    target_authors.add(author)
+
+                if idents:
+                    value = fn.SUM(Case(None, [(vote.positive == 1, 1)], -1))
+                    on_target = in_batch & (vote_key == target_key)
+                    count = fn.COUNT(vote.xid)
+                    target.update(
+                        upvotes=target.upvotes
+                        - vote.select(count).where(on_target & (vote.positive == 1)),
+                        downvotes=target.downvotes
+                        - vote.select(count).where(on_target & (vote.positive == 0)),
+                        score=target.score - vote.select(value).where(on_target),
+                    ).where(target_key << list(idents)).execute()
+
+                    received = (
+                        vote.select(value)
+                        .join(target, on=(target_key == vote_key))
+                        .where(in_batch & (target.uid == User.uid))
+                    )
+                    User.update(score=User.score - received).where(
+                        User.uid << list(target_authors)
+                    ).execute()
+                    given = (
+                        vote.select(value)
+                        .join(target, on=(target_key == vote_key))
+                        .where(in_batch)
+                        .scalar()
+                    )
+                    User.update(given=User.given - given).where(
+                        User.uid == uid
+                    ).execute()
+
+                removed = vote.delete().where(in_batch).execute()
+            if target is SubPost:
+                pids |= idents
+            authors |= target_authors
+            rconn.hincrby(key, "done", removed)
+    return list(pids), list(authors)
+
+
+@jobs.job("default", retries=0)
+def undo_votes(uid, batch=1000):
+    """Removes the votes cast by `uid`, except on their own posts, and takes
+    them out of the scores of the posts, comments and users that got them.
+    Votes are removed `batch` at a time, each batch with a few statements
+    in a transaction of its own, and the progress is kept in Redis. The new
+    scores are sent to the browsers once everything is done."""
+    key = UNDO_VOTES_PREFIX + uid
+    own_posts = SubPost.select(SubPost.pid).where(SubPost.uid == uid)
+    total = (
+        SubPostVote.select()
+        .where((SubPostVote.uid == uid) & ~(SubPostVote.pid << own_posts))
+        .count()
+        + SubPostCommentVote.select().where(SubPostCommentVote.uid == uid).count()
+    )
+    rconn.delete(key)
+    rconn.hset(key, mapping={"status": "running", "total": total, "done": 0})
+    rconn.expire(key, 86400)
+
+    try:
+        pids, authors = _remove_votes(uid, key, own_posts, batch)
+        for i in range(0, len(pids), batch):
+            update_hot_rank(*pids[i : i + batch])
+    except Exception:
+        # Let the admins start it again.
+        rconn.hset(key, "status", "failed")
+        raise
+    rconn.hset(key, "status", "done")
+
+    for i in range(0, len(pids), batch):
+        posts = SubPost.select(SubPost.pid, SubPost.score).where(
+            SubPost.pid << pids[i : i + batch]
+        )
+        for post in posts:
+            socketio.emit(
+                "threadscore",
+                {"pid": post.pid, "score": post.score},
+                namespace="/snt",
+                room=post.pid,
+            )
+    for i in range(0, len(authors), batch):
+        users = User.select(User.uid, User.score).where(
+            User.uid << authors[i : i + batch]
+        )
+        for user in users:
+            socketio.emit(
+                "uscore",
+                {"score": user.score},
+                namespace="/snt",
+                room="user" + user.uid,
+            )
 
 
 def is_sub_mod(uid, sid, power_level, can_admin=False):
@@ -2880,79 +3613,227 @@ def word_truncate(content, max_length, suffix="..."):
     )
 
 
-def recent_activity(sidebar=True):
-    if not config.site.recent_activity.enabled:
-        return False
+# The latest posts and comments are kept in the list RECENT_ACTIVITY_KEY.
+# If the sidebar only shows those of default subs or only comments, it has
+# its own list with the entries that match, see recent_activity_list. Each
+# list is built from the database the first time it's needed, and then
+# "<list>:built" is set.
+RECENT_ACTIVITY_KEY = "activity:recent"
+RECENT_ACTIVITY_MAX = 100
+
+# Adds an entry to each of the lists in KEYS (with their "built" key after
+# them), unless the list has to be built from the database first (then the
+# entry will be read from there).
+RECENT_ACTIVITY_ADD = """
+for i = 1, #KEYS, 2 do
+  if redis.call('EXISTS', KEYS[i + 1]) == 1 then
+    redis.call('LPUSH', KEYS[i], ARGV[1])
+    redis.call('LTRIM', KEYS[i], 0, ARGV[2] - 1)
+  end
+end
+"""
+
+# Removes the entry of a post or comment from the lists in KEYS, or
+# replaces its content if ARGV[3] is given.
+RECENT_ACTIVITY_CHANGE = """
+for _, key in ipairs(KEYS) do
+  local items = redis.call('LRANGE', key, 0, -1)
+  for i, item in ipairs(items) do
+    local entry = cjson.decode(item)
+    if entry['type'] == ARGV[1] and entry['id'] == ARGV[2] then
+      if ARGV[3] then
+        entry['content'] = ARGV[3]
+        redis.call('LSET', key, i - 1, cjson.encode(entry))
+      else
+        redis.call('LREM', key, 1, item)
+      end
+      break
+    end
+  end
+end
+"""
+
+
+def recent_activity_list(sidebar):
+    """Returns the key of the list read by the sidebar (or by the /activity
+    page), and whether it only has the entries of default subs and only
+    comments."""
+    defaults_only = sidebar and bool(config.site.recent_activity.defaults_only)
+    comments_only = sidebar and bool(config.site.recent_activity.comments_only)
+    if not (defaults_only or comments_only):
+        return RECENT_ACTIVITY_KEY, False, False
+    key = f"{RECENT_ACTIVITY_KEY}:{int(defaults_only)}{int(comments_only)}"
+    return key, defaults_only, comments_only
+
+
+def reset_recent_activity():
+    """Builds the recent activity lists again from the database. Needed after
+    changing the default subs, or undeleting a post, which has to go back in
+    its place among the others."""
+    keys = [RECENT_ACTIVITY_KEY, RECENT_ACTIVITY_KEY + ":built"]
+    for sidebar_key in ("10", "11", "01"):
+        key = f"{RECENT_ACTIVITY_KEY}:{sidebar_key}"
+        keys += [key, key + ":built"]
+    rconn.delete(*keys)
+
+
+def comment_summary(content, length=250):
+    """ Returns the text of a comment, without markup or spoilers, shortened to `length` """
+    parsed = BeautifulSoup(our_markdown(content), features="lxml")
+    for spoiler in parsed.findAll("spoiler"):
+        spoiler.string = "█" * len(spoiler.get_text())
+    text = "".join(parsed.findAll(text=True)).replace("\n", " ").strip()
+    return word_truncate(text, length)
+
+
+def _recent_activity_entry(kind, ident, content, user, pid, sid, sub, time):
+    return json.dumps(
+        {
+            "type": kind,
+            "id": str(ident),
+            "content": content,
+            "user": user,
+            "time": time.isoformat(),
+            "pid": pid,
+            "sid": sid,
+            "sub": sub,
+        }
+    )
 
-    # XXX: The queries below don't work on sqlite
-    # TODO: Make em work?
-    if "SqliteDatabase" in config.database.engine:
-        return []
 
-    # TODO: Pagination?
-    post_activity = SubPost.select(
-        Value("post").alias("type"),
-        SubPost.title.alias("content"),
-        User.name.alias("user"),
-        SubPost.posted.alias("time"),
-        SubPost.pid,
-        SubPost.sid,
+def add_recent_activity(kind, ident, content, user, pid, sub, time):
+    """Adds a new post or comment (`kind`) to the recent activity. `content`
+    is the title of the post or the summary of the comment, and `sub` the
+    Sub it was posted in."""
+    entry = _recent_activity_entry(
+        kind, ident, content, user, pid, sub.sid, sub.name, time
     )
-    post_activity = post_activity.join(User).switch(SubPost)
-    post_activity = (
-        post_activity.where(SubPost.deleted == 0).order_by(SubPost.pid.desc()).limit(50)
+    keys = [RECENT_ACTIVITY_KEY]
+    sidebar_key, defaults_only, comments_only = recent_activity_list(True)
+    if (
+        sidebar_key != RECENT_ACTIVITY_KEY
+        and (kind == "comment" or not comments_only)
+        and (not defaults_only or sub.sid in {x["sid"] for x in getDefaultSubs()})
+    ):
+        keys.append(sidebar_key)
+    built = [key + ":built" for key in keys]
+    rconn.eval(
+        RECENT_ACTIVITY_ADD,
+        len(keys) * 2,
+        *[k for pair in zip(keys, built) for k in pair],
+        entry,
+        RECENT_ACTIVITY_MAX,
     )
 
-    comment_activity = SubPostComment.select(
-        Value("comment").alias("type"),
-        SubPostComment.content,
-        User.name.alias("user"),
-        SubPostComment.time.alias("time"),
-        SubPost.pid,
-        SubPost.sid,
+
+def change_recent_activity(kind, ident, content=None):
+    """Replaces the content of a post or comment in the recent activity
+    after it was edited, or removes it if `content` is None."""
+    keys = {RECENT_ACTIVITY_KEY, recent_activity_list(True)[0]}
+    args = [kind, str(ident)] + ([content] if content is not None else [])
+    rconn.eval(RECENT_ACTIVITY_CHANGE, len(keys), *keys, *args)
+
+
+def build_recent_activity(key, defaults_only=False, comments_only=False):
+    """Fills the recent activity list `key` with the latest posts and
+    comments from the database, or only those that match the filters."""
+    sids = [x["sid"] for x in getDefaultSubs()] if defaults_only else None
+    posts = (
+        SubPost.select(
+            SubPost.pid,
+            SubPost.title,
+            SubPost.posted,
+            User.name.alias("user"),
+            Sub.sid,
+            Sub.name.alias("sub"),
+        )
+        .join(User, on=(User.uid == SubPost.uid))
+        .switch(SubPost)
+        .join(Sub, on=(Sub.sid == SubPost.sid))
+        .where(SubPost.deleted == 0)
+        .order_by(SubPost.pid.desc())
+        .limit(RECENT_ACTIVITY_MAX)
     )
-    comment_activity = comment_activity.join(User).switch(SubPostComment).join(SubPost)
-    comment_activity = (
-        comment_activity.where(SubPostComment.status.is_null(True))
+    comments = (
+        SubPostComment.select(
+            SubPostComment.cid,
+            SubPostComment.content,
+            SubPostComment.time,
+            User.name.alias("user"),
+            SubPost.pid,
+            Sub.sid,
+            Sub.name.alias("sub"),
+        )
+        .join(User, on=(User.uid == SubPostComment.uid))
+        .switch(SubPostComment)
+        .join(SubPost, on=(SubPost.pid == SubPostComment.pid))
+        .join(Sub, on=(Sub.sid == SubPost.sid))
+        .where(SubPostComment.status.is_null(True))
         .order_by(SubPostComment.time.desc())
-        .limit(50)
+        .limit(RECENT_ACTIVITY_MAX)
     )
+    if sids is not None:
+        posts = posts.where(SubPost.sid << sids)
+        comments = comments.where(SubPost.sid << sids)
+    posts = [] if comments_only else posts.dicts()
+    entries = [
+        (
+            p["posted"],
+            "post",
+            p["pid"],
+            p["title"],
+            p["user"],
+            p["pid"],
+            p["sid"],
+            p["sub"],
+        )
+        for p in posts
+    ] + [
+        (
+            c["time"],
+            "comment",
+            c["cid"],
+            comment_summary(c["content"]),
+            c["user"],
+            c["pid"],
+            c["sid"],
+            c["sub"],
+        )
+        for c in comments.dicts()
+    ]
+    entries.sort(key=lambda x: x[0], reverse=True)
+    entries = entries[:RECENT_ACTIVITY_MAX]
 
-    if sidebar and config.site.recent_activity.defaults_only:
-        defaults = [
-            x.value for x in SiteMetadata.select().where(SiteMetadata.key == "default")
-        ]
-        post_activity = post_activity.where(SubPost.sid << defaults)
-        comment_activity = comment_activity.where(SubPost.sid << defaults)
-
-    activity = comment_activity | post_activity
-    activity = activity.alias("subquery")
-    # This abomination was created to work aroun a bug (?) where mysql won't use the index of the sub table
-    data = activity.select(
-        activity.c.type,
-        activity.c.content,
-        activity.c.user,
-        activity.c.time,
-        activity.c.pid,
-        activity.c.sid,
-        Sub.name.alias("sub"),
-    )
-    data = data.join(Sub, on=Sub.sid == activity.c.sid)
-    if sidebar and config.site.recent_activity.comments_only:
-        data = data.where(activity.c.type == "comment")
-    data = data.order_by(activity.c.time.desc())
-    data = data.limit(config.site.recent_activity.max_entries if sidebar else 50)
-    data = data.dicts().execute(db)
-
-    for rec in data:
-        if rec["type"] != "post":
-            parsed = BeautifulSoup(our_markdown(rec["content"]), features="lxml")
-            for spoiler in parsed.findAll("spoiler"):
-                spoiler.string.replace_with("█" * len(spoiler.string))
-            stripped = parsed.findAll(text=True)
-            rec["content"] = word_truncate("".join(stripped).replace("\n", " "), 350)
+    pipe = rconn.pipeline()
+    pipe.delete(key)
+    if entries:
+        pipe.rpush(key, *[_recent_activity_entry(*x[1:], x[0]) for x in entries])
+    pipe.set(key + ":built", 1)
+    pipe.execute()
 
-    return data
+
+def recent_activity(sidebar=True):
+    """Returns the latest posts and comments, newest first. They're kept in
+    Redis as they're made, so this only has to read them from there, unless
+    it's the first time (or Redis was emptied)."""
+    if not config.site.recent_activity.enabled:
+        return False
+
+    key, defaults_only, comments_only = recent_activity_list(sidebar)
+    entries = rconn.lrange(key, 0, -1)
+    if not entries and not rconn.exists(key + ":built"):
+        lock = f"{key}:lock"
+        if rconn.set(lock, 1, nx=True, ex=30):
+            try:
+                build_recent_activity(key, defaults_only, comments_only)
+            finally:
+                rconn.delete(lock)
+            entries = rconn.lrange(key, 0, -1)
+
+    data = [json.loads(entry) for entry in entries]
+    if not sidebar:
+        return data
+    return data[: config.site.recent_activity.max_entries]
 
 
 logger = LocalProxy(lambda: current_app.logger)
@@ -2969,11 +3850,5 @@ def get_user_flair(sid, uid):
         return ""
 
 
-@cache.memoize(600)
 def get_sub_flair_choices(sid):
-    choices = (
-        SubUserFlairChoice.select(SubUserFlairChoice.id, SubUserFlairChoice.flair)
-        .where(SubUserFlairChoice.sid == sid)
-        .dicts()
-    )
-    return list(choices)
+    return get_sub_bundle(sid)["flair_choices"]
@@ -2,17 +2,28 @@
 import datetime
 from enum import IntEnum
 import functools
+import os
 import sys
+import time
 from flask import g
 from flask_redis import FlaskRedis
 from peewee import IntegerField, DateTimeField, BooleanField, Proxy, Model, Database
-from peewee import CharField, ForeignKeyField, TextField, PrimaryKeyField
+from peewee import (
+    CharField,
+    ForeignKeyField,
+    TextField,
+    PrimaryKeyField,
+    DoubleField,
+    fn,
+)
 from werkzeug.local import LocalProxy
 from .storage import file_url
 from .config import config
 
 rconn = FlaskRedis()
 
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+
 dbp = Proxy()
 
 
@@ -57,6 +68,8 @@ def db_init_app(app):
 
     dbm = database_class(name, **dbconnect)
     dbm.execute = functools.partial(peewee_count_queries, dbm.execute)
+    if app.config["THROAT_CONFIG"].profiler.enabled:
+        dbm.execute_sql = functools.partial(peewee_profile_queries, dbm.execute_sql)
     dbp.initialize(dbm)
 
     @app.teardown_appcontext
@@ -77,6 +90,32 @@ def peewee_count_queries(dex, *args, **kwargs):
     return dex(*args, **kwargs)
 
 
+def query_call_site():
+    """ Returns the innermost frame of app code that isn't this module """
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(APP_ROOT) and filename != __file__:
+            return f"{filename[len(APP_ROOT) + 1:]}:{frame.f_lineno} in {frame.f_code.co_name}"
+        frame = frame.f_back
+    return "unknown"
+
+
+def peewee_profile_queries(dex, sql, *args, **kwargs):
+    """ Used to record the SQL, duration and call site of every query """
+    start = time.perf_counter()
+    try:
+        return dex(sql, *args, **kwargs)
+    finally:
+        try:
+            if "query_log" not in g:
+                g.query_log = []
+            duration = (time.perf_counter() - start) * 1000
+            g.query_log.append((sql, duration, query_call_site()))
+        except RuntimeError:
+            pass
+
+
 class BaseModel(Model):
     class Meta:
         database = db
@@ -128,6 +167,10 @@ class User(BaseModel):
         table_name = "user"
 
 
+# For the `fn.Lower(User.name) == ...` lookups
+User.add_index(User.index(fn.Lower(User.name), name="user_name_lower"))
+
+
 class Client(BaseModel):
     _default_scopes = TextField(null=True)
     _redirect_uris = TextField(null=True)
@@ -230,6 +273,10 @@ class Sub(BaseModel):
             restr.save()
 
 
+# For the `fn.Lower(Sub.name) == ...` lookups
+Sub.add_index(Sub.index(fn.Lower(Sub.name), name="sub_name_lower"))
+
+
 class SubFlair(BaseModel):
     sid = ForeignKeyField(db_column="sid", null=True, model=Sub, field="sid")
     text = CharField(null=True)
@@ -294,6 +341,8 @@ class SubPost(BaseModel):
     # 0 = normal, 1 = mod, 2 = admin
     distinguish = IntegerField(null=True)  # 1=mod, 2=admin, 0 or null = normal
     link = CharField(null=True)
+    # Normalized host name of `link`, see misc.link_domain
+    domain = CharField(null=True, max_length=255)
     nsfw = BooleanField(null=True)
     pid = PrimaryKeyField()
     posted = DateTimeField(null=True)
@@ -306,6 +355,8 @@ class SubPost(BaseModel):
     score = IntegerField(null=True)  # XXX: Deprecated
     upvotes = IntegerField(default=0)
     downvotes = IntegerField(default=0)
+    # Precomputed hot rank, see misc.hot_rank_expression
+    hot = DoubleField(default=0)
 
     sid = ForeignKeyField(db_column="sid", null=True, model=Sub, field="sid")
     thumbnail = CharField(null=True)
@@ -333,6 +384,13 @@ class SubPost(BaseModel):
 
     class Meta:
         table_name = "sub_post"
+        indexes = (
+            (("sid", "hot"), False),
+            (("domain", "pid"), False),
+            # For the keyset pagination of the "hot" and "top" listings
+            (("hot", "pid"), False),
+            (("score", "pid"), False),
+        )
 
 
 class SubPostPollOption(BaseModel):
@@ -434,6 +492,8 @@ class SubPostVote(BaseModel):
 
 class SubStylesheet(BaseModel):
     content = TextField(null=True)
+    # Hash of `content`, used in its URL. Set by misc.stylesheet_content_hash.
+    content_hash = CharField(null=True, max_length=64)
     source = TextField()
     sid = ForeignKeyField(db_column="sid", null=True, model=Sub, field="sid")
     xid = PrimaryKeyField()
@@ -870,3 +930,23 @@ class Message(BaseModel):
 
     class Meta:
         table_name = "message"
+
+
+class SearchDocument(BaseModel):
+    """ Text of a post or comment, as indexed by the search engine """
+
+    # "post" or "comment"
+    kind = CharField(max_length=8)
+    # pid or cid
+    ident = CharField(max_length=40)
+    sub = ForeignKeyField(db_column="sid", model=Sub, field="sid")
+    user = ForeignKeyField(db_column="uid", model=User, field="uid", null=True)
+    posted = DateTimeField()
+    content = TextField()
+
+    def __repr__(self):
+        return f"<SearchDocument {self.kind} {self.ident}>"
+
+    class Meta:
+        table_name = "search_document"
+        indexes = ((("kind", "ident"), True), (("kind", "posted"), False))
@@ -3,6 +3,7 @@
 from peewee import JOIN
 from flask_babel import _
 from pyfcm import FCMNotification
+from . import jobs
 from .config import config
 from .models import (
     Notification,
@@ -15,7 +16,7 @@ from .models import (
     SubPostVote,
 )
 from .socketio import socketio
-from .misc import get_notification_count
+from .misc import get_notification_count, bump_counter
 
 
 class Notifications(object):
@@ -136,6 +137,7 @@ class Notifications(object):
             post=post,
             content=content,
         )
+        bump_counter("notifications", target)
 
         notification_count = get_notification_count(target)
         socketio.emit(
@@ -243,9 +245,14 @@ class Notifications(object):
                 },
                 "notificationCount": notification_count,
             }
-            self.push_service.topic_subscribers_data_message(
-                topic_name=target, data_message=notification_data
-            )
+            jobs.enqueue(send_push_notification, target, notification_data)
 
 
 notifications = Notifications()
+
+
+@jobs.job("notifications")
+def send_push_notification(target, notification_data):
+    notifications.push_service.topic_subscribers_data_message(
+        topic_name=target, data_message=notification_data
+    )
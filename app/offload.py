@@ -0,0 +1,223 @@
+""" Runs CPU-bound work (mostly image processing) in a pool of processes,
+so it doesn't block the other greenlets of the web worker. """
+import multiprocessing
+import os
+import pickle
+import signal
+import struct
+import time
+import gevent
+import gevent.lock
+import gevent.queue
+from gevent.os import make_nonblocking, nb_read, nb_write
+from flask import current_app
+from .config import config
+from . import models
+
+STATS_KEY = "offload:stats"
+
+
+class OffloadError(Exception):
+    """ The work could not be done in the pool """
+
+    pass
+
+
+class OffloadBusy(OffloadError):
+    """ Too many jobs are already waiting for a process """
+
+    pass
+
+
+class OffloadTimeout(OffloadError):
+    """ The job took longer than `offload.timeout` """
+
+    pass
+
+
+def _read_exactly(read, fd, size):
+    data = b""
+    while len(data) < size:
+        chunk = read(fd, size - len(data))
+        if not chunk:
+            raise EOFError("pipe closed")
+        data += chunk
+    return data
+
+
+def _receive(read, fd):
+    (size,) = struct.unpack("!Q", _read_exactly(read, fd, 8))
+    return pickle.loads(_read_exactly(read, fd, size))
+
+
+def _send(write, fd, obj):
+    data = pickle.dumps(obj)
+    data = memoryview(struct.pack("!Q", len(data)) + data)
+    while data:
+        data = data[write(fd, data) :]
+
+
+def _worker_main(recv_fd, send_fd, parent_fds):
+    """ Runs jobs read from `recv_fd` until the pipe is closed """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for fd in parent_fds:
+        os.close(fd)
+    # Under gevent the pipes may have been made non-blocking, and nothing
+    # here waits for them to be ready.
+    os.set_blocking(recv_fd, True)
+    os.set_blocking(send_fd, True)
+    while True:
+        try:
+            func, args = _receive(os.read, recv_fd)
+        except EOFError:
+            return
+        try:
+            result = (True, func(*args))
+        except Exception as e:
+            result = (False, e)
+        try:
+            _send(os.write, send_fd, result)
+        except Exception as e:  # Can't pickle the result
+            _send(os.write, send_fd, (False, OffloadError(repr(e))))
+
+
+class Worker:
+    def __init__(self):
+        context = multiprocessing.get_context("fork")
+        child_recv, self.send_fd = os.pipe()
+        self.recv_fd, child_send = os.pipe()
+        self.process = context.Process(
+            target=_worker_main,
+            args=(child_recv, child_send, (self.send_fd, self.recv_fd)),
+            daemon=True,
+        )
+        try:
+            self.process.start()
+        finally:
+            os.close(child_recv)
+            os.close(child_send)
+        make_nonblocking(self.send_fd)
+        make_nonblocking(self.recv_fd)
+
+    def run(self, func, args, timeout):
+        """Sends the job and waits for its result, letting other greenlets
+        run meanwhile. Raises OffloadError if the process can't be talked
+        to and OffloadTimeout after `timeout` seconds."""
+        with gevent.Timeout(timeout, OffloadTimeout("job timed out")):
+            try:
+                _send(nb_write, self.send_fd, (func, args))
+                return _receive(nb_read, self.recv_fd)
+            except (OSError, EOFError, pickle.PickleError) as e:
+                raise OffloadError(f"worker process failed: {e!r}") from e
+
+    def kill(self):
+        for fd in (self.send_fd, self.recv_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self.process.kill()
+        self.process.join(1)
+
+
+class ProcessPool:
+    """A bounded pool of worker processes. `run` sends a job to an idle
+    process and waits for the result without blocking the gevent hub.
+    Processes are started the first time they're needed, so each web
+    worker gets its own after gunicorn forks it.
+
+    With `config.app.testing` or no workers configured, jobs run in the
+    calling greenlet instead."""
+
+    def __init__(self):
+        self.pid = None
+        self.idle = None
+        self.slots = None
+        self.pending = 0
+
+    def _setup(self):
+        # Called again in forked children, which can't use our processes.
+        self.pid = os.getpid()
+        self.idle = gevent.queue.LifoQueue()
+        self.slots = gevent.lock.BoundedSemaphore(int(config.offload.workers))
+        self.pending = 0
+
+    def run(self, func, *args):
+        """Returns `func(*args)`, run in a worker process. `func` and its
+        arguments must be picklable. Exceptions raised by `func` are
+        raised here. Raises OffloadBusy if `offload.max_queue` jobs are
+        already waiting and OffloadTimeout if the job doesn't finish in
+        `offload.timeout` seconds."""
+        if config.app.testing or not int(config.offload.workers):
+            return func(*args)
+        if self.pid != os.getpid():
+            self._setup()
+
+        name = f"{func.__module__}.{func.__name__}"
+        if self.pending >= int(config.offload.max_queue):
+            self._record(name, "rejected")
+            raise OffloadBusy("too many jobs waiting")
+
+        timeout = float(config.offload.timeout)
+        start = time.time()
+        self.pending += 1
+        try:
+            if not self.slots.acquire(timeout=timeout):
+                self._record(name, "timeouts", start)
+                raise OffloadTimeout("no worker available")
+        finally:
+            self.pending -= 1
+
+        worker = None
+        try:
+            worker = self.idle.get_nowait() if self.idle.qsize() else Worker()
+            ok, result = worker.run(func, args, timeout - (time.time() - start))
+        except Exception as e:
+            # The job timed out, the process died or it couldn't be started.
+            if worker is not None:
+                worker.kill()
+                worker = None
+            if isinstance(e, OffloadTimeout):
+                self._record(name, "timeouts", start)
+                raise
+            self._record(name, "failed", start)
+            if isinstance(e, OffloadError):
+                raise
+            raise OffloadError(f"could not run {name}: {e!r}") from e
+        finally:
+            if worker is not None:
+                self.idle.put(worker)
+            self.slots.release()
+
+        self._record(name, "completed" if ok else "failed", start)
+        if not ok:
+            raise result
+        return result
+
+    def _record(self, name, outcome, start=None):
+        try:
+            pipe = models.rconn.pipeline(transaction=False)
+            pipe.hincrby(STATS_KEY, f"{name}:{outcome}", 1)
+            if start is not None:
+                elapsed = (time.time() - start) * 1000
+                pipe.hincrbyfloat(STATS_KEY, f"{name}:time_ms", elapsed)
+            pipe.execute()
+        except Exception as e:
+            current_app.logger.warning("Could not record offload stats: %s", e)
+        if outcome in ("rejected", "timeouts"):
+            current_app.logger.warning("Offloaded job %s %s", name, outcome)
+
+
+def get_stats():
+    """Returns the number of jobs of each kind that completed, failed,
+    timed out or were rejected, and the time spent on them, added up over
+    all the web workers."""
+    stats = {}
+    for key, value in models.rconn.hgetall(STATS_KEY).items():
+        name, field = key.decode().rsplit(":", 1)
+        value = float(value) if field == "time_ms" else int(value)
+        stats.setdefault(name, {})[field] = value
+    return stats
+
+
+pool = ProcessPool()
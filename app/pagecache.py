@@ -0,0 +1,142 @@
+""" Caches the pages seen by logged out users. Enabled with `page_cache.enabled`. """
+import hashlib
+import time
+from flask import current_app, g, request, session, Response
+from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
+from .config import config
+from .misc import get_locale
+from .models import rconn
+
+PREFIX = "page:"
+# Stands for the CSRF token of each visitor in the cached pages.
+CSRF_PLACEHOLDER = "__PAGE_CACHE_CSRF_TOKEN__"
+
+
+class PageCache:
+    """Keeps the HTML of the pages listed in `page_cache.endpoints`, as
+    rendered for logged out users, in Redis. Pages are served from the
+    cache for `page_cache.ttl` seconds, and for `page_cache.stale_ttl`
+    seconds more while one request renders them again. Visitors with
+    flashed messages, and pages whose rendering changed the session, are
+    left alone."""
+
+    refresh_timeout = 30
+
+    def init_app(self, app):
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+    def cacheable(self):
+        return (
+            config.page_cache.enabled
+            and request.method in ("GET", "HEAD")
+            and request.endpoint in config.page_cache.endpoints
+            and not current_user.is_authenticated
+            and not session.get("_flashes")
+        )
+
+    def key(self):
+        locale = str(get_locale())
+        nsfw = "nsfw" in current_user.prefs
+        theme = request.cookies.get("dayNight", "")
+        ident = f"{request.full_path}\0{locale}\0{nsfw}\0{theme}"
+        return PREFIX + hashlib.sha1(ident.encode()).hexdigest()
+
+    def before_request(self):
+        g.page_cache = None
+        initial = dict(session)
+        if not self.cacheable():
+            return None
+        key = self.key()
+        g.page_cache = {
+            "key": key,
+            "session": self.session_state(),
+            "initial": initial,
+            "lock": False,
+        }
+        entry = rconn.hmget(key, "body", "digest", "fresh_until")
+        if entry[0] is None:
+            g.page_cache["status"] = "MISS"
+            return None
+        if float(entry[2]) < time.time():
+            # Stale. Only one request gets to render it again.
+            lock = rconn.set(key + ":lock", 1, nx=True, ex=self.refresh_timeout)
+            if lock:
+                g.page_cache.update(status="REFRESH", lock=True)
+                return None
+            return self.respond(entry[0], entry[1], "STALE", initial)
+        return self.respond(entry[0], entry[1], "HIT", initial)
+
+    def respond(self, body, digest, status, initial):
+        g.page_cache = None
+        token = generate_csrf()
+        response = Response(
+            body.decode().replace(CSRF_PLACEHOLDER, token), mimetype="text/html"
+        )
+        response.headers["X-Page-Cache"] = status
+        self.add_cache_headers(response, digest.decode(), initial)
+        return response.make_conditional(request)
+
+    def add_cache_headers(self, response, digest, initial):
+        """Adds the ETag and the Cache-Control and Vary headers. `initial`
+        is the session as the request came in."""
+        # Pages differ from one session to another because of the token,
+        # and with the language and the theme.
+        token = session.get("csrf_token", "")
+        response.set_etag(hashlib.sha1(f"{digest}:{token}".encode()).hexdigest())
+        response.vary.add("Cookie")
+        response.vary.add("Accept-Language")
+        # Flask-Login marks anonymous sessions as modified on every request.
+        # Don't send the cookie back if nothing in it changed, and don't
+        # let shared caches keep the responses that do send it.
+        if dict(session) == initial:
+            session.modified = False
+        if current_app.session_interface.should_set_cookie(current_app, session):
+            response.cache_control.private = True
+        else:
+            response.cache_control.public = True
+        response.cache_control.max_age = int(config.page_cache.max_age)
+
+    def session_state(self):
+        return {k: v for k, v in session.items() if k != "csrf_token"}
+
+    def after_request(self, response):
+        state = g.get("page_cache")
+        if state is None:
+            return response
+        g.page_cache = None
+        try:
+            if (
+                request.method == "GET"
+                and response.status_code == 200
+                and response.mimetype == "text/html"
+                and not response.direct_passthrough
+                and self.session_state() == state["session"]
+            ):
+                self.store(state["key"], response, state["initial"])
+                response.headers["X-Page-Cache"] = state["status"]
+        finally:
+            if state["lock"]:
+                rconn.delete(state["key"] + ":lock")
+        return response
+
+    def store(self, key, response, initial):
+        body = response.get_data(as_text=True)
+        token = g.get("csrf_token")
+        if token:
+            body = body.replace(token, CSRF_PLACEHOLDER)
+        body = body.encode()
+        digest = hashlib.sha1(body).hexdigest()
+        ttl = int(config.page_cache.ttl)
+        pipe = rconn.pipeline()
+        pipe.hset(
+            key,
+            mapping={"body": body, "digest": digest, "fresh_until": time.time() + ttl},
+        )
+        pipe.expire(key, ttl + int(config.page_cache.stale_ttl))
+        pipe.execute()
+        self.add_cache_headers(response, digest, initial)
+
+
+page_cache = PageCache()
@@ -0,0 +1,164 @@
+""" Per-request query profiler. Enabled with `profiler.enabled` in the config. """
+import hashlib
+import re
+from collections import defaultdict
+from flask import current_app
+from .config import config
+from .models import rconn
+
+PREFIX = "profiler:"
+
+_string_re = re.compile(r"'(?:[^']|'')*'")
+_number_re = re.compile(r"\b\d+(?:\.\d+)?\b")
+_in_list_re = re.compile(r"\((?:\s*(?:\?|%s)\s*,)+\s*(?:\?|%s)\s*\)")
+_space_re = re.compile(r"\s+")
+
+
+def normalize_sql(sql):
+    """Replaces the literals in `sql` with placeholders and collapses IN
+    lists, so queries that only differ in their parameters look the same."""
+    sql = _string_re.sub("?", sql)
+    sql = _number_re.sub("?", sql)
+    sql = _in_list_re.sub("(...)", sql)
+    return _space_re.sub(" ", sql).strip()
+
+
+def fingerprint(sql):
+    return hashlib.sha1(normalize_sql(sql).encode()).hexdigest()[:16]
+
+
+def summarize(log):
+    """Groups the queries of a request by fingerprint. `log` is the list
+    of (sql, duration in ms, call site) tuples collected in `g.query_log`."""
+    queries = {}
+    for sql, duration, site in log:
+        fp = fingerprint(sql)
+        if fp not in queries:
+            queries[fp] = {
+                "fingerprint": fp,
+                "sql": normalize_sql(sql),
+                "sites": defaultdict(int),
+                "calls": 0,
+                "time_ms": 0.0,
+                "slow": 0,
+            }
+        query = queries[fp]
+        query["calls"] += 1
+        query["time_ms"] += duration
+        query["sites"][site] += 1
+        if duration >= float(config.profiler.slow_query_ms):
+            query["slow"] += 1
+    return list(queries.values())
+
+
+def record_request(endpoint, log):
+    """Logs the slow and repeated queries of a request and adds them to the
+    totals kept in Redis."""
+    threshold = int(config.profiler.repeat_threshold)
+    queries = summarize(log)
+    total_ms = 0.0
+    pipe = rconn.pipeline(transaction=False)
+    for query in queries:
+        fp = query["fingerprint"]
+        site = max(query["sites"], key=query["sites"].get)
+        total_ms += query["time_ms"]
+        repeated = query["calls"] >= threshold
+        if repeated:
+            current_app.logger.warning(
+                "%s: query repeated %s times at %s: %s",
+                endpoint,
+                query["calls"],
+                site,
+                query["sql"],
+            )
+        if query["slow"]:
+            current_app.logger.warning(
+                "%s: slow query (%s ms total) at %s: %s",
+                endpoint,
+                round(query["time_ms"], 1),
+                site,
+                query["sql"],
+            )
+
+        key = f"{PREFIX}query:{fp}"
+        pipe.zincrby(f"{PREFIX}queries", query["time_ms"], fp)
+        pipe.hset(key, mapping={"sql": query["sql"], "site": site})
+        pipe.hincrby(key, "calls", query["calls"])
+        pipe.hincrby(key, "requests", 1)
+        pipe.hincrby(key, "slow", query["slow"])
+        pipe.hincrby(key, "repeated", int(repeated))
+        pipe.hincrbyfloat(key, "time_ms", query["time_ms"])
+        if repeated:
+            pipe.hset(key, "repeated_in", endpoint)
+
+    key = f"{PREFIX}endpoint:{endpoint}"
+    pipe.sadd(f"{PREFIX}endpoints", endpoint)
+    pipe.hincrby(key, "requests", 1)
+    pipe.hincrby(key, "queries", len(log))
+    pipe.hincrbyfloat(key, "time_ms", total_ms)
+    pipe.execute()
+
+
+def _decode(values):
+    return {k.decode(): v.decode() for k, v in values.items()}
+
+
+def get_report(sort="time", limit=50):
+    """Returns the totals collected by record_request. Queries are sorted by
+    total time, number of calls or number of requests in which they were
+    repeated (`sort` is "time", "calls" or "repeated")."""
+    fps = [x.decode() for x in rconn.zrevrange(f"{PREFIX}queries", 0, -1)]
+    pipe = rconn.pipeline(transaction=False)
+    for fp in fps:
+        pipe.hgetall(f"{PREFIX}query:{fp}")
+    queries = []
+    for fp, values in zip(fps, pipe.execute()):
+        values = _decode(values)
+        calls = int(values.get("calls", 0))
+        time_ms = float(values.get("time_ms", 0))
+        queries.append(
+            {
+                "fingerprint": fp,
+                "sql": values.get("sql"),
+                "site": values.get("site"),
+                "calls": calls,
+                "requests": int(values.get("requests", 0)),
+                "slow": int(values.get("slow", 0)),
+                "repeated": int(values.get("repeated", 0)),
+                "repeated_in": values.get("repeated_in"),
+                "time_ms": round(time_ms, 3),
+                "avg_ms": round(time_ms / max(calls, 1), 3),
+            }
+        )
+    sort_key = {"time": "time_ms", "calls": "calls", "repeated": "repeated"}[sort]
+    queries.sort(key=lambda x: x[sort_key], reverse=True)
+
+    endpoints = sorted(x.decode() for x in rconn.smembers(f"{PREFIX}endpoints"))
+    pipe = rconn.pipeline(transaction=False)
+    for endpoint in endpoints:
+        pipe.hgetall(f"{PREFIX}endpoint:{endpoint}")
+    endpoint_list = []
+    for endpoint, values in zip(endpoints, pipe.execute()):
+        values = _decode(values)
+        requests = int(values.get("requests", 0))
+        queries_count = int(values.get("queries", 0))
+        endpoint_list.append(
+            {
+                "endpoint": endpoint,
+                "requests": requests,
+                "queries": queries_count,
+                "queries_per_request": round(queries_count / max(requests, 1), 1),
+                "time_ms": round(float(values.get("time_ms", 0)), 3),
+            }
+        )
+    endpoint_list.sort(key=lambda x: x["queries_per_request"], reverse=True)
+    return {"queries": queries[:limit], "endpoints": endpoint_list[:limit]}
+
+
+def reset():
+    """ Deletes all the collected totals. Returns the number of keys deleted. """
+    count = 0
+    for key in rconn.scan_iter(match=f"{PREFIX}*", count=1000):
+        rconn.delete(key)
+        count += 1
+    return count
@@ -0,0 +1,425 @@
+""" Full-text search of posts and comments. """
+import bisect
+import itertools
+import math
+import re
+import time
+from datetime import datetime
+from peewee import SQL, NodeList, Table, fn
+from .models import db, rconn, SearchDocument, Sub, SubPost, SubPostComment, User
+
+_word_re = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    """ Splits `text` into the lowercase words the python backend indexes """
+    return [w for w in _word_re.findall(text.lower()) if 1 < len(w) <= 64]
+
+
+class PostgresBackend:
+    """Searches with a GIN index on `to_tsvector('simple', content)`,
+    created by the migration. Postgres keeps it up to date by itself."""
+
+    config = SQL("'simple'")
+
+    def add(self, doc):
+        pass
+
+    def remove(self, doc_id):
+        pass
+
+    def search(self, query, terms, offset, limit):
+        vector = fn.to_tsvector(self.config, SearchDocument.content)
+        tsquery = fn.plainto_tsquery(self.config, " ".join(terms))
+        return [
+            x.ident
+            for x in query.where(NodeList((vector, SQL("@@"), tsquery)))
+            .order_by(fn.ts_rank(vector, tsquery).desc(), SearchDocument.posted.desc())
+            .offset(offset)
+            .limit(limit)
+        ]
+
+
+class SqliteBackend:
+    """ Searches an FTS5 table whose rowids are SearchDocument ids """
+
+    table = Table("search_document_fts", ("rowid", "content")).alias(
+        "search_document_fts"
+    )
+
+    def __init__(self):
+        self.checked = None  # Last connection the table was created on
+
+    def _ensure_table(self):
+        # create_tables doesn't know about the FTS table, so it's created on
+        # the first use of each connection instead of on every query.
+        conn = db.connection()
+        if conn is self.checked:
+            return
+        db.execute_sql(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS search_document_fts "
+            "USING fts5(content, tokenize='unicode61')"
+        )
+        self.checked = conn
+
+    def add(self, doc):
+        self._ensure_table()
+        self.remove(doc.id)
+        db.execute_sql(
+            "INSERT INTO search_document_fts (rowid, content) VALUES (?, ?)",
+            (doc.id, doc.content),
+        )
+
+    def remove(self, doc_id):
+        self._ensure_table()
+        db.execute_sql("DELETE FROM search_document_fts WHERE rowid = ?", (doc_id,))
+
+    def search(self, query, terms, offset, limit):
+        self._ensure_table()
+        # Quote every term so the user can't write FTS5 query syntax
+        match = " ".join('"' + t.replace('"', '""') + '"' for t in terms)
+        return [
+            x.ident
+            for x in query.join(self.table, on=(SearchDocument.id == self.table.rowid))
+            .where(SQL("search_document_fts MATCH ?", [match]))
+            .order_by(SQL("bm25(search_document_fts)"), SearchDocument.posted.desc())
+            .offset(offset)
+            .limit(limit)
+        ]
+
+
+class PythonBackend:
+    """An inverted index kept in Redis, for databases without full-text
+    search. Every word has a sorted set of the ids of the documents that
+    contain it, scored by the number of times it appears. Results are
+    ranked by tf-idf and only the best `max_candidates` are filtered."""
+
+    prefix = "search:"
+    max_candidates = 1000
+
+    def add(self, doc):
+        words = {}
+        for word in tokenize(doc.content):
+            words[word] = words.get(word, 0) + 1
+        self.remove(doc.id)
+        pipe = rconn.pipeline()
+        for word, count in words.items():
+            pipe.zadd(f"{self.prefix}word:{word}", {doc.id: count})
+        if words:
+            pipe.sadd(f"{self.prefix}doc:{doc.id}", *words)
+        pipe.sadd(f"{self.prefix}docs", doc.id)
+        pipe.execute()
+
+    def remove(self, doc_id):
+        words = rconn.smembers(f"{self.prefix}doc:{doc_id}")
+        pipe = rconn.pipeline()
+        for word in words:
+            pipe.zrem(f"{self.prefix}word:{word.decode()}", doc_id)
+        pipe.delete(f"{self.prefix}doc:{doc_id}")
+        pipe.srem(f"{self.prefix}docs", doc_id)
+        pipe.execute()
+
+    def search(self, query, terms, offset, limit):
+        keys = [f"{self.prefix}word:{t}" for t in set(terms)]
+        pipe = rconn.pipeline()
+        pipe.scard(f"{self.prefix}docs")
+        for key in keys:
+            pipe.zcard(key)
+        total, *counts = pipe.execute()
+        if not keys or not all(counts):
+            return []
+        weights = {key: math.log(1 + total / count) for key, count in zip(keys, counts)}
+        dest = f"{self.prefix}result:" + ",".join(sorted(terms))
+        pipe = rconn.pipeline()
+        pipe.zinterstore(dest, weights)
+        pipe.zrevrange(dest, 0, self.max_candidates - 1)
+        pipe.delete(dest)
+        _, candidates, _ = pipe.execute()
+
+        rank = {int(x): i for i, x in enumerate(candidates)}
+        docs = query.select_extend(SearchDocument.id).where(
+            SearchDocument.id << list(rank)
+        )
+        docs = sorted(docs, key=lambda x: rank[x.id])
+        return [x.ident for x in docs[offset : offset + limit]]
+
+
+# Atomically numbers an entry and appends it to the names change feed, so
+# readers can tell when they missed entries that were trimmed from it.
+NAMES_FEED_ADD = """
+local seq = redis.call('INCR', KEYS[2])
+redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[3], '*',
+           'seq', seq, 'kind', ARGV[1], 'name', ARGV[2])
+return seq
+"""
+
+
+class NameIndex:
+    """An in-memory index of the names of all the subs or users, for the
+    autocompletion and name searches. Names are kept in a sorted list to
+    answer prefix queries with a binary search, and in a trigram index to
+    find the names that contain a string.
+
+    Every process builds its own copy from the database the first time it
+    is used, and then keeps it up to date by reading the names added since
+    from a Redis stream, at most every `search.name_index_refresh` seconds.
+    """
+
+    feed = "names:feed"
+    feed_seq = "names:seq"
+    feed_maxlen = 10000
+    max_listed = 500  # Most names put in a query by `condition`
+
+    def __init__(self, kind, model, refresh):
+        self.kind = kind
+        self.model = model
+        self.refresh = refresh
+        self.names = []  # Sorted lowercase names
+        self.canonical = {}  # Lowercase name => name
+        self.trigrams = {}  # Trigram => set of lowercase names
+        self.seq = None  # Sequence number of the last feed entry read
+        self.last_id = None  # Stream id of the last feed entry read
+        self.checked = 0
+
+    def _add(self, name):
+        lower = name.lower()
+        if lower in self.canonical:
+            return
+        self.canonical[lower] = name
+        bisect.insort(self.names, lower)
+        for i in range(len(lower) - 2):
+            self.trigrams.setdefault(lower[i : i + 3], set()).add(lower)
+
+    def build(self):
+        pipe = rconn.pipeline()  # MULTI, so both values are from the same point
+        pipe.get(self.feed_seq)
+        pipe.xrevrange(self.feed, count=1)
+        seq, last = pipe.execute()
+        self.seq = int(seq or 0)
+        self.last_id = last[0][0] if last else b"0-0"
+
+        self.names, self.canonical, self.trigrams = [], {}, {}
+        query = self.model.select(self.model.name).where(self.model.name.is_null(False))
+        for row in query.tuples():
+            self._add(row[0])
+        self.checked = time.time()
+
+    def update(self):
+        """ Applies the changes from the feed, or rebuilds the index if needed """
+        if self.seq is None:
+            return self.build()
+        if time.time() - self.checked < self.refresh:
+            return
+        self.checked = time.time()
+        while True:
+            entries = rconn.xread({self.feed: self.last_id}, count=1000)
+            if not entries:
+                return
+            for entry_id, fields in entries[0][1]:
+                seq = int(fields[b"seq"])
+                if seq != self.seq + 1:
+                    # We fell behind and lost some entries (or Redis was reset)
+                    return self.build()
+                self.seq, self.last_id = seq, entry_id
+                if fields[b"kind"].decode() == self.kind:
+                    self._add(fields[b"name"].decode())
+
+    def publish(self, name):
+        """ Adds a new name to the index of every process """
+        rconn.eval(
+            NAMES_FEED_ADD,
+            2,
+            self.feed,
+            self.feed_seq,
+            self.kind,
+            name,
+            self.feed_maxlen,
+        )
+        self.checked = 0  # Make it visible to this process right away
+
+    def complete(self, prefix, limit=10):
+        """ Returns up to `limit` names starting with `prefix`, in order """
+        self.update()
+        prefix = prefix.lower()
+        result = []
+        i = bisect.bisect_left(self.names, prefix)
+        while i < len(self.names) and len(result) < limit:
+            if not self.names[i].startswith(prefix):
+                break
+            result.append(self.canonical[self.names[i]])
+            i += 1
+        return result
+
+    def search(self, term, limit=None):
+        """ Returns up to `limit` names containing `term`, in order """
+        self.update()
+        term = term.lower()
+        if len(term) < 3:
+            candidates = self.names
+        else:
+            sets = [
+                self.trigrams.get(term[i : i + 3], set()) for i in range(len(term) - 2)
+            ]
+            candidates = sorted(set.intersection(*sorted(sets, key=len)))
+        matches = (self.canonical[x] for x in candidates if term in x)
+        return list(itertools.islice(matches, limit))
+
+    def condition(self, field, term):
+        """Returns a query condition for the rows whose `field` contains
+        `term`. It lists the matching names when there are at most
+        `max_listed`, and falls back to LIKE for short or common terms,
+        so the query never gets too many parameters."""
+        if len(term) >= 3:
+            names = self.search(term, self.max_listed + 1)
+            if len(names) <= self.max_listed:
+                return field << names
+        return fn.Lower(field).contains(term.lower())
+
+
+class SearchEngine:
+    def __init__(self, app=None):
+        self.backend = None
+        self.sub_names = None
+        self.user_names = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        cfg = app.config["THROAT_CONFIG"]
+        provider = cfg.search.provider
+        if provider == "DATABASE":
+            if "Postgres" in cfg.database.engine:
+                provider = "POSTGRES"
+            elif "Sqlite" in cfg.database.engine:
+                provider = "SQLITE"
+            else:
+                provider = "PYTHON"
+        self.backend = {
+            "POSTGRES": PostgresBackend,
+            "SQLITE": SqliteBackend,
+            "PYTHON": PythonBackend,
+        }[provider]()
+        refresh = float(cfg.search.name_index_refresh)
+        self.sub_names = NameIndex("sub", Sub, refresh)
+        self.user_names = NameIndex("user", User, refresh)
+
+    def _store(self, kind, ident, values):
+        """Creates, updates or (if `values` is None) deletes the search
+        document of a post or comment and updates the index."""
+        try:
+            doc = SearchDocument.get(
+                (SearchDocument.kind == kind) & (SearchDocument.ident == ident)
+            )
+        except SearchDocument.DoesNotExist:
+            doc = None
+
+        if values is None:
+            if doc is not None:
+                self.backend.remove(doc.id)
+                doc.delete_instance()
+            return
+
+        if doc is None:
+            doc = SearchDocument.create(kind=kind, ident=ident, **values)
+        else:
+            for key, value in values.items():
+                setattr(doc, key, value)
+            doc.save()
+        self.backend.add(doc)
+
+    def index_post(self, pid):
+        """Adds a post to the index, updates it, or removes it if it was
+        deleted. Must be called after a post is created or changed."""
+        try:
+            post = SubPost.get(SubPost.pid == pid)
+        except SubPost.DoesNotExist:
+            post = None
+        if post is None or post.deleted:
+            return self._store("post", str(pid), None)
+
+        content = post.title
+        if post.ptype != 1 and post.content:
+            content += "\n" + post.content
+        self._store(
+            "post",
+            str(pid),
+            {
+                "sub": post.sid_id,
+                "user": post.uid_id,
+                "posted": post.posted,
+                "content": content,
+            },
+        )
+
+    def index_comment(self, cid):
+        """ Same as index_post, for comments """
+        cid = str(cid)
+        comment = (
+            SubPostComment.select(SubPostComment, SubPost.sid)
+            .join(SubPost)
+            .where(SubPostComment.cid == cid)
+            .objects()
+            .first()
+        )
+        if comment is None or comment.status:
+            return self._store("comment", cid, None)
+
+        self._store(
+            "comment",
+            cid,
+            {
+                "sub": comment.sid,
+                "user": comment.uid_id,
+                "posted": comment.time,
+                "content": comment.content or "",
+            },
+        )
+
+    def search(
+        self, term, kind="post", sid=None, uid=None, since=None, until=None, page=1
+    ):
+        """Returns the pids (or cids, if `kind` is "comment") of a page of 25
+        results for `term`, the most relevant first. Can be filtered by sub,
+        user and a range of dates."""
+        terms = tokenize(term)
+        if not terms:
+            return []
+
+        query = SearchDocument.select(SearchDocument.ident).where(
+            SearchDocument.kind == kind
+        )
+        if sid is not None:
+            query = query.where(SearchDocument.sub == sid)
+        if uid is not None:
+            query = query.where(SearchDocument.user == uid)
+        if since is not None:
+            query = query.where(SearchDocument.posted >= since)
+        if until is not None:
+            query = query.where(SearchDocument.posted < until)
+        return self.backend.search(query, terms, (page - 1) * 25, 25)
+
+
+def parse_filters(args):
+    """Reads the `sub`, `user`, `since` and `until` search filters from the
+    request arguments `args`. Dates are in YYYY-MM-DD format. Returns a dict
+    of keyword arguments for SearchEngine.search, or raises ValueError."""
+    filters = {}
+    if args.get("sub"):
+        try:
+            sub = Sub.get(fn.Lower(Sub.name) == args["sub"].lower())
+        except Sub.DoesNotExist:
+            raise ValueError("Sub does not exist")
+        filters["sid"] = sub.sid
+    if args.get("user"):
+        try:
+            user = User.get(fn.Lower(User.name) == args["user"].lower())
+        except User.DoesNotExist:
+            raise ValueError("User does not exist")
+        filters["uid"] = user.uid
+    for key in ("since", "until"):
+        if args.get(key):
+            filters[key] = datetime.strptime(args[key], "%Y-%m-%d")
+    return filters
+
+
+search_engine = SearchEngine()
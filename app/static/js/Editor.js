@@ -1,6 +1,8 @@
 import u from './Util';
 import _ from './utils/I18n';
 import icon from './Icon'
+import 'autocompleter/autocomplete.css';
+import autocomplete from 'autocompleter';
 
 u.ready(function(){
   u.each('.markdown-editor', function(el,i){
@@ -61,6 +63,7 @@ function initializeEditor(element){
     el.appendChild(makeThingy('quote', _('Quote (ctrl-shift-.)'), function(e){addTags(textarea, '> ', '');}));
 
     element.insertBefore(el, element.firstChild);
+    mentionAutocomplete(textarea);
 
     window.onkeydown = function(e){
       if(e.shiftKey && e.altKey && e.which == 67){
@@ -86,6 +89,40 @@ function initializeEditor(element){
 }
 
 
+// Matches the @user or /u/user being typed before the cursor.
+const mentionRe = /(^|[^\w/])(@|\/u\/)([\w-]{2,})$/;
+
+function mentionAutocomplete(textarea){
+  autocomplete({
+    minLength: 2,
+    debounceWaitMs: 200,
+    input: textarea,
+    fetch: function(text, update) {
+      var m = textarea.value.substring(0, textarea.selectionStart).match(mentionRe);
+      if(!m){
+        return update([]);
+      }
+      u.get('/api/v3/user/search?query=' + m[3], function(data){
+        update(data.results);
+      })
+    },
+    onSelect: function(item) {
+      var sel = getCursorSelection(textarea);
+      var before = sel[0].replace(mentionRe, function(all, pre, prefix){
+        return pre + prefix + item.name + ' ';
+      });
+      textarea.value = before + sel[2];
+      setSelection(textarea, before.length, before.length);
+    },
+    render: function(item, currentValue) {
+      var div = document.createElement("div");
+      div.textContent = item.name;
+      return div;
+    }
+  });
+}
+
+
 function addTags(textarea, begin, end, bm){
   var sel = getCursorSelection(textarea);
   if(bm){
@@ -19,6 +19,7 @@ from flask_babel import _
 from flask_login import current_user
 from flask_cloudy import Storage
 from .config import config
+from .offload import OffloadError, pool
 
 
 class SizeLimitExceededError(Exception):
@@ -224,7 +225,11 @@ def store_file(ufile, basename, mtype, remove_metadata=False):
             with open(fullpath, mode="w") as tf:
                 tf.write(b)
         if remove_metadata:
-            clear_metadata(fullpath, mtype)
+            try:
+                pool.run(clear_metadata, fullpath, mtype)
+            except OffloadError:
+                # Busy, timed out or broken: the metadata must go anyway.
+                clear_metadata(fullpath, mtype)
 
         # TODO probably there are errors that need handling
         return storage.upload(
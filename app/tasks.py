@@ -9,11 +9,12 @@ import uuid
 
 from bs4 import BeautifulSoup
 from flask import current_app, jsonify
-import gevent
 from PIL import Image
 import requests
 
+from . import jobs, models, offload
 from .config import config
+from .fetch import fetcher, url_metadata
 from .misc import WHITESPACE, logger
 from .storage import store_thumbnail, thumbnail_url
 from .socketio import send_deferred_event
@@ -28,41 +29,21 @@ def create_thumbnail(fileid, store):
 def create_thumbnail_external(link, store):
     """Try to create a thumbnail for an external link.  So as not to delay
     the response in the event the external server is slow, fetch from
-    that server in a new gevent thread. Store should be a list of
+    that server in a background job. Store should be a list of
     tuples consisting of database models, primary key names and
     primary key values.  When the thumbnail is successfully created,
     update the thumbnail fields of those records in the database, and emit
     socket server messages to anyone who might be waiting for that thumbnail.
     """
-    if config.app.testing:
-        create_thumbnail_async(link, store)
-    else:
-        gevent.spawn(
-            create_thumbnail_async_appctx,
-            current_app._get_current_object(),
-            link,
-            store,
-        )
-
-
-def create_thumbnail_async_appctx(app, link, store):
-    with app.app_context():
-        create_thumbnail_async(link, store)
+    store = [[model.__name__, field, value] for model, field, value in store]
+    jobs.enqueue(create_thumbnail_async, link, store)
 
 
+@jobs.job("thumbnails")
 def create_thumbnail_async(link, store):
-    result = ""
-    typ, dat = fetch_image_data(link)
-    if dat is not None:
-        if typ == "image":
-            img = Image.open(BytesIO(dat)).convert("RGB")
-        else:  # favicon
-            im = Image.open(BytesIO(dat))
-            n_im = Image.new("RGBA", im.size, "WHITE")
-            n_im.paste(im, (0, 0), im)
-            img = n_im.convert("RGB")
-        result = thumbnail_from_img(img)
-    for model, field, value in store:
+    result = url_metadata.once(link, "thumbnail", lambda: thumbnail_from_link(link))
+    for model_name, field, value in store:
+        model = getattr(models, model_name)
         model.update(thumbnail=result).where(getattr(model, field) == value).execute()
         token = "-".join([model.__name__, str(value)])
         result_dict = {
@@ -72,11 +53,36 @@ def create_thumbnail_async(link, store):
         send_deferred_event("thumbnail", token, result_dict)
 
 
+def thumbnail_from_link(link):
+    """Fetches the image at `link` (or the one its page links to) and makes
+    a thumbnail. Returns the thumbnail's filename, or an empty string."""
+    typ, dat = fetch_image_data(link)
+    if dat is None:
+        return ""
+    try:
+        thash, im = offload.pool.run(make_thumbnail, typ, dat)
+    except offload.OffloadError as e:
+        logger.warning("Could not make a thumbnail for %s: %s", link, e)
+        return ""
+    filename = store_thumbnail(im, str(uuid.uuid5(THUMB_NAMESPACE, thash)))
+    im.close()
+    return filename
+
+
 def fetch_image_data(link):
     """ Try to fetch image data from a URL , and return it, or None. """
+    # 0 - We may already know which image the page links to
+    image = url_metadata.get(link).get("image")
+    if image:
+        try:
+            _, data = fetcher.get(image)
+            return "image", data
+        except (requests.exceptions.RequestException, ValueError):
+            pass
+
     # 1 - Check if it's an image
     try:
-        resp, data = safe_request(link)
+        resp, data = fetcher.get(link)
     except (requests.exceptions.RequestException, ValueError):
         return None, None
     ctype = resp.headers.get("content-type", "").split(";")[0].lower()
@@ -110,13 +116,14 @@ def fetch_image_data(link):
             return None, None
         try:
             img = urljoin(link, og("meta", {"property": "og:image"})[0].get("content"))
-            _, image = safe_request(img)
+            url_metadata.set(link, image=img)
+            _, image = fetcher.get(img)
             return "image", image
         except (OSError, ValueError, IndexError):
             # no image, try fetching just the favicon then
             try:
                 img = urljoin(link, og("link", {"rel": "icon"})[0].get("href"))
-                _, icon = safe_request(img)
+                _, icon = fetcher.get(img)
                 return "favicon", icon
             except (OSError, ValueError, IndexError):
                 return None, None
@@ -126,42 +133,54 @@ def fetch_image_data(link):
 THUMB_NAMESPACE = uuid.UUID("f674f09a-4dcf-4e4e-a0b2-79153e27e387")
 
 
-def thumbnail_from_img(im):
-    """Generate a thumbnail from an image in memory and write it to
-    storage.  Return the filename."""
-    thash = hashlib.blake2b(im.tobytes())
-    im = generate_thumb(im)
-    filename = store_thumbnail(im, str(uuid.uuid5(THUMB_NAMESPACE, thash.hexdigest())))
-    im.close()
-    return filename
+def make_thumbnail(typ, data):
+    """Decodes the image or favicon (see fetch_image_data) in `data` and
+    generates a thumbnail. Returns the hash of the decoded image, which
+    names the thumbnail, and the thumbnail. Runs in the offload pool."""
+    if typ == "image":
+        im = Image.open(BytesIO(data)).convert("RGB")
+    else:  # favicon
+        icon = Image.open(BytesIO(data))
+        n_im = Image.new("RGBA", icon.size, "WHITE")
+        n_im.paste(icon, (0, 0), icon)
+        im = n_im.convert("RGB")
+    thash = hashlib.blake2b(im.tobytes()).hexdigest()
+    return thash, generate_thumb(im)
 
 
 def generate_thumb(im: Image) -> Image:
-    x, y = im.size
-    while y > x:
-        slice_height = min(y - x, 10)
-        bottom = im.crop((0, y - slice_height, x, y))
-        top = im.crop((0, 0, x, slice_height))
-
-        if _image_entropy(bottom) < _image_entropy(top):
-            im = im.crop((0, 0, x, y - slice_height))
+    """Crops a tall image to a square by cutting 10 pixel slices from the
+    top or the bottom, whichever has less entropy, and scales it down."""
+    width, height = im.size
+    top, bottom = 0, height
+    entropies = {}
+
+    def entropy(start, end):
+        # Each slice is measured once, cut from the original image, so the
+        # whole image isn't copied on every step.
+        if (start, end) not in entropies:
+            entropies[(start, end)] = _image_entropy(im.crop((0, start, width, end)))
+        return entropies[(start, end)]
+
+    while bottom - top > width:
+        slice_height = min(bottom - top - width, 10)
+        if entropy(bottom - slice_height, bottom) < entropy(top, top + slice_height):
+            bottom -= slice_height
         else:
-            im = im.crop((0, slice_height, x, y))
-
-        x, y = im.size
-        gevent.sleep(0)
+            top += slice_height
 
+    if bottom - top != height:
+        im = im.crop((0, top, width, bottom))
     im.thumbnail((70, 70), Image.ANTIALIAS)
     return im
 
 
 def _image_entropy(img):
     """calculate the entropy of an image"""
-    hist = img.histogram()
+    hist = [h for h in img.histogram() if h]
     hist_size = sum(hist)
-    hist = [float(h) / hist_size for h in hist]
-
-    return -sum(p * math.log(p, 2) for p in hist if p != 0)
+    # Same as -sum(p * log2(p)) with p = h / hist_size, with fewer divisions.
+    return math.log2(hist_size) - sum(h * math.log2(h) for h in hist) / hist_size
 
 
 def grab_title(url):
@@ -172,40 +191,43 @@ def grab_title(url):
         return jsonify(grab_title_async(current_app, url))
     else:
         token = "title-" + str(uuid.uuid4())
-        gevent.spawn(
-            send_title_grab_async, current_app._get_current_object(), url, token
-        )
+        jobs.enqueue(send_title_grab_async, url, token)
         return jsonify(status="deferred", token=token)
 
 
-def send_title_grab_async(app, url, token):
+def fetch_title(url):
+    """ Fetches the page at `url` and returns its title """
+    resp, data = fetcher.get(
+        url, max_size=500000, mimetypes={"text/html"}, partial_read=True
+    )
+
+    # Truncate the HTML so less parsing work will be required.
+    end_title_pos = data.find(b"</title>")
+    if end_title_pos == -1:
+        raise ValueError
+    data = data[:end_title_pos] + b"</title></head><body></body>"
+
+    _, options = cgi.parse_header(resp.headers.get("Content-Type", ""))
+    charset = options.get("charset", "utf-8")
+    og = BeautifulSoup(data, "lxml", from_encoding=charset)
+    title = og("title")[0].text
+    title = title.strip(WHITESPACE)
+    return re.sub(" - YouTube$", "", title)
+
+
+@jobs.job("default", retries=0)
+def send_title_grab_async(url, token):
     """Grab the title from the url and send it to whoever might be waiting
     via socketio."""
-    result = grab_title_async(app, url)
+    result = grab_title_async(current_app, url)
     result.update(target=token)
-    with app.app_context():
-        send_deferred_event("grab_title", token, result)
+    send_deferred_event("grab_title", token, result)
 
 
 def grab_title_async(app, url):
     with app.app_context():
         try:
-            resp, data = safe_request(
-                url, max_size=500000, mimetypes={"text/html"}, partial_read=True
-            )
-
-            # Truncate the HTML so less parsing work will be required.
-            end_title_pos = data.find(b"</title>")
-            if end_title_pos == -1:
-                raise ValueError
-            data = data[:end_title_pos] + b"</title></head><body></body>"
-
-            _, options = cgi.parse_header(resp.headers.get("Content-Type", ""))
-            charset = options.get("charset", "utf-8")
-            og = BeautifulSoup(data, "lxml", from_encoding=charset)
-            title = og("title")[0].text
-            title = title.strip(WHITESPACE)
-            title = re.sub(" - YouTube$", "", title)
+            title = url_metadata.once(url, "title", lambda: fetch_title(url))
             return {"status": "ok", "title": title}
         except (
             requests.exceptions.RequestException,
@@ -215,48 +237,3 @@ def grab_title_async(app, url):
             KeyError,
         ):
             return {"status": "error"}
-
-
-def safe_request(
-    url, receive_timeout=10, max_size=25000000, mimetypes=None, partial_read=False
-):
-    """Gets stuff from the internet, with timeouts, content type and size
-    restrictions.  If partial_read is True it will return approximately
-    the first max_size bytes, otherwise it will raise an error if
-    max_size is exceeded."""
-    # Returns (Response, File)
-    try:
-        r = requests.get(
-            url,
-            stream=True,
-            timeout=receive_timeout,
-            headers={"User-Agent": "Throat/1 (Phuks)"},
-        )
-    except:  # noqa
-        raise ValueError("error fetching")
-    r.raise_for_status()
-
-    if int(r.headers.get("Content-Length", 1)) > max_size and not partial_read:
-        raise ValueError("response too large")
-
-    if mimetypes is not None:
-        mtype, _ = cgi.parse_header(r.headers.get("Content-Type", ""))
-        if mtype not in mimetypes:
-            raise ValueError("wrong content type")
-
-    size = 0
-    start = time.time()
-    f = b""
-    for chunk in r.iter_content(1024):
-        if time.time() - start > receive_timeout:
-            raise ValueError("timeout reached")
-        gevent.sleep(0)  # Otherwise this loop can block other greenlets for > 0.5s
-
-        size += len(chunk)
-        f += chunk
-        if size > max_size:
-            if partial_read:
-                return r, f
-            else:
-                raise ValueError("response too large")
-    return r, f
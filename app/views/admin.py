@@ -17,10 +17,11 @@ from flask import (
     render_template,
     request,
     send_file,
+    jsonify,
 )
 from flask_login import login_required, current_user
 from flask_babel import _
-from .. import misc
+from .. import fragments, jobs, misc, offload, profiler
 from ..config import config
 from ..forms import (
     TOTPForm,
@@ -51,6 +52,7 @@ from ..models import (
 from ..models import UserUploads, InviteCode, Wiki
 from ..misc import engine, getReports
 from ..badges import badges
+from ..search import search_engine
 
 bp = Blueprint("admin", __name__)
 
@@ -541,7 +543,8 @@ def users_search(term):
     )
     users = users.join(postcount, JOIN.LEFT_OUTER, on=User.uid == postcount.c.uid)
     users = users.join(commcount, JOIN.LEFT_OUTER, on=User.uid == commcount.c.uid)
-    users = users.where(User.name.contains(term)).order_by(User.joindate.desc()).dicts()
+    users = users.where(search_engine.user_names.condition(User.name, term))
+    users = users.order_by(User.joindate.desc()).dicts()
 
     return render_template(
         "admin/users.html", users=users, term=term, admin_route="admin.users_search"
@@ -572,7 +575,7 @@ def subs_search(term):
     if not current_user.is_admin():
         abort(404)
     term = re.sub(r"[^A-Za-z0-9.\-_]+", "", term)
-    subs = Sub.select().where(Sub.name.contains(term))
+    subs = Sub.select().where(search_engine.sub_names.condition(Sub.name, term))
     return render_template(
         "admin/subs.html",
         subs=subs,
@@ -793,6 +796,49 @@ def reports(page):
     )
 
 
+@bp.route("/queries")
+@login_required
+def queries():
+    """ Totals collected by the query profiler, as JSON """
+    if not current_user.is_admin():
+        abort(404)
+    if not config.profiler.enabled:
+        abort(404)
+
+    sort = request.args.get("sort", "time")
+    if sort not in ("time", "calls", "repeated"):
+        abort(400)
+    limit = request.args.get("limit", 50, type=int)
+    return jsonify(profiler.get_report(sort, limit))
+
+
+@bp.route("/offload")
+@login_required
+def offload_stats():
+    """ Jobs run by the offload process pools, as JSON """
+    if not current_user.is_admin():
+        abort(404)
+    return jsonify(offload.get_stats())
+
+
+@bp.route("/jobs")
+@login_required
+def job_stats():
+    """ Depth and totals of the background job queues, as JSON """
+    if not current_user.is_admin():
+        abort(404)
+    return jsonify(jobs.get_stats())
+
+
+@bp.route("/fragments")
+@login_required
+def fragment_stats():
+    """ Hits and misses of the template fragments kept in memory, as JSON """
+    if not current_user.is_admin():
+        abort(404)
+    return jsonify(fragments.get_stats())
+
+
 @bp.route("/wiki", defaults={"page": 1})
 @bp.route("/wiki/<int:page>")
 @login_required
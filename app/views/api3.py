@@ -2,7 +2,6 @@
 
 import datetime
 import uuid
-from bs4 import BeautifulSoup
 from email_validator import EmailNotValidError
 from flask import Blueprint, jsonify, request, url_for
 from peewee import JOIN, fn
@@ -24,6 +23,7 @@ from ..auth import (
     normalize_email,
 )
 from ..socketio import socketio
+from ..search import search_engine, parse_filters
 from ..misc import ratelimit, POSTING_LIMIT, AUTH_LIMIT, captchas_required
 from ..models import (
     Sub,
@@ -234,13 +234,15 @@ def fresh_login():
 @jwt_optional
 def get_post_list(target):
     """Same as v2, but `content` is returned as parsed markdown and the `sort` can be `default`
-    when `target` is a sub"""
+    when `target` is a sub. Pass the returned `cursor` as `cursor` to get the next page, `page`
+    still works but gets slower the further you go."""
 
     if target not in ("all", "home"):
         sort = request.args.get("sort", default="default")
     else:
         sort = request.args.get("sort", default="new")
     page = request.args.get("page", default=1, type=int)
+    cursor = request.args.get("cursor")
 
     if sort not in ("hot", "top", "new", "default"):
         return jsonify(msg="Invalid sort"), 400
@@ -255,6 +257,7 @@ def get_post_list(target):
         SubPost.title,
         SubPost.posted,
         SubPost.score,
+        SubPost.hot,
         SubPost.thumbnail,
         SubPost.link,
         User.name.alias("user"),
@@ -327,10 +330,13 @@ def get_post_list(target):
                 sort = "top"
         base_query = base_query.where(Sub.sid == sub.sid)
 
+    if cursor and misc.parse_post_cursor(cursor, sort) is None:
+        return jsonify(msg="Invalid cursor"), 400
+
     base_query = base_query.where(SubPost.deleted == 0)
-    posts = misc.getPostList(base_query, sort, page).dicts()
+    posts = list(misc.getPostList(base_query, sort, page, cursor).dicts())
 
-    cnt = base_query.count() - page * 25
+    cursor = misc.next_post_cursor(posts, sort)
     postList = []
     for post in posts:
         if post["userstatus"] == 10:  # account deleted
@@ -340,12 +346,15 @@ def get_post_list(target):
         ) > datetime.timedelta(days=config.site.archive_post_after)
         del post["userstatus"]
         del post["uid"]
+        del post["hot"]
         post["content"] = (
             misc.our_markdown(post["content"]) if post["ptype"] != 1 else ""
         )
         postList.append(post)
 
-    return jsonify(posts=postList, sort=sort, continues=True if cnt > 0 else False)
+    return jsonify(
+        posts=postList, sort=sort, continues=cursor is not None, cursor=cursor
+    )
 
 
 @API.route("/post/<sub>/<int:pid>", methods=["GET"])
@@ -467,6 +476,7 @@ def edit_post(sub, pid):
     if (datetime.datetime.utcnow() - post.posted.replace(tzinfo=None)).seconds > 300:
         post.edited = datetime.datetime.utcnow()
     post.save()
+    search_engine.index_post(post.pid)
     return get_post(sub, pid)
 
 
@@ -504,6 +514,7 @@ def delete_post(sub, pid):
             sender=uid,
             target=post.uid,
         )
+        misc.bump_counter("notifications", post.uid_id)
 
         misc.create_sublog(
             misc.LOG_TYPE_SUB_DELETE_POST,
@@ -530,6 +541,9 @@ def delete_post(sub, pid):
     except SiteMetadata.DoesNotExist:
         pass
     post.save()
+    misc.update_home_feeds(post.pid)
+    search_engine.index_post(post.pid)
+    misc.change_recent_activity("post", post.pid)
     Sub.update(posts=Sub.posts - 1).where(Sub.sid == post.sid).execute()
     return jsonify(), 200
 
@@ -667,6 +681,7 @@ def create_comment(sub, pid):
     SubPost.update(comments=SubPost.comments + 1).where(
         SubPost.pid == post.pid
     ).execute()
+    search_engine.index_comment(comment.cid)
 
     socketio.emit(
         "threadcomments",
@@ -678,15 +693,11 @@ def create_comment(sub, pid):
     defaults = [
         x.value for x in SiteMetadata.select().where(SiteMetadata.key == "default")
     ]
-    comment_res = misc.word_truncate(
-        "".join(
-            BeautifulSoup(misc.our_markdown(comment.content), features="lxml").findAll(
-                text=True
-            )
-        ).replace("\n", " "),
-        250,
-    )
+    comment_res = misc.comment_summary(comment.content)
     sub = Sub.get(Sub.name == sub)
+    misc.add_recent_activity(
+        "comment", comment.cid, comment_res, user.name, post.pid, sub, comment.time
+    )
     socketio.emit(
         "comment",
         {
@@ -798,6 +809,8 @@ def edit_comment(_sub, pid, cid):
     comment.content = content
     comment.lastedit = datetime.datetime.utcnow()
     comment.save()
+    search_engine.index_comment(comment.cid)
+    misc.change_recent_activity("comment", comment.cid, misc.comment_summary(content))
     # TODO: move this block to a function
     comm = (
         SubPostComment.select(
@@ -857,6 +870,8 @@ def delete_comment(_sub, pid, cid):
 
     comment.status = 1
     comment.save()
+    search_engine.index_comment(comment.cid)
+    misc.change_recent_activity("comment", comment.cid)
 
     q = Message.delete().where(Message.mlink == cid)
     q.execute()
@@ -1086,6 +1101,7 @@ def create_post():
         title=title.strip(misc.WHITESPACE),
         content=content,
         link=link if ptype == "link" else None,
+        domain=misc.link_domain(link) if ptype == "link" else None,
         posted=datetime.datetime.utcnow(),
         score=1,
         upvotes=1,
@@ -1096,10 +1112,18 @@ def create_post():
         nsfw=nsfw if not subdata.get("nsfw") == "1" else 1,
         thumbnail="deferred" if ptype == "link" else "",
     )
+    misc.update_hot_rank(post.pid, added=True)
+    search_engine.index_post(post.pid)
+    if post.content:
+        # Warm up the markdown cache
+        misc.our_markdown(post.content)
     if ptype == "link":
         tasks.create_thumbnail_external(link, [(SubPost, "pid", post.pid)])
 
     Sub.update(posts=Sub.posts + 1).where(Sub.sid == sub.sid).execute()
+    misc.add_recent_activity(
+        "post", post.pid, post.title, user.name, post.pid, sub, post.posted
+    )
     addr = url_for("sub.view_post", sub=sub.name, pid=post.pid)
     posts = misc.getPostList(
         misc.postListQueryBase(nofilter=True).where(SubPost.pid == post.pid), "new", 1
@@ -1147,6 +1171,76 @@ def create_post():
     return jsonify(status="ok", pid=post.pid, sub=sub.name)
 
 
+@API.route("/search", methods=["GET"])
+def search():
+    """Full-text search of posts (or comments, if `type` is "comment"),
+    the most relevant first. Results can be filtered with `sub`, `user`,
+    `since` and `until` (dates as YYYY-MM-DD)."""
+    term = request.args.get("q", "")
+    kind = request.args.get("type", "post")
+    page = request.args.get("page", default=1, type=int)
+    if kind not in ("post", "comment"):
+        return jsonify(msg="Invalid type"), 400
+    if page < 1:
+        return jsonify(msg="Invalid page number"), 400
+    try:
+        filters = parse_filters(request.args)
+    except ValueError as e:
+        return jsonify(msg=str(e)), 400
+
+    idents = search_engine.search(term, kind, page=page, **filters)
+    if kind == "post":
+        rank = {int(pid): i for i, pid in enumerate(idents)}
+        results = (
+            SubPost.select(
+                SubPost.pid,
+                SubPost.title,
+                SubPost.posted,
+                SubPost.score,
+                SubPost.comments,
+                SubPost.nsfw,
+                Sub.name.alias("sub"),
+                User.name.alias("user"),
+                User.status.alias("userstatus"),
+            )
+            .join(User, JOIN.LEFT_OUTER)
+            .switch(SubPost)
+            .join(Sub)
+            .where(SubPost.pid << list(rank))
+            .dicts()
+        )
+        results = sorted(results, key=lambda x: rank[x["pid"]])
+    else:
+        rank = {cid: i for i, cid in enumerate(idents)}
+        results = (
+            SubPostComment.select(
+                SubPostComment.cid,
+                SubPostComment.pid,
+                SubPostComment.content,
+                SubPostComment.time,
+                SubPostComment.score,
+                Sub.name.alias("sub"),
+                User.name.alias("user"),
+                User.status.alias("userstatus"),
+            )
+            .join(User, JOIN.LEFT_OUTER)
+            .switch(SubPostComment)
+            .join(SubPost)
+            .join(Sub)
+            .where(SubPostComment.cid << list(rank))
+            .dicts()
+        )
+        results = sorted(results, key=lambda x: rank[x["cid"]])
+        for result in results:
+            result["content"] = misc.our_markdown(result["content"])
+
+    for result in results:
+        if result["userstatus"] == 10:  # account deleted
+            result["user"] = "[Deleted]"
+        del result["userstatus"]
+    return jsonify(results=results, continues=len(idents) == 25)
+
+
 @API.route("/sub", methods=["GET"])
 def search_sub():
     """Search for subs matching the query parameter.  Return, for each sub
@@ -1155,10 +1249,30 @@ def search_sub():
     if len(query) < 3 or not misc.allowedNames.match(query):
         return jsonify(results=[])
 
-    query = "%" + query + "%"
-    subs = Sub.select(Sub.name).where(Sub.name ** query).limit(10).dicts()
+    names = search_engine.sub_names.complete(query, 10)
+    if len(names) < 10:
+        matches = search_engine.sub_names.search(query, 20)
+        names += [x for x in matches if x not in names]
+    return jsonify(results=[{"name": x} for x in names[:10]])
 
-    return jsonify(results=list(subs))
+
+@API.route("/user/search", methods=["GET"])
+def search_user():
+    """Autocomplete for user mentions. Return the names of up to 10 active
+    users whose name starts with the query parameter."""
+    query = request.args.get("query", "")
+    if len(query) < 2 or not misc.allowedNames.match(query):
+        return jsonify(results=[])
+
+    names = search_engine.user_names.complete(query, 20)
+    users = (
+        User.select(User.name)
+        .where((User.name << names) & (User.status == 0))
+        .order_by(fn.Lower(User.name))
+        .limit(10)
+        .dicts()
+    )
+    return jsonify(results=list(users))
 
 
 @API.route("/sub/<name>", methods=["GET"])
@@ -1303,6 +1417,7 @@ def get_notifications():
         Notification.update(read=datetime.datetime.utcnow()).where(
             (Notification.read.is_null(True)) & (Notification.target == uid)
         ).execute()
+        misc.reset_counter("notifications", uid)
     return jsonify(notifications=notification_list)
 
 
@@ -1325,6 +1440,8 @@ def delete_notification():
         return jsonify(error="Notification does not exist"), 404
 
     notification.delete_instance()
+    if notification.read is None:
+        misc.bump_counter("notifications", uid, -1)
     return jsonify(status="ok")
 
 
@@ -1452,8 +1569,11 @@ def delete_message():
     except Notification.DoesNotExist:
         return jsonify(error="Message does not exist"), 404
 
+    unread = message.read is None and message.mtype == 1
     message.mtype = 6
     message.save()
+    if unread:
+        misc.bump_counter("messages", uid, -1)
     return jsonify(status="ok")
 
 
@@ -1540,8 +1660,11 @@ def read_message(mid):
     except Message.DoesNotExist:
         return jsonify(error="Message not found"), 404
 
-    message.read = datetime.datetime.utcnow()
-    message.save()
+    if message.read is None:
+        message.read = datetime.datetime.utcnow()
+        message.save()
+        if message.mtype == 1:
+            misc.bump_counter("messages", uid, -1)
 
     socketio.emit(
         "notification",
@@ -1608,6 +1731,7 @@ def set_settings():
         )
 
     [x.execute() for x in qrys]
+    misc.invalidate_user_snapshot(uid)
     return jsonify()
 
 
@@ -279,6 +279,7 @@ def login_with_token(token):
         user.status = UserStatus.OK
         user.save()
         auth_provider.set_email_verified(user)
+        misc.invalidate_user_snapshot(user.uid)
         theuser = misc.load_user(user.uid)
         login_user(theuser)
         session["remember_me"] = False
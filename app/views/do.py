@@ -6,17 +6,16 @@ import time
 import datetime
 import uuid
 import random
-from collections import defaultdict
 from flask import Blueprint, redirect, url_for, session, abort, jsonify, current_app
 from flask import request
 from flask_login import login_user, login_required, logout_user, current_user
 from flask_babel import _
 from itsdangerous import URLSafeTimedSerializer
 from itsdangerous.exc import SignatureExpired, BadSignature
-from bs4 import BeautifulSoup
 from ..config import config
-from .. import forms, misc, storage, tasks
+from .. import forms, jobs, misc, storage, tasks
 from ..socketio import socketio
+from ..search import search_engine
 from ..auth import (
     auth_provider,
     email_validation_is_required,
@@ -76,8 +75,6 @@ from ..models import (
     SubPostReport,
 )
 from ..models import (
-    SubPostVote,
-    SubPostCommentVote,
     SubFlair,
     SubPostPollOption,
     SubPostPollVote,
@@ -202,6 +199,7 @@ def edit_account():
                 if not email_validation_is_required():
                     user.email = email
                     user.save()
+                    misc.invalidate_user_snapshot(user.uid)
                 else:
                     auth_provider.set_pending_email(user, email)
                     send_email_confirmation_link_email(user, email)
@@ -332,6 +330,7 @@ def delete_post():
                 sender=current_user.uid,
                 target=post.uid,
             )
+            misc.bump_counter("notifications", post.uid_id)
 
             misc.create_sublog(
                 misc.LOG_TYPE_SUB_DELETE_POST,
@@ -385,6 +384,7 @@ def delete_post():
                 & (SubMetadata.value == post.pid)
             )
             is_sticky.delete_instance()
+            misc.invalidate_sub_bundle(post.sid_id)
             misc.create_sublog(
                 misc.LOG_TYPE_SUB_STICKY_DEL,
                 current_user.uid,
@@ -398,6 +398,9 @@ def delete_post():
 
         post.deleted = deletion
         post.save()
+        misc.update_home_feeds(post.pid)
+        search_engine.index_post(post.pid)
+        misc.change_recent_activity("post", post.pid)
 
         return jsonify(status="ok")
     return jsonify(status="ok", error=get_errors(form))
@@ -438,6 +441,7 @@ def undelete_post():
             sender=current_user.uid,
             target=post.uid,
         )
+        misc.bump_counter("notifications", post.uid_id)
 
         misc.create_sublog(
             misc.LOG_TYPE_SUB_UNDELETE_POST,
@@ -464,6 +468,9 @@ def undelete_post():
 
         post.deleted = deletion
         post.save()
+        misc.update_home_feeds(post.pid, added=True)
+        misc.reset_recent_activity()
+        search_engine.index_post(post.pid)
 
         return jsonify(status="ok")
     return jsonify(status="ok", error=get_errors(form))
@@ -492,8 +499,10 @@ def edit_sub_css(sub):
             )
 
         styles.content = dcss[1]
+        styles.content_hash = misc.stylesheet_content_hash(dcss[1])
         styles.source = form.css.data
         styles.save()
+        misc.invalidate_sub_bundle(sub.sid)
         misc.create_sublog(misc.LOG_TYPE_SUB_CSS_CHANGE, current_user.uid, sub.sid)
 
         return json.dumps(
@@ -545,6 +554,7 @@ def edit_sub(sub):
 
             if form.subsort.data != "None":
                 sub.update_metadata("sort", form.subsort.data)
+            misc.invalidate_sub_bundle(sub.sid)
 
             misc.create_sublog(misc.LOG_TYPE_SUB_SETTINGS, current_user.uid, sub.sid)
 
@@ -800,6 +810,8 @@ def edit_mod():
             sm.save()
         except SubMod.DoesNotExist:
             SubMod.create(sid=sub.sid, uid=user.uid, power_level=0)
+        misc.invalidate_user_snapshot(user.uid)
+        misc.invalidate_sub_bundle(sub.sid)
 
         misc.create_sublog(
             misc.LOG_TYPE_SUB_TRANSFER,
@@ -834,6 +846,7 @@ def assign_userbadge():
 
     if form.validate():
         badges.assign_userbadge(user.uid, bid)
+        misc.invalidate_user_snapshot(user.uid)
         # TODO log it, create new log type and save to sitelog ??
         return jsonify(status="ok")
     return jsonify(status="error", error=get_errors(form))
@@ -860,6 +873,7 @@ def remove_userbadge():
 
     if form.validate():
         badges.unassign_userbadge(user.uid, bid)
+        misc.invalidate_user_snapshot(user.uid)
         # TODO log it, create new log type and save to sitelog ??
         return jsonify(status="ok")
     return jsonify(status="error", error=get_errors(form))
@@ -891,6 +905,7 @@ def subscribe_to_sub(sid):
             time=datetime.datetime.utcnow(), uid=current_user.uid, sid=sid, status=1
         )
         Sub.update(subscribers=Sub.subscribers + 1).where(Sub.sid == sid).execute()
+        misc.invalidate_user_snapshot(current_user.uid)
         return jsonify(status="ok")
     return jsonify(status="error", error=get_errors(form))
 
@@ -917,6 +932,7 @@ def unsubscribe_from_sub(sid):
         ss.delete_instance()
 
         Sub.update(subscribers=Sub.subscribers - 1).where(Sub.sid == sid).execute()
+        misc.invalidate_user_snapshot(current_user.uid)
         return jsonify(status="ok")
     return jsonify(status="error", error=get_errors(form))
 
@@ -947,6 +963,7 @@ def block_sub(sid):
         SubSubscriber.create(
             time=datetime.datetime.utcnow(), uid=current_user.uid, sid=sid, status=2
         )
+        misc.invalidate_user_snapshot(current_user.uid)
         return jsonify(status="ok")
     return jsonify(status="error", error=get_errors(form))
 
@@ -971,6 +988,7 @@ def unblock_sub(sid):
             & (SubSubscriber.status == 2)
         )
         ss.delete_instance()
+        misc.invalidate_user_snapshot(current_user.uid)
         return jsonify(status="ok")
     return jsonify(status="error", error=get_errors(form))
 
@@ -1164,6 +1182,8 @@ def edit_txtpost(pid):
         ).seconds > 300:
             post.edited = datetime.datetime.utcnow()
         post.save()
+        misc.our_markdown(post.content)
+        search_engine.index_post(post.pid)
         return jsonify(status="ok")
     return json.dumps({"status": "error", "error": get_errors(form)})
 
@@ -1253,6 +1273,7 @@ def create_comment(pid):
         SubPost.update(comments=SubPost.comments + 1).where(
             SubPost.pid == post.pid
         ).execute()
+        search_engine.index_comment(comment.cid)
 
         socketio.emit(
             "threadcomments",
@@ -1260,10 +1281,16 @@ def create_comment(pid):
             namespace="/snt",
             room=post.pid,
         )
-        comment_text = BeautifulSoup(
-            misc.our_markdown(comment.content.decode()), features="lxml"
-        ).findAll(text=True)
-        comment_res = misc.word_truncate("".join(comment_text).replace("\n", " "), 250)
+        comment_res = misc.comment_summary(comment.content.decode())
+        misc.add_recent_activity(
+            "comment",
+            comment.cid,
+            comment_res,
+            current_user.name,
+            post.pid,
+            sub,
+            comment.time,
+        )
         defaults = [
             x.value for x in SiteMetadata.select().where(SiteMetadata.key == "default")
         ]
@@ -1432,6 +1459,7 @@ def ban_user_sub(sub):
             content="Reason: " + form.reason.data,
             target=user.uid,
         )
+        misc.bump_counter("notifications", user.uid)
         socketio.emit(
             "notification",
             {"count": misc.get_notification_count(user.uid)},
@@ -1579,6 +1607,8 @@ def inv_mod(sub):
             SubMod.create(
                 sid=sub.sid, user=user.uid, power_level=power_level, invite=True
             )
+            misc.invalidate_user_snapshot(user.uid)
+            misc.invalidate_sub_bundle(sub.sid)
 
             misc.create_sublog(
                 misc.LOG_TYPE_SUB_MOD_INVITE,
@@ -1639,6 +1669,7 @@ def remove_sub_ban(sub, user):
             Notification.create(
                 type="SUB_UNBAN", sub=sub.sid, sender=current_user.uid, target=user.uid
             )
+            misc.bump_counter("notifications", user.uid)
             socketio.emit(
                 "notification",
                 {"count": misc.get_notification_count(user.uid)},
@@ -1727,7 +1758,9 @@ def remove_mod2(sub, user):
                 return jsonify(status="error", error=[_("User is not mod")])
 
             mod.delete_instance()
+            misc.invalidate_user_snapshot(user.uid)
             SubMetadata.create(sid=sub.sid, key="xmod2", value=user.uid)
+            misc.invalidate_sub_bundle(sub.sid)
 
             misc.create_sublog(
                 misc.LOG_TYPE_SUB_MOD_REMOVE,
@@ -1771,6 +1804,8 @@ def revoke_mod2inv(sub, user):
                     error=[_("User has not been invited to moderate the sub")],
                 )
             x.delete_instance()
+            misc.invalidate_user_snapshot(user.uid)
+            misc.invalidate_sub_bundle(sub.sid)
 
             misc.create_sublog(
                 misc.LOG_TYPE_SUB_MOD_INV_CANCEL,
@@ -1828,6 +1863,7 @@ def accept_modinv(sub, user):
             & (SubMetadata.key == "xmod2")
             & (SubMetadata.value == user.uid)
         ).execute()
+        misc.invalidate_sub_bundle(sub.sid)
 
         misc.create_sublog(
             misc.LOG_TYPE_SUB_MOD_ACCEPT, current_user.uid, sub.sid, target=user.uid
@@ -1838,6 +1874,7 @@ def accept_modinv(sub, user):
             Sub.update(subscribers=Sub.subscribers + 1).where(
                 Sub.sid == sub.sid
             ).execute()
+        misc.invalidate_user_snapshot(user.uid, current_user.uid)
         return jsonify(status="ok")
     return json.dumps({"status": "error", "error": get_errors(form)})
 
@@ -1865,6 +1902,8 @@ def refuse_mod2inv(sub):
             )
 
         modi.delete_instance()
+        misc.invalidate_user_snapshot(current_user.uid)
+        misc.invalidate_sub_bundle(sub.sid)
         misc.create_sublog(
             misc.LOG_TYPE_SUB_MOD_INV_REJECT,
             current_user.uid,
@@ -1889,6 +1928,8 @@ def read_pm(mid):
             return jsonify(status="ok")
         message.read = datetime.datetime.utcnow()
         message.save()
+        if message.mtype == 1:
+            misc.bump_counter("messages", current_user.uid, -1)
         socketio.emit(
             "notification",
             {"count": misc.get_notification_count(current_user.uid)},
@@ -1911,9 +1952,10 @@ def readall_msgs(boxid):
         .where(Message.receivedby == current_user.uid)
     )
     q.where(Message.mtype == boxid).execute()
+    misc.reset_counter("messages", current_user.uid)
     socketio.emit(
         "notification",
-        {"count": misc.get_notif_count(current_user.uid)},
+        {"count": misc.get_notification_count(current_user.uid)},
         namespace="/snt",
         room="user" + current_user.uid,
     )
@@ -1929,8 +1971,11 @@ def delete_pm(mid):
         if message.receivedby_id != current_user.uid:
             return jsonify(status="error", error=_("Message does not exist"))
 
+        unread = message.read is None and message.mtype == 1
         message.mtype = 6
         message.save()
+        if unread:
+            misc.bump_counter("messages", current_user.uid, -1)
         return jsonify(status="ok")
     except Message.DoesNotExist:
         return jsonify(status="error", error=_("Message does not exist"))
@@ -1969,6 +2014,8 @@ def edit_title():
 
         post.title = form.reason.data
         post.save()
+        search_engine.index_post(post.pid)
+        misc.change_recent_activity("post", post.pid, post.title)
         socketio.emit(
             "threadtitle",
             {"pid": post.pid, "title": form.reason.data},
@@ -1989,8 +2036,11 @@ def save_pm(mid):
         if message.receivedby_id != current_user.uid:
             return jsonify(status="error", error=_("Message does not exist"))
 
+        unread = message.read is None and message.mtype == 1
         message.mtype = 9
         message.save()
+        if unread:
+            misc.bump_counter("messages", current_user.uid, -1)
         return jsonify(status="ok")
     except Message.DoesNotExist:
         return jsonify(status="error", error=_("Message does not exist"))
@@ -2340,8 +2390,7 @@ def toggle_sticky(post):
                 link=url_for("sub.view_post", sub=post.sid.name, pid=post.pid),
             )
 
-        cache.delete_memoized(misc.getStickyPid, post.sid_id)
-        cache.delete_memoized(misc.getStickies, post.sid_id)
+        misc.invalidate_sub_bundle(post.sid_id)
     return jsonify(status="ok")
 
 
@@ -2468,7 +2517,7 @@ def toggle_wikipost(post):
             # misc.create_sublog(misc.LOG_TYPE_SUB_STICKY_ADD, current_user.uid, post.sid,
             #        link=url_for('sub.view_post', sub=post.sid.name, pid=post.pid))
 
-        cache.delete_memoized(misc.getWikiPid, post.sid_id)
+        misc.invalidate_sub_bundle(post.sid_id)
     return jsonify(status="ok")
 
 
@@ -2495,7 +2544,7 @@ def delete_user_flair(sub):
             return jsonify(status="error", error=[_("Flair does not exist")])
 
         flair.delete_instance()
-        cache.delete_memoized(misc.get_sub_flair_choices, sub.sid)
+        misc.invalidate_sub_bundle(sub.sid)
         return jsonify(status="ok")
     return json.dumps({"status": "error", "error": get_errors(form)})
 
@@ -2523,7 +2572,7 @@ def create_user_flair(sub):
 
     if form.validate():
         SubUserFlairChoice.create(sid=sub.sid, flair=form.text.data)
-        cache.delete_memoized(misc.get_sub_flair_choices, sub.sid)
+        misc.invalidate_sub_bundle(sub.sid)
         return jsonify(status="ok")
     return jsonify(status="error", error=get_errors(form))
 
@@ -2599,6 +2648,7 @@ def delete_rule(sub):
         except SubRule.DoesNotExist:
             return jsonify(status="error", error=[_("Rule does not exist")])
         rule.delete_instance()
+        misc.invalidate_sub_bundle(sub.sid)
         return jsonify(status="ok")
     return json.dumps({"status": "error", "error": get_errors(form)})
 
@@ -2622,6 +2672,7 @@ def create_rule(sub):
             return jsonify(status="error", error=[_("Rule has invalid characters")])
 
         SubRule.create(sid=sub.sid, text=form.text.data)
+        misc.invalidate_sub_bundle(sub.sid)
         return jsonify(status="ok")
     return json.dumps({"status": "error", "error": get_errors(form)})
 
@@ -2722,6 +2773,10 @@ def edit_comment():
         comment.content = form.text.data
         comment.lastedit = dt
         comment.save()
+        search_engine.index_comment(comment.cid)
+        misc.change_recent_activity(
+            "comment", comment.cid, misc.comment_summary(comment.content)
+        )
         return jsonify(status="ok")
     return json.dumps({"status": "error", "error": get_errors(form)[0]})
 
@@ -2773,6 +2828,8 @@ def delete_comment():
             comment.status = 1
 
         comment.save()
+        search_engine.index_comment(comment.cid)
+        misc.change_recent_activity("comment", comment.cid)
 
         q = Message.delete().where(Message.mlink == form.cid.data)
         q.execute()
@@ -2819,6 +2876,7 @@ def undelete_comment():
             )
         comment.status = 0
         comment.save()
+        search_engine.index_comment(comment.cid)
 
         return jsonify(status="ok")
     return json.dumps({"status": "error", "error": get_errors(form)})
@@ -2956,7 +3014,7 @@ def preview():
     if form.validate():
         if request.json.get("text"):
             return jsonify(
-                status="ok", text=misc.our_markdown(request.json.get("text"))
+                status="ok", text=misc.render_markdown(request.json.get("text"))
             )
         else:
             return jsonify(status="error", error=_("Missing text"))
@@ -2982,6 +3040,7 @@ def toggle_nsfw():
         ):
             post.nsfw = 1 if post.nsfw == 0 else 0
             post.save()
+            misc.update_home_feeds(post.pid, added=True)
             return json.dumps({"status": "ok"})
         else:
             return json.dumps({"status": "error", "error": _("Not authorized")})
@@ -3325,6 +3384,7 @@ def edit_top_bar():
         except SubSubscriber.DoesNotExist:
             pass  # TODO: Add these as status=4 SubSubscriber (after implementing some way to delete those)
 
+    misc.invalidate_user_snapshot(current_user.uid)
     return jsonify(status="ok")
 
 
@@ -3343,64 +3403,19 @@ def admin_undo_votes(uid):
     if not form.validate():
         return redirect(url_for("user.view", user=user.name))
 
-    post_v = SubPostVote.select().where(SubPostVote.uid == user.uid)
-    comm_v = SubPostCommentVote.select().where(SubPostCommentVote.uid == user.uid)
-    score_deltas = defaultdict(int)
-    delta_given = 0
+    if misc.get_undo_votes_progress(user.uid).get("status") == "running":
+        return jsonify(status="error", error=[_("The votes are already being removed")])
+    jobs.enqueue(misc.undo_votes, user.uid)
+    return jsonify(status="ok")
 
-    for v in post_v:
-        try:
-            post = (
-                SubPost.select(SubPost.pid, SubPost.uid)
-                .where(SubPost.pid == v.pid_id)
-                .get()
-            )
-        except SubPost.DoesNotExist:
-            # Edge case. An orphan vote.
-            v.delete_instance()
-            continue
-        # Not removing self-votes
-        if post.uid_id == user.uid:
-            continue
-        adjustment = 1 if v.positive else -1
-        score_deltas[post.uid_id] -= adjustment
-        delta_given -= adjustment
-        kwargs = dict(score=SubPost.score - adjustment)
-        if v.positive:
-            kwargs.update(upvotes=SubPost.upvotes - 1)
-        else:
-            kwargs.update(downvotes=SubPost.downvotes - 1)
-        SubPost.update(**kwargs).where(SubPost.pid == v.pid_id).execute()
-        v.delete_instance()
-    for v in comm_v:
-        try:
-            comm = (
-                SubPostComment.select(
-                    SubPostComment.cid, SubPostComment.score, SubPostComment.uid
-                )
-                .where(SubPostComment.cid == v.cid)
-                .get()
-            )
-        except SubPostComment.DoesNotExist:
-            # Edge case. An orphan vote.
-            v.delete_instance()
-            continue
-        adjustment = 1 if v.positive else -1
-        kwargs = {}
-        score_deltas[comm.uid_id] -= adjustment
-        delta_given -= adjustment
-        if comm.score is not None:
-            kwargs.update(score=SubPostComment.score - adjustment)
-        if v.positive:
-            kwargs.update(upvotes=SubPostComment.upvotes - 1)
-        else:
-            kwargs.update(downvotes=SubPostComment.downvotes - 1)
-        SubPostComment.update(**kwargs).where(SubPostComment.cid == v.cid).execute()
-        v.delete_instance()
-    for recipient_uid, delta in score_deltas.items():
-        User.update(score=User.score + delta).where(User.uid == recipient_uid).execute()
-    User.update(given=User.given + delta_given).where(User.uid == uid).execute()
-    return redirect(url_for("user.view", user=user.name))
+
+@do.route("/do/admin/undo_votes/<uid>", methods=["GET"])
+@login_required
+def admin_undo_votes_progress(uid):
+    """ How many of the votes of the user have been removed so far """
+    if not current_user.admin:
+        abort(403)
+    return jsonify(misc.get_undo_votes_progress(uid))
 
 
 @do.route("/do/cast_vote/<pid>/<oid>", methods=["POST"])
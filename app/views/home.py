@@ -15,6 +15,7 @@ from .. import misc
 from ..misc import engine
 from ..misc import ratelimit, POSTING_LIMIT
 from ..models import SubPost, Sub
+from ..search import search_engine, parse_filters
 
 bp = Blueprint("home", __name__)
 
@@ -29,10 +30,11 @@ def index():
 @bp.route("/hot/<int:page>")
 def hot(page):
     """ /hot for subscriptions """
-    posts = list(misc.getPostList(misc.postListQueryHome(), "hot", page).dicts())
+    posts = list(misc.getHomePostList("hot", page, request.args.get("after")).dicts())
     return engine.get_template("index.html").render(
         {
             "posts": posts,
+            "next_cursor": misc.next_post_cursor(posts, "hot"),
             "sort_type": "home.hot",
             "page": page,
             "subOfTheDay": misc.getSubOfTheDay(),
@@ -47,10 +49,11 @@ def hot(page):
 @bp.route("/new/<int:page>")
 def new(page):
     """ /new for subscriptions """
-    posts = misc.getPostList(misc.postListQueryHome(), "new", page).dicts()
+    posts = list(misc.getHomePostList("new", page, request.args.get("after")).dicts())
     return engine.get_template("index.html").render(
         {
             "posts": posts,
+            "next_cursor": misc.next_post_cursor(posts, "new"),
             "sort_type": "home.new",
             "page": page,
             "subOfTheDay": misc.getSubOfTheDay(),
@@ -65,10 +68,11 @@ def new(page):
 @bp.route("/top/<int:page>")
 def top(page):
     """ /top for subscriptions """
-    posts = misc.getPostList(misc.postListQueryHome(), "top", page).dicts()
+    posts = list(misc.getHomePostList("top", page, request.args.get("after")).dicts())
     return engine.get_template("index.html").render(
         {
             "posts": posts,
+            "next_cursor": misc.next_post_cursor(posts, "top"),
             "sort_type": "home.top",
             "page": page,
             "subOfTheDay": misc.getSubOfTheDay(),
@@ -101,12 +105,16 @@ def all_new(page):
     """ The index page, all posts sorted as most recent posted first """
     posts = list(
         misc.getPostList(
-            misc.postListQueryBase(isSubMod=current_user.can_admin), "new", page
+            misc.postListQueryBase(isSubMod=current_user.can_admin),
+            "new",
+            page,
+            request.args.get("after"),
         ).dicts()
     )
     return engine.get_template("index.html").render(
         {
             "posts": posts,
+            "next_cursor": misc.next_post_cursor(posts, "new"),
             "sort_type": "home.all_new",
             "page": page,
             "subOfTheDay": misc.getSubOfTheDay(),
@@ -117,50 +125,50 @@ def all_new(page):
     )
 
 
-@bp.route("/all/<sort>/more", defaults={"pid": None})
+def more_cursor(sort, pid):
+    """Returns the cursor to continue an infinite scroll listing from. The
+    client only knows the pid of the last post it has, so we look up the
+    rest of its sort key."""
+    if request.args.get("after") or pid is None:
+        return request.args.get("after")
+    try:
+        post = (
+            SubPost.select(SubPost.pid, SubPost.score, SubPost.hot)
+            .where(SubPost.pid == pid)
+            .dicts()
+            .get()
+        )
+    except SubPost.DoesNotExist:
+        return abort(404)
+    return misc.post_cursor(post, sort)
+
+
+@bp.route("/all/<sort>/more", defaults={"page": 1, "pid": None})
 @bp.route("/all/<sort>/more/<int:page>/<int:pid>")
 def all_more(sort, page, pid):
-    """ Infinite scroll pagination for /all """
-    # XXX: Our pagination is very slow
-    if sort == "new":
-        posts = misc.getPostList(
-            misc.postListQueryBase(isSubMod=current_user.can_admin).where(
-                SubPost.pid < pid
-            ),
-            "new",
-            1,
-        ).dicts()
-    elif sort == "top":
-        posts = misc.getPostList(
-            misc.postListQueryBase(isSubMod=current_user.can_admin), "top", page
-        ).dicts()
-    elif sort == "hot":
-        posts = misc.getPostList(
-            misc.postListQueryBase(isSubMod=current_user.can_admin), "hot", page
-        ).dicts()
-    else:
+    """Infinite scroll pagination for /all. Continues after post `pid`, or
+    after the `after` cursor if there is one."""
+    if sort not in ("new", "top", "hot"):
         return abort(404)
+    posts = misc.getPostList(
+        misc.postListQueryBase(isSubMod=current_user.can_admin),
+        sort,
+        1,
+        more_cursor(sort, pid),
+    ).dicts()
 
     return engine.get_template("shared/post.html").render(
         {"posts": posts, "sub": False}
     )
 
 
-@bp.route("/home/<sort>/more", defaults={"pid": None})
+@bp.route("/home/<sort>/more", defaults={"page": 1, "pid": None})
 @bp.route("/home/<sort>/more/<int:page>/<int:pid>")
 def home_more(sort, page, pid):
-    """ Infinite scroll pagination for /all """
-    # XXX: Our pagination is very slow
-    if sort == "new":
-        posts = misc.getPostList(
-            misc.postListQueryHome().where(SubPost.pid < pid), "new", 1
-        ).dicts()
-    elif sort == "top":
-        posts = misc.getPostList(misc.postListQueryHome(), "top", page).dicts()
-    elif sort == "hot":
-        posts = misc.getPostList(misc.postListQueryHome(), "hot", page).dicts()
-    else:
+    """ Infinite scroll pagination for the home page, see all_more """
+    if sort not in ("new", "top", "hot"):
         return abort(404)
+    posts = misc.getHomePostList(sort, 1, more_cursor(sort, pid)).dicts()
 
     return engine.get_template("shared/post.html").render(
         {"posts": posts, "sub": False}
@@ -174,14 +182,17 @@ def all_domain_new(domain, page):
     domain = re.sub(r"[^A-Za-z0-9.\-_]+", "", domain)
     posts = misc.getPostList(
         misc.postListQueryBase(noAllFilter=True).where(
-            SubPost.link % ("%://" + domain + "/%")
+            SubPost.domain == domain.lower()
         ),
         "new",
         page,
-    ).dicts()
+        request.args.get("after"),
+    )
+    posts = list(posts.dicts())
     return engine.get_template("index.html").render(
         {
             "posts": posts,
+            "next_cursor": misc.next_post_cursor(posts, "new"),
             "sort_type": "home.all_domain_new",
             "page": page,
             "subOfTheDay": misc.getSubOfTheDay(),
@@ -194,22 +205,33 @@ def all_domain_new(domain, page):
 
 @bp.route("/search/<term>", defaults={"page": 1})
 @bp.route("/search/<term>/<int:page>")
-@ratelimit(POSTING_LIMIT)
 def search(page, term):
-    """ The index page, with basic title search """
+    """The index page, with full-text search of post titles and contents.
+    Can be filtered with the `sub`, `user`, `since` and `until` arguments."""
     term = re.sub(r'[^A-Za-z0-9.,\-_\'" ]+', "", term)
-    posts = misc.getPostList(
-        misc.postListQueryBase().where(SubPost.title ** ("%" + term + "%")), "new", page
-    ).dicts()
+    kw = {
+        k: request.args[k]
+        for k in ("sub", "user", "since", "until")
+        if k in request.args
+    }
+    try:
+        pids = search_engine.search(term, page=page, **parse_filters(kw))
+    except ValueError:
+        pids = []
+    rank = {int(pid): i for i, pid in enumerate(pids)}
+    posts = misc.postListQueryBase().where(SubPost.pid << list(rank)).dicts()
+    posts = sorted(posts, key=lambda x: rank[x["pid"]])
+    kw["term"] = term
     return engine.get_template("index.html").render(
         {
             "posts": posts,
+            "next_cursor": None,
             "sort_type": "home.search",
             "page": page,
             "subOfTheDay": misc.getSubOfTheDay(),
             "changeLog": misc.getChangelog(),
             "ann": misc.getAnnouncement(),
-            "kw": {"term": term},
+            "kw": kw,
         }
     )
 
@@ -218,12 +240,18 @@ def search(page, term):
 @bp.route("/all/top/<int:page>")
 def all_top(page):
     """ The index page, all posts sorted as most recent posted first """
-    posts = misc.getPostList(
-        misc.postListQueryBase(isSubMod=current_user.can_admin), "top", page
-    ).dicts()
+    posts = list(
+        misc.getPostList(
+            misc.postListQueryBase(isSubMod=current_user.can_admin),
+            "top",
+            page,
+            request.args.get("after"),
+        ).dicts()
+    )
     return engine.get_template("index.html").render(
         {
             "posts": posts,
+            "next_cursor": misc.next_post_cursor(posts, "top"),
             "sort_type": "home.all_top",
             "page": page,
             "subOfTheDay": misc.getSubOfTheDay(),
@@ -239,13 +267,19 @@ def all_top(page):
 @bp.route("/all/hot/<int:page>")
 def all_hot(page):
     """ The index page, all posts sorted as most recent posted first """
-    posts = misc.getPostList(
-        misc.postListQueryBase(isSubMod=current_user.can_admin), "hot", page
-    ).dicts()
+    posts = list(
+        misc.getPostList(
+            misc.postListQueryBase(isSubMod=current_user.can_admin),
+            "hot",
+            page,
+            request.args.get("after"),
+        ).dicts()
+    )
 
     return engine.get_template("index.html").render(
         {
             "posts": posts,
+            "next_cursor": misc.next_post_cursor(posts, "hot"),
             "sort_type": "home.all_hot",
             "page": page,
             "subOfTheDay": misc.getSubOfTheDay(),
@@ -304,7 +338,7 @@ def subs_search(page, term, sort):
         Sub.sid, Sub.name, Sub.title, Sub.nsfw, Sub.creation, Sub.subscribers, Sub.posts
     )
 
-    c = c.where(Sub.name.contains(term))
+    c = c.where(search_engine.sub_names.condition(Sub.name, term))
 
     # sorts...
     if sort == "name_desc":
@@ -42,6 +42,7 @@ def view_notifications(page):
     Notification.update(read=datetime.utcnow()).where(
         (Notification.read.is_null(True)) & (Notification.target == current_user.uid)
     ).execute()
+    misc.reset_counter("notifications", current_user.uid)
     return engine.get_template("user/messages/notifications.html").render(
         {"notifications": notifications, "postmeta": postmeta}
     )
@@ -57,6 +58,8 @@ def delete_notification(mid):
     except Notification.DoesNotExist:
         return abort(404)
     notification.delete_instance()
+    if notification.read is None:
+        misc.bump_counter("notifications", current_user.uid, -1)
     return jsonify(status="ok")
 
 
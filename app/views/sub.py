@@ -110,6 +110,31 @@ def edit_sub_css(sub):
     )
 
 
+@blueprint.route("/<sub>/stylesheet/<digest>.css")
+def view_sub_css(sub, digest):
+    """Serves the sub's stylesheet. Its URL changes along with it, so it
+    can be cached for good."""
+    try:
+        sub = Sub.get(fn.Lower(Sub.name) == sub.lower())
+        sheet = SubStylesheet.get(SubStylesheet.sid == sub.sid)
+    except (Sub.DoesNotExist, SubStylesheet.DoesNotExist):
+        abort(404)
+
+    current = misc.get_stylesheet_hash(sheet)
+    if not current:
+        abort(404)
+    if digest != current:
+        # A page cached before the last edit.
+        return redirect(url_for("sub.view_sub_css", sub=sub.name, digest=current))
+
+    response = Response(sheet.content, mimetype="text/css")
+    response.set_etag(current)
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
+
+
 @blueprint.route("/<sub>/edit/flairs")
 @login_required
 def edit_sub_flairs(sub):
@@ -324,13 +349,16 @@ def view_sub_new(sub, page):
         ),
         "new",
         page,
-    ).dicts()
+        request.args.get("after"),
+    )
+    posts = list(posts.dicts())
 
     return engine.get_template("sub.html").render(
         {
             "sub": sub,
             "subInfo": misc.getSubData(sub["sid"]),
             "posts": posts,
+            "next_cursor": misc.next_post_cursor(posts, "new"),
             "page": page,
             "sort_type": "sub.view_sub_new",
             "subMods": misc.getSubMods(sub["sid"]),
@@ -427,13 +455,16 @@ def view_sub_top(sub, page):
         ),
         "top",
         page,
-    ).dicts()
+        request.args.get("after"),
+    )
+    posts = list(posts.dicts())
 
     return engine.get_template("sub.html").render(
         {
             "sub": sub,
             "subInfo": misc.getSubData(sub["sid"]),
             "posts": posts,
+            "next_cursor": misc.next_post_cursor(posts, "top"),
             "page": page,
             "sort_type": "sub.view_sub_top",
             "subMods": misc.getSubMods(sub["sid"]),
@@ -460,13 +491,16 @@ def view_sub_hot(sub, page):
         ),
         "hot",
         page,
-    ).dicts()
+        request.args.get("after"),
+    )
+    posts = list(posts.dicts())
 
     return engine.get_template("sub.html").render(
         {
             "sub": sub,
             "subInfo": misc.getSubData(sub["sid"]),
             "posts": posts,
+            "next_cursor": misc.next_post_cursor(posts, "hot"),
             "page": page,
             "sort_type": "sub.view_sub_hot",
             "subMods": misc.getSubMods(sub["sid"]),
@@ -9,6 +9,7 @@ from .. import misc
 from ..config import config
 from ..misc import engine, ratelimit, POSTING_LIMIT
 from ..socketio import socketio
+from ..search import search_engine
 from ..models import (
     Sub,
     db as pdb,
@@ -409,6 +410,7 @@ def create_post(ptype, sub):
         title=form.title.data,
         content=form.content.data if ptype != 1 else "",
         link=form.link.data if ptype == 1 else None,
+        domain=misc.link_domain(form.link.data) if ptype == 1 else None,
         posted=datetime.utcnow(),
         score=1,
         upvotes=1,
@@ -419,6 +421,11 @@ def create_post(ptype, sub):
         nsfw=form.nsfw.data if not sub.nsfw else 1,
         thumbnail=img,
     )
+    misc.update_hot_rank(post.pid, added=True)
+    search_engine.index_post(post.pid)
+    if post.content:
+        # Warm up the markdown cache
+        misc.our_markdown(post.content)
     thumbnail_store = [(SubPost, "pid", post.pid)]
 
     if form.ptype.data == "poll":
@@ -439,6 +446,9 @@ def create_post(ptype, sub):
             )
 
     Sub.update(posts=Sub.posts + 1).where(Sub.sid == sub.sid).execute()
+    misc.add_recent_activity(
+        "post", post.pid, post.title, current_user.name, post.pid, sub, post.posted
+    )
     addr = url_for("sub.view_post", sub=sub.name, pid=post.pid)
     posts = misc.getPostList(
         misc.postListQueryBase(nofilter=True).where(SubPost.pid == post.pid), "new", 1
@@ -591,6 +601,7 @@ def create_sub():
             )
 
     sub = Sub.create(sid=uuid.uuid4(), name=form.subname.data, title=form.title.data)
+    search_engine.sub_names.publish(sub.name)
 
     smd = [dict(sid=sub.sid, key="mod", value=current_user.uid)]
     for key in ["allow_text_posts", "allow_link_posts", "allow_upload_posts"]:
@@ -598,7 +609,9 @@ def create_sub():
     SubMetadata.insert_many(smd).execute()
 
     SubMod.create(sid=sub.sid, uid=current_user.uid, power_level=0)
-    SubStylesheet.create(sid=sub.sid, content="", source="/* CSS here */")
+    SubStylesheet.create(
+        sid=sub.sid, content="", content_hash="", source="/* CSS here */"
+    )
 
     # admin/site log
     misc.create_sublog(
@@ -606,5 +619,6 @@ def create_sub():
     )
 
     SubSubscriber.create(uid=current_user.uid, sid=sub.sid, status=1)
+    misc.invalidate_user_snapshot(current_user.uid)
 
     return redirect(url_for("sub.view_sub", sub=form.subname.data))
@@ -3,5 +3,22 @@ from .admin import admin
 from .default import default
 from .migration import migration
 from .translations import translations
+from .bench import bench
+from .votes import votes
+from .profiler import profiler
+from .search import search
+from .jobs import jobs, worker
 
-commands = [migration, recount, admin, default, translations]
+commands = [
+    migration,
+    recount,
+    admin,
+    default,
+    translations,
+    bench,
+    votes,
+    profiler,
+    search,
+    jobs,
+    worker,
+]
@@ -1,6 +1,7 @@
 import click
 from flask.cli import AppGroup
 from peewee import fn
+from app import misc
 from app.models import User, UserMetadata
 
 admin = AppGroup("admin", help="Manages admin users")
@@ -15,6 +16,7 @@ def add(username):
         print("Error: User does not exist")
         return
     UserMetadata.create(uid=user.uid, key="admin", value="1")
+    misc.invalidate_user_snapshot(user.uid)
     print("Done.")
 
 
@@ -31,6 +33,7 @@ def remove(username):
             (UserMetadata.uid == user.uid) & (UserMetadata.key == "admin")
         )
         umeta.delete_instance()
+        misc.invalidate_user_snapshot(user.uid)
         print("Done.")
     except UserMetadata.DoesNotExist:
         print("Error: User is not an administrator.")
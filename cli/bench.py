@@ -0,0 +1,471 @@
+import json
+import math
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from flask_login import login_user, logout_user
+from peewee import fn
+from PIL import Image
+from app import misc, tasks
+from app.models import (
+    db,
+    User,
+    Sub,
+    SubMod,
+    SubSubscriber,
+    SubPost,
+    SubPostComment,
+    SubPostVote,
+    SubPostReport,
+    SiteMetadata,
+)
+
+bench = AppGroup("bench", help="Runs performance benchmarks")
+
+
+def synthetic_comments(count, seed=0):
+    """Returns a flat list of `count` comments shaped like the ones
+    get_comment_tree receives. About a third of them are top level
+    comments and the rest reply to a random earlier comment. The list is
+    shuffled, as it would be when sorted by score."""
+    rnd = random.Random(seed)
+    comments = []
+    for i in range(count):
+        parent = None
+        if comments and rnd.random() > 0.3:
+            parent = rnd.choice(comments)["cid"]
+        comments.append({"cid": f"c{i}", "parentcid": parent})
+    rnd.shuffle(comments)
+    return comments
+
+
+def legacy_build_tree(tuff, rootcid=None):
+    """ The quadratic tree builder get_comment_tree used to have """
+    res = []
+    for i in tuff[::]:
+        if i["parentcid"] == rootcid:
+            tuff.remove(i)
+            i["children"] = legacy_build_tree(tuff, rootcid=i["cid"])
+            res.append(i)
+    return res
+
+
+def best_time(func, make_args, repeat):
+    """Runs `func(*make_args())` `repeat` times and returns the fastest
+    run in milliseconds. Argument preparation is not timed."""
+    timings = []
+    for _ in range(repeat):
+        args = make_args()
+        start = time.perf_counter()
+        func(*args)
+        timings.append((time.perf_counter() - start) * 1000)
+    return round(min(timings), 3)
+
+
+def emit(name, results):
+    print(json.dumps({"benchmark": name, "results": results}, indent=2))
+
+
+@bench.command(name="comment-tree", help="Times building comment trees")
+@click.option("--sizes", default="1000,10000,50000", help="Comma separated sizes")
+@click.option("--repeat", default=3, help="Runs per size, the fastest is kept")
+@click.option(
+    "--reference-limit",
+    default=10000,
+    help="Largest size also timed with the old quadratic builder",
+)
+def comment_tree(sizes, repeat, reference_limit):
+    results = []
+    for size in [int(x) for x in sizes.split(",")]:
+        base = synthetic_comments(size)
+
+        def fresh():
+            return ([dict(c) for c in base],)
+
+        result = {
+            "comments": size,
+            "build_ms": best_time(misc.build_comment_tree, fresh, repeat),
+        }
+        if size <= reference_limit:
+            result["legacy_build_ms"] = best_time(legacy_build_tree, fresh, repeat)
+            result["speedup"] = round(
+                result["legacy_build_ms"] / max(result["build_ms"], 0.001), 1
+            )
+        results.append(result)
+    emit("comment-tree", results)
+
+
+def synthetic_image(width, height, seed=0):
+    """Returns an RGB image with a flat background and some noisy patches
+    scattered over it, like a screenshot or a meme would have."""
+    rnd = random.Random(seed)
+    im = Image.new("RGB", (width, height), (240, 240, 240))
+    for _ in range(20):
+        w = rnd.randint(width // 10, width // 2)
+        h = rnd.randint(height // 20, height // 4)
+        patch = Image.effect_noise((w, h), rnd.randint(10, 100)).convert("RGB")
+        im.paste(patch, (rnd.randint(0, width - w), rnd.randint(0, height - h)))
+    return im
+
+
+def legacy_generate_thumb(im):
+    """ The entropy crop generate_thumb used to do, copying the image on every step """
+
+    def image_entropy(img):
+        hist = img.histogram()
+        hist_size = sum(hist)
+        hist = [float(h) / hist_size for h in hist]
+        return -sum(p * math.log(p, 2) for p in hist if p != 0)
+
+    x, y = im.size
+    while y > x:
+        slice_height = min(y - x, 10)
+        bottom = im.crop((0, y - slice_height, x, y))
+        top = im.crop((0, 0, x, slice_height))
+        if image_entropy(bottom) < image_entropy(top):
+            im = im.crop((0, 0, x, y - slice_height))
+        else:
+            im = im.crop((0, slice_height, x, y))
+        x, y = im.size
+    im.thumbnail((70, 70), Image.ANTIALIAS)
+    return im
+
+
+@bench.command(help="Times the entropy crop of thumbnails")
+@click.option("--repeat", default=3, help="Runs per image, the fastest is kept")
+def thumbnails(repeat):
+    results = []
+    for shape, size in (
+        ("tall", (1000, 4000)),
+        ("wide", (4000, 1000)),
+        ("square", (1500, 1500)),
+    ):
+        base = synthetic_image(*size)
+
+        def fresh():
+            return (base.copy(),)
+
+        new, old = tasks.generate_thumb(base.copy()), legacy_generate_thumb(base.copy())
+        result = {
+            "shape": shape,
+            "size": "x".join(str(x) for x in size),
+            "thumb_ms": best_time(tasks.generate_thumb, fresh, repeat),
+            "legacy_thumb_ms": best_time(legacy_generate_thumb, fresh, repeat),
+            "identical": new.tobytes() == old.tobytes(),
+        }
+        result["speedup"] = round(
+            result["legacy_thumb_ms"] / max(result["thumb_ms"], 0.001), 1
+        )
+        results.append(result)
+    emit("thumbnails", results)
+
+
+def make_uid(rnd):
+    return str(uuid.UUID(int=rnd.getrandbits(128), version=4))
+
+
+def insert_batches(model, rows, batch=500):
+    for i in range(0, len(rows), batch):
+        model.insert_many(rows[i : i + batch]).execute()
+
+
+def seed_data(users, subs, posts, comments, votes, subscriptions, reports, seed=0):
+    """Fills the database with deterministic synthetic data: the same
+    arguments always create the same names, relationships and votes. Every
+    name starts with "bench" so the rows are easy to find and remove. The
+    timestamps are relative to now and recent enough that nothing is
+    archived."""
+    rnd = random.Random(seed)
+    now = datetime.utcnow()
+
+    def recent(days=30):
+        return now - timedelta(seconds=rnd.randrange(days * 86400))
+
+    with db.atomic():
+        uids = [make_uid(rnd) for _ in range(users)]
+        insert_batches(
+            User,
+            [
+                {
+                    "uid": uid,
+                    "crypto": 1,
+                    "name": f"bench_user_{i}",
+                    "email": f"bench_user_{i}@example.com",
+                    "joindate": recent(365),
+                }
+                for i, uid in enumerate(uids)
+            ],
+        )
+
+        sids = [make_uid(rnd) for _ in range(subs)]
+        insert_batches(
+            Sub,
+            [
+                {
+                    "sid": sid,
+                    "name": f"bench_sub_{i}",
+                    "title": f"Benchmark sub {i}",
+                    "creation": recent(365),
+                    "subscribers": 0,
+                }
+                for i, sid in enumerate(sids)
+            ],
+        )
+        insert_batches(
+            SubMod,
+            [{"user": rnd.choice(uids), "sub": sid, "power_level": 0} for sid in sids],
+        )
+        # The first few subs are the defaults anonymous users see.
+        insert_batches(
+            SiteMetadata, [{"key": "default", "value": sid} for sid in sids[:5]]
+        )
+
+        subscribers = []
+        for uid in uids:
+            for sid in rnd.sample(sids, min(subscriptions, len(sids))):
+                subscribers.append({"uid": uid, "sid": sid, "status": 1})
+        insert_batches(SubSubscriber, subscribers)
+
+        insert_batches(
+            SubPost,
+            [
+                {
+                    "sid": rnd.choice(sids),
+                    "uid": rnd.choice(uids),
+                    "title": f"Benchmark post {i}",
+                    "content": f"Content of benchmark post {i}",
+                    "posted": recent(),
+                    "score": 0,
+                    "upvotes": 0,
+                    "downvotes": 0,
+                    "deleted": 0,
+                    "comments": 0,
+                    "ptype": 0,
+                    "nsfw": False,
+                }
+                for i in range(posts)
+            ],
+        )
+        pids = [
+            x.pid
+            for x in SubPost.select(SubPost.pid)
+            .where(SubPost.sid << sids)
+            .order_by(SubPost.pid)
+        ]
+
+        # Comments concentrate on a few posts, like they do on real sites.
+        cids_by_post = {}
+        comment_rows = []
+        for i in range(comments):
+            pid = pids[min(int(rnd.paretovariate(1)) - 1, len(pids) - 1)]
+            if rnd.random() > 0.5:
+                pid = rnd.choice(pids)
+            siblings = cids_by_post.setdefault(pid, [])
+            cid = make_uid(rnd)
+            comment_rows.append(
+                {
+                    "cid": cid,
+                    "pid": pid,
+                    "uid": rnd.choice(uids),
+                    "parentcid": rnd.choice(siblings)
+                    if siblings and rnd.random() > 0.3
+                    else None,
+                    "content": f"Benchmark comment {i}",
+                    "time": recent(),
+                    "score": 0,
+                }
+            )
+            siblings.append(cid)
+        insert_batches(SubPostComment, comment_rows)
+
+        vote_pairs = set()
+        limit = min(votes, len(uids) * len(pids))
+        while len(vote_pairs) < limit:
+            vote_pairs.add((rnd.choice(uids), rnd.choice(pids)))
+        insert_batches(
+            SubPostVote,
+            [
+                {"uid": uid, "pid": pid, "positive": int(rnd.random() > 0.2)}
+                for uid, pid in sorted(vote_pairs)
+            ],
+        )
+
+        insert_batches(
+            SubPostReport,
+            [
+                {
+                    "pid": rnd.choice(pids),
+                    "uid": rnd.choice(uids),
+                    "reason": f"Benchmark report {i}",
+                }
+                for i in range(reports)
+            ],
+        )
+
+        # Bring the counters in line with the rows created above.
+        def count_votes(positive):
+            return SubPostVote.select(fn.Count(SubPostVote.xid)).where(
+                (SubPostVote.pid == SubPost.pid) & (SubPostVote.positive == positive)
+            )
+
+        SubPost.update(
+            upvotes=count_votes(1),
+            downvotes=count_votes(0),
+            comments=SubPostComment.select(fn.Count(SubPostComment.cid)).where(
+                SubPostComment.pid == SubPost.pid
+            ),
+        ).where(SubPost.pid << pids).execute()
+        SubPost.update(score=SubPost.upvotes - SubPost.downvotes).where(
+            SubPost.pid << pids
+        ).execute()
+        SubPost.update(hot=misc.hot_rank_expression()).where(
+            SubPost.pid << pids
+        ).execute()
+        Sub.update(
+            subscribers=SubSubscriber.select(fn.Count(SubSubscriber.xid)).where(
+                (SubSubscriber.sid == Sub.sid) & (SubSubscriber.status == 1)
+            ),
+            posts=SubPost.select(fn.Count(SubPost.pid)).where(SubPost.sid == Sub.sid),
+        ).where(Sub.sid << sids).execute()
+
+    return {
+        "users": users,
+        "subs": subs,
+        "posts": len(pids),
+        "comments": len(comment_rows),
+        "votes": len(vote_pairs),
+        "reports": reports,
+    }
+
+
+@bench.command(help="Fills the database with synthetic benchmark data")
+@click.option("--users", default=1000)
+@click.option("--subs", default=100)
+@click.option("--posts", default=10000)
+@click.option("--comments", default=50000)
+@click.option("--votes", default=100000)
+@click.option("--subscriptions", default=20, help="Subs each user subscribes to")
+@click.option("--reports", default=200)
+@click.option(
+    "--seed", default=0, help="Random seed, the same seed gives the same data"
+)
+def seed(users, subs, posts, comments, votes, subscriptions, reports, seed):
+    """Seed a throwaway database (SQLite or Postgres) for `flask bench
+    read-paths`. Running it twice on the same database fails because the
+    names are the same."""
+    start = time.perf_counter()
+    counts = seed_data(
+        users, subs, posts, comments, votes, subscriptions, reports, seed
+    )
+    counts["seconds"] = round(time.perf_counter() - start, 1)
+    emit("seed", counts)
+
+
+def time_read_paths(repeat):
+    """Times the functions behind the busiest pages on the data created by
+    seed_data. Must run in a request context."""
+    results = []
+
+    def run(name, func, make_args=tuple):
+        results.append({"name": name, "ms": best_time(func, make_args, repeat)})
+
+    def post_list(query, sort, page):
+        return list(misc.getPostList(query(), sort, page).dicts())
+
+    user = (
+        User.select(User.uid)
+        .where(User.name.startswith("bench_user_"))
+        .order_by(User.name)
+        .first()
+    )
+    if user is None:
+        raise click.ClickException("No benchmark data, run `flask bench seed` first.")
+    uid = user.uid
+
+    logout_user()
+    for sort in misc.POST_SORT_KEYS:
+        for page in (1, 10):
+            run(
+                f"getPostList anonymous home {sort} page {page}",
+                lambda: post_list(misc.postListQueryHome, sort, page),
+            )
+
+    def uncached_user():
+        misc.invalidate_user_snapshot(uid)
+        return (uid,)
+
+    run("load_user uncached", misc.load_user, uncached_user)
+    run("load_user cached", misc.load_user, lambda: (uid,))
+
+    login_user(misc.load_user(uid))
+    for sort in misc.POST_SORT_KEYS:
+        for page in (1, 10):
+            run(
+                f"getPostList home {sort} page {page}",
+                lambda: post_list(misc.postListQueryHome, sort, page),
+            )
+            run(
+                f"getPostList all {sort} page {page}",
+                lambda: post_list(misc.postListQueryBase, sort, page),
+            )
+
+    post = (
+        SubPost.select(SubPost.pid, SubPost.sid, SubPost.comments)
+        .order_by(SubPost.comments.desc(), SubPost.pid)
+        .first()
+    )
+
+    def comment_tree():
+        comments = (
+            SubPostComment.select(SubPostComment.cid, SubPostComment.parentcid)
+            .where(SubPostComment.pid == post.pid)
+            .order_by(SubPostComment.score.desc())
+            .dicts()
+        )
+        return misc.get_comment_tree(post.pid, post.sid_id, comments, uid=uid)
+
+    run(f"get_comment_tree {post.comments} comments", comment_tree)
+
+    # Every run votes and then takes the vote back, so the data is unchanged.
+    targets = [
+        x.pid
+        for x in SubPost.select(SubPost.pid)
+        .where(
+            (SubPost.uid != uid)
+            & SubPost.pid.not_in(
+                SubPostVote.select(SubPostVote.pid).where(SubPostVote.uid == uid)
+            )
+        )
+        .order_by(SubPost.pid.desc())
+        .limit(repeat)
+    ]
+    rnd = random.Random(0)
+
+    def vote_twice(pid):
+        misc.cast_vote(uid, "post", pid, "up")
+        misc.cast_vote(uid, "post", pid, "up")
+
+    run("cast_vote and undo", vote_twice, lambda: (rnd.choice(targets),))
+
+    run("getReports admin open", misc.getReports, lambda: ("admin", "open", 1))
+    run("getReports admin all", misc.getReports, lambda: ("admin", "all", 1))
+
+    run("recent_activity", misc.recent_activity)
+    run(
+        "build_recent_activity",
+        misc.build_recent_activity,
+        lambda: misc.recent_activity_list(True),
+    )
+    return results
+
+
+@bench.command(name="read-paths", help="Times the core read paths on seeded data")
+@click.option("--repeat", default=5, help="Runs per function, the fastest is kept")
+def read_paths(repeat):
+    with current_app.test_request_context():
+        results = time_read_paths(repeat)
+    emit("read-paths", results)
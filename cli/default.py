@@ -1,6 +1,7 @@
 import click
 from flask.cli import AppGroup
 from peewee import fn
+from app import misc
 from app.models import Sub, SiteMetadata
 
 default = AppGroup(
@@ -30,6 +31,7 @@ def add(sub):
         print("Error: Sub is already a default!")
     except SiteMetadata.DoesNotExist:
         SiteMetadata.create(key="default", value=sub.sid)
+        misc.reset_recent_activity()
         print("Done.")
 
 
@@ -46,6 +48,7 @@ def remove(sub):
             (SiteMetadata.key == "default") & (SiteMetadata.value == sub.sid)
         )
         metadata.delete_instance()
+        misc.reset_recent_activity()
         print("Done.")
     except SiteMetadata.DoesNotExist:
         print("Error: Sub is not a default")
@@ -0,0 +1,50 @@
+import json
+import signal
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from app import jobs as app_jobs, misc
+from app.config import config
+
+jobs = AppGroup("jobs", help="Run and inspect the background job queues")
+
+
+@jobs.command(help="Runs the jobs queued in Redis when `jobs.enabled` is set")
+@click.option(
+    "--queues",
+    default="default,thumbnails,mail,notifications",
+    help="Comma separated queues to take jobs from, by order of priority.",
+)
+@click.option("--burst", is_flag=True, help="Stop when there are no jobs left.")
+@click.option(
+    "--flush-votes",
+    default=0,
+    help="Also write the queued vote counters every this many seconds "
+    "when `site.vote_write_behind` is set.",
+)
+def work(queues, burst, flush_votes):
+    """Run jobs until stopped. Jobs left unfinished by a worker that died
+    are put back in their queues when the next one starts."""
+    worker = app_jobs.Worker(current_app._get_current_object(), queues.split(","))
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    periodic = []
+    if flush_votes and config.site.vote_write_behind:
+        periodic.append((misc.flush_vote_deltas, flush_votes))
+    worker.work(burst=burst, periodic=periodic)
+
+
+# `flask worker` is the same command, for process managers and Procfiles.
+worker = click.Command(
+    "worker", callback=work.callback, params=work.params, help=work.help
+)
+
+
+@jobs.command(help="Shows the depth and totals of every queue")
+def stats():
+    print(json.dumps(app_jobs.get_stats(), indent=2))
+
+
+@jobs.command("retry-dead", help="Queues again the jobs that failed too many times")
+def retry_dead():
+    print(f"Queued {app_jobs.retry_dead()} jobs.")
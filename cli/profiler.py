@@ -0,0 +1,45 @@
+import json
+import click
+from flask.cli import AppGroup
+from app import profiler as query_profiler
+
+profiler = AppGroup("profiler", help="Shows what the query profiler collected")
+
+
+@profiler.command(help="Prints the slowest and most repeated queries")
+@click.option(
+    "--sort",
+    type=click.Choice(["time", "calls", "repeated"]),
+    default="time",
+    help="Order queries by total time, number of calls or number of requests "
+    "in which they were repeated.",
+)
+@click.option("--limit", default=20, help="Number of queries and endpoints to show")
+@click.option("--json", "as_json", is_flag=True, help="Print the report as JSON")
+def report(sort, limit, as_json):
+    """Print the totals collected while `profiler.enabled` was set."""
+    result = query_profiler.get_report(sort, limit)
+    if as_json:
+        print(json.dumps(result, indent=2))
+        return
+
+    print("   Calls Requests Repeated     Total ms  Avg ms  Call site")
+    for query in result["queries"]:
+        print(
+            f"{query['calls']:8}{query['requests']:9}{query['repeated']:9}"
+            f"{query['time_ms']:13.1f}{query['avg_ms']:8.2f}  {query['site']}"
+        )
+        print(f"    {query['sql'][:200]}")
+    print()
+    print("Requests  Queries/request     Total ms  Endpoint")
+    for endpoint in result["endpoints"]:
+        print(
+            f"{endpoint['requests']:8}{endpoint['queries_per_request']:17.1f}"
+            f"{endpoint['time_ms']:13.1f}  {endpoint['endpoint']}"
+        )
+
+
+@profiler.command(help="Deletes the collected totals")
+def reset():
+    count = query_profiler.reset()
+    print(f"Deleted {count} keys.")
@@ -1,34 +1,309 @@
+from contextlib import nullcontext
+import functools
 import click
 from flask.cli import AppGroup
-from app.models import Sub, SubSubscriber
+from peewee import Case, fn
+from app import misc
+from app.models import (
+    db,
+    Sub,
+    SubSubscriber,
+    SubPost,
+    SubPostVote,
+    SubPostComment,
+    SubPostCommentVote,
+    User,
+    rconn,
+)
 
 recount = AppGroup("recount", help="Re-count various internal counters")
 
 
+def recount_options(func):
+    """ Adds the options shared by the commands that recount from the votes and other rows """
+
+    @click.option(
+        "--save/--dry-run",
+        default=True,
+        help="Use --save (the default) to fix the counts, or --dry-run to just print the wrong ones.",
+    )
+    @click.option("--batch", default=1000, help="Rows checked in each transaction")
+    @click.option(
+        "--start", default=None, help="Only check rows with this key or a later one"
+    )
+    @click.option(
+        "--stop", default=None, help="Only check rows with keys before this one"
+    )
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+def recount_rows(name, key, fields, counts, save, batch, start, stop, label=None):
+    """Compares the counters `fields` of the rows of `key.model` with the
+    correct values returned by `counts(keys)`, as {key: {field name: value}}
+    with missing counters meaning 0, and fixes the ones that are wrong.
+    Rows are checked `batch` at a time, in key order, each batch in its own
+    transaction, so disjoint key ranges can be recounted in parallel.
+    Returns the keys of the rows that were wrong."""
+    model = key.model
+    label = label or key
+    start = key.adapt(start) if start is not None else None
+    stop = key.adapt(stop) if stop is not None else None
+    print(f"{'Row':36} {'Counter':10} {'Current':>8} {'Correct':>8}")
+    wrong = []
+    total = 0
+    last = None
+    while True:
+        with db.atomic() if save else nullcontext():
+            rows = model.select(key, label, *fields).order_by(key).limit(batch)
+            if last is not None:
+                rows = rows.where(key > last)
+            elif start is not None:
+                rows = rows.where(key >= start)
+            if stop is not None:
+                rows = rows.where(key < stop)
+            if save:
+                rows = misc.for_update(rows)
+            rows = list(rows.dicts())
+            if not rows:
+                break
+            last = rows[-1][key.name]
+            correct = counts([row[key.name] for row in rows])
+
+            for row in rows:
+                ident = row[key.name]
+                values = correct.get(ident, {})
+                changes = {}
+                for field in fields:
+                    value = values.get(field.name, 0)
+                    if (row[field.name] or 0) != value:
+                        print(
+                            f"{row[label.name]!s:36} {field.name:10} {row[field.name] or 0:8} {value:8}"
+                        )
+                        changes[field.name] = value
+                if changes:
+                    wrong.append(ident)
+                    if save:
+                        model.update(**changes).where(key == ident).execute()
+        total += len(rows)
+
+    print(
+        f"{'Fixed' if save else 'Found'} {len(wrong)} of {total} {name} with wrong counters."
+    )
+    return wrong
+
+
+def vote_counts(model, key, idents):
+    """ Returns {ident: {"score", "upvotes", "downvotes"}} from the votes of `model` """
+    query = (
+        model.select(
+            key,
+            fn.SUM(Case(None, [(model.positive == 1, 1)], 0)),
+            fn.SUM(Case(None, [(model.positive == 1, 0)], 1)),
+        )
+        .where(key << idents)
+        .group_by(key)
+    )
+    result = {}
+    for ident, upvotes, downvotes in query.tuples():
+        upvotes, downvotes = int(upvotes), int(downvotes)
+        result[ident] = {
+            "score": upvotes - downvotes,
+            "upvotes": upvotes,
+            "downvotes": downvotes,
+        }
+    return result
+
+
+def add_counts(result, field, query):
+    """ Adds the (key, count) pairs returned by `query` to the `field` of `result` """
+    for ident, count in query.tuples():
+        counts = result.setdefault(ident, {})
+        counts[field] = counts.get(field, 0) + int(count)
+    return result
+
+
+def subscriber_counts(sids):
+    return (
+        SubSubscriber.select(SubSubscriber.sid, fn.COUNT(SubSubscriber.xid))
+        .where((SubSubscriber.sid << sids) & (SubSubscriber.status == 1))
+        .group_by(SubSubscriber.sid)
+    )
+
+
 @recount.command(help="Rebuilds all sub's subscriber counters")
-@click.option(
-    "--save/--dry-run",
-    default=True,
-    help="Use --save (the default) to fix the counts, or --dry-run to just print them.",
-)
-def subscribers(save):
+@recount_options
+def subscribers(save, batch, start, stop):
     """Update subscriber counts for all the subs."""
+    recount_rows(
+        "subs",
+        Sub.sid,
+        [Sub.subscribers],
+        lambda sids: add_counts({}, "subscribers", subscriber_counts(sids)),
+        save,
+        batch,
+        start,
+        stop,
+        label=Sub.name,
+    )
+
+
+@recount.command(help="Recounts the subscribers and posts of all subs")
+@recount_options
+def subs(save, batch, start, stop):
+    """Update `Sub.subscribers` and `Sub.posts`, which doesn't include
+    deleted posts."""
+
+    def counts(sids):
+        result = add_counts({}, "subscribers", subscriber_counts(sids))
+        return add_counts(
+            result,
+            "posts",
+            SubPost.select(SubPost.sid, fn.COUNT(SubPost.pid))
+            .where((SubPost.sid << sids) & (SubPost.deleted == 0))
+            .group_by(SubPost.sid),
+        )
+
+    recount_rows(
+        "subs",
+        Sub.sid,
+        [Sub.subscribers, Sub.posts],
+        counts,
+        save,
+        batch,
+        start,
+        stop,
+        label=Sub.name,
+    )
+
+
+@recount.command(help="Recounts the votes and comments of all posts")
+@recount_options
+def posts(save, batch, start, stop):
+    """Update the score, upvotes, downvotes and comment count of the posts
+    from their votes and comments, and the hot rank of those that change.
+    With `site.vote_write_behind`, run `flask votes flush` first."""
+
+    def counts(pids):
+        return add_counts(
+            vote_counts(SubPostVote, SubPostVote.pid, pids),
+            "comments",
+            SubPostComment.select(SubPostComment.pid, fn.COUNT(SubPostComment.cid))
+            .where(SubPostComment.pid << pids)
+            .group_by(SubPostComment.pid),
+        )
+
+    fields = [SubPost.score, SubPost.upvotes, SubPost.downvotes, SubPost.comments]
+    wrong = recount_rows("posts", SubPost.pid, fields, counts, save, batch, start, stop)
     if save:
-        print("Name                             Before   After")
-    else:
-        print("Name                            Current Correct")
-
-    subs = Sub.select(Sub.sid, Sub.name, Sub.subscribers).order_by(Sub.name)
-    for sub in subs:
-        count = (
-            SubSubscriber.select()
-            .where((SubSubscriber.sid == sub.sid) & (SubSubscriber.status == 1))
-            .count()
+        for i in range(0, len(wrong), batch):
+            misc.update_hot_rank(*wrong[i : i + batch])
+
+
+@recount.command(help="Recounts the votes of all comments")
+@recount_options
+def comments(save, batch, start, stop):
+    """Update the score, upvotes and downvotes of the comments from their
+    votes. With `site.vote_write_behind`, run `flask votes flush` first."""
+    recount_rows(
+        "comments",
+        SubPostComment.cid,
+        [SubPostComment.score, SubPostComment.upvotes, SubPostComment.downvotes],
+        functools.partial(vote_counts, SubPostCommentVote, SubPostCommentVote.cid),
+        save,
+        batch,
+        start,
+        stop,
+    )
+
+
+@recount.command(help="Recounts the votes received and given by all users")
+@recount_options
+def users(save, batch, start, stop):
+    """Update `User.score`, the votes received on the user's posts and
+    comments not counting their own, and `User.given`, the votes they
+    cast. With `site.vote_write_behind`, run `flask votes flush` first."""
+
+    def counts(uids):
+        result = {}
+        for vote, target, key in (
+            (SubPostVote, SubPost, SubPost.pid),
+            (SubPostCommentVote, SubPostComment, SubPostComment.cid),
+        ):
+            value = fn.SUM(Case(None, [(vote.positive == 1, 1)], -1))
+            target_key = vote.pid if vote is SubPostVote else vote.cid
+            add_counts(
+                result,
+                "score",
+                vote.select(target.uid, value)
+                .join(target, on=(key == target_key))
+                .where((target.uid << uids) & (vote.uid != target.uid))
+                .group_by(target.uid),
+            )
+            add_counts(
+                result,
+                "given",
+                vote.select(vote.uid, value).where(vote.uid << uids).group_by(vote.uid),
+            )
+        return result
+
+    recount_rows(
+        "users",
+        User.uid,
+        [User.score, User.given],
+        counts,
+        save,
+        batch,
+        start,
+        stop,
+        label=User.name,
+    )
+
+
+@recount.command(help="Recalculates the stored hot rank of all posts")
+def hot():
+    """Recalculate `SubPost.hot`. Needed after changing `custom_hot_sort`
+    or the SQL `hot` function."""
+    count = SubPost.update(hot=misc.hot_rank_expression()).execute()
+    print(f"Updated {count} posts.")
+
+
+@recount.command(help="Recounts unread notifications, messages and open reports")
+def unread():
+    """Drop the counters kept in Redis so they get counted from the
+    database again the next time they're needed."""
+    count = 0
+    for key in rconn.scan_iter(match="counter:*", count=1000):
+        rconn.delete(key)
+        count += 1
+    print(f"Reset {count} counters.")
+
+
+@recount.command(help="Fills in the stored domain of all link posts")
+@click.option("--batch", default=1000, help="Posts updated at once")
+def domains(batch):
+    """Set `SubPost.domain` from the link of every link post. Needed once
+    after the migration that added it."""
+    count = 0
+    last = 0
+    while True:
+        posts = (
+            SubPost.select(SubPost.pid, SubPost.link)
+            .where((SubPost.pid > last) & SubPost.link.is_null(False))
+            .order_by(SubPost.pid)
+            .limit(batch)
         )
-        print(f"{sub.name:32}{sub.subscribers:7}{count:8}")
-        if save:
-            Sub.update(
-                subscribers=SubSubscriber.select()
-                .where((SubSubscriber.sid == sub.sid) & (SubSubscriber.status == 1))
-                .count()
-            ).where(Sub.sid == sub.sid).execute()
+        by_domain = {}
+        for post in posts:
+            by_domain.setdefault(misc.link_domain(post.link), []).append(post.pid)
+            last = post.pid
+        if not by_domain:
+            break
+        with db.atomic():
+            for domain, pids in by_domain.items():
+                SubPost.update(domain=domain).where(SubPost.pid << pids).execute()
+        count += sum(len(pids) for pids in by_domain.values())
+        print(f"Updated {count} posts.")
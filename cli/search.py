@@ -0,0 +1,31 @@
+import click
+from flask.cli import AppGroup
+from app.models import SubPost, SubPostComment
+from app.search import search_engine
+
+search = AppGroup("search", help="Manage the full-text search index")
+
+
+@search.command(help="Adds all posts and comments to the search index")
+@click.option("--batch", default=1000, help="Rows read from the database at once")
+def reindex(batch):
+    """Index every post and comment. Needed after enabling search on an
+    existing site or changing `search.provider`."""
+    for name, model, key, index in (
+        ("posts", SubPost, SubPost.pid, search_engine.index_post),
+        ("comments", SubPostComment, SubPostComment.cid, search_engine.index_comment),
+    ):
+        count = 0
+        last = None
+        while True:
+            rows = model.select(key).order_by(key).limit(batch)
+            if last is not None:
+                rows = rows.where(key > last)
+            idents = [getattr(x, key.name) for x in rows]
+            if not idents:
+                break
+            for ident in idents:
+                index(ident)
+            count += len(idents)
+            last = idents[-1]
+            print(f"Indexed {count} {name}.")
@@ -0,0 +1,25 @@
+import time
+import click
+from flask.cli import AppGroup
+from app import misc
+
+votes = AppGroup("votes", help="Manage vote counters")
+
+
+@votes.command(help="Writes the vote counters queued in write-behind mode")
+@click.option(
+    "--interval",
+    default=0,
+    help="Keep running, flushing every this many seconds. By default flushes once.",
+)
+def flush(interval):
+    """Apply the score deltas queued in Redis when `site.vote_write_behind`
+    is enabled."""
+    while True:
+        count = misc.flush_vote_deltas()
+        while count:
+            print(f"Updated {count} rows.")
+            count = misc.flush_vote_deltas()
+        if not interval:
+            break
+        time.sleep(interval)
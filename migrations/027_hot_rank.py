@@ -0,0 +1,57 @@
+"""Peewee migrations -- 027_hot_rank.py.
+
+Some examples (model - class or model name)::
+
+    > Model = migrator.orm['model_name']            # Return model in current state by name
+
+    > migrator.sql(sql)                             # Run custom SQL
+    > migrator.python(func, *args, **kwargs)        # Run python code
+    > migrator.create_model(Model)                  # Create a model (could be used as decorator)
+    > migrator.remove_model(model, cascade=True)    # Remove a model
+    > migrator.add_fields(model, **fields)          # Add fields to a model
+    > migrator.change_fields(model, **fields)       # Change fields
+    > migrator.remove_fields(model, *field_names, cascade=True)
+    > migrator.rename_field(model, old_field_name, new_field_name)
+    > migrator.rename_table(model, new_table_name)
+    > migrator.add_index(model, *col_names, unique=False)
+    > migrator.drop_index(model, *col_names)
+    > migrator.add_not_null(model, *field_names)
+    > migrator.drop_not_null(model, *field_names)
+    > migrator.add_default(model, field_name, default)
+
+"""
+
+import datetime as dt
+import peewee as pw
+from decimal import ROUND_HALF_EVEN
+
+try:
+    import playhouse.postgres_ext as pw_pext
+except ImportError:
+    pass
+
+SQL = pw.SQL
+
+
+def migrate(migrator, database, fake=False, **kwargs):
+    """Write your migrations here."""
+    migrator.add_fields("sub_post", hot=pw.DoubleField(default=0, index=True))
+    migrator.add_index("sub_post", "sid", "hot", unique=False)
+
+    database = getattr(database, "obj", database)  # Unwrap the database proxy
+    if isinstance(database, pw.PostgresqlDatabase):
+        posted = "EXTRACT(EPOCH FROM posted)"
+    elif isinstance(database, pw.SqliteDatabase):
+        posted = "CAST(strftime('%s', posted) AS INTEGER)"
+    else:
+        posted = "UNIX_TIMESTAMP(posted)"
+    # Sites using `custom_hot_sort` should run `flask recount hot` afterwards.
+    migrator.sql(
+        f"UPDATE sub_post SET hot = score * 20 + ({posted} - 1134028003) / 1500.0"
+    )
+
+
+def rollback(migrator, database, fake=False, **kwargs):
+    """Write your rollback migrations here."""
+    migrator.drop_index("sub_post", "sid", "hot")
+    migrator.remove_fields("sub_post", "hot")
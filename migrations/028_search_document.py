@@ -0,0 +1,83 @@
+"""Peewee migrations -- 028_search_document.py.
+
+Some examples (model - class or model name)::
+
+    > Model = migrator.orm['model_name']            # Return model in current state by name
+
+    > migrator.sql(sql)                             # Run custom SQL
+    > migrator.python(func, *args, **kwargs)        # Run python code
+    > migrator.create_model(Model)                  # Create a model (could be used as decorator)
+    > migrator.remove_model(model, cascade=True)    # Remove a model
+    > migrator.add_fields(model, **fields)          # Add fields to a model
+    > migrator.change_fields(model, **fields)       # Change fields
+    > migrator.remove_fields(model, *field_names, cascade=True)
+    > migrator.rename_field(model, old_field_name, new_field_name)
+    > migrator.rename_table(model, new_table_name)
+    > migrator.add_index(model, *col_names, unique=False)
+    > migrator.drop_index(model, *col_names)
+    > migrator.add_not_null(model, *field_names)
+    > migrator.drop_not_null(model, *field_names)
+    > migrator.add_default(model, field_name, default)
+
+"""
+
+import datetime as dt
+import peewee as pw
+from decimal import ROUND_HALF_EVEN
+
+try:
+    import playhouse.postgres_ext as pw_pext
+except ImportError:
+    pass
+
+SQL = pw.SQL
+
+
+def migrate(migrator, database, fake=False, **kwargs):
+    """Write your migrations here."""
+
+    @migrator.create_model
+    class SearchDocument(pw.Model):
+        id = pw.AutoField()
+        kind = pw.CharField(max_length=8)
+        ident = pw.CharField(max_length=40)
+        sub = pw.ForeignKeyField(
+            backref="searchdocument_set",
+            column_name="sid",
+            field="sid",
+            model=migrator.orm["sub"],
+        )
+        user = pw.ForeignKeyField(
+            backref="searchdocument_set",
+            column_name="uid",
+            field="uid",
+            model=migrator.orm["user"],
+            null=True,
+        )
+        posted = pw.DateTimeField()
+        content = pw.TextField()
+
+        class Meta:
+            table_name = "search_document"
+            indexes = ((("kind", "ident"), True), (("kind", "posted"), False))
+
+    database = getattr(database, "obj", database)  # Unwrap the database proxy
+    if isinstance(database, pw.PostgresqlDatabase):
+        migrator.sql(
+            "CREATE INDEX search_document_tsv ON search_document "
+            "USING GIN (to_tsvector('simple', content))"
+        )
+    elif isinstance(database, pw.SqliteDatabase):
+        migrator.sql(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS search_document_fts "
+            "USING fts5(content, tokenize='unicode61')"
+        )
+    # Existing posts and comments are indexed by `flask search reindex`.
+
+
+def rollback(migrator, database, fake=False, **kwargs):
+    """Write your rollback migrations here."""
+    database = getattr(database, "obj", database)
+    if isinstance(database, pw.SqliteDatabase):
+        migrator.sql("DROP TABLE IF EXISTS search_document_fts")
+    migrator.remove_model("search_document")
@@ -0,0 +1,56 @@
+"""Peewee migrations -- 029_name_lower_index.py.
+
+Some examples (model - class or model name)::
+
+    > Model = migrator.orm['model_name']            # Return model in current state by name
+
+    > migrator.sql(sql)                             # Run custom SQL
+    > migrator.python(func, *args, **kwargs)        # Run python code
+    > migrator.create_model(Model)                  # Create a model (could be used as decorator)
+    > migrator.remove_model(model, cascade=True)    # Remove a model
+    > migrator.add_fields(model, **fields)          # Add fields to a model
+    > migrator.change_fields(model, **fields)       # Change fields
+    > migrator.remove_fields(model, *field_names, cascade=True)
+    > migrator.rename_field(model, old_field_name, new_field_name)
+    > migrator.rename_table(model, new_table_name)
+    > migrator.add_index(model, *col_names, unique=False)
+    > migrator.drop_index(model, *col_names)
+    > migrator.add_not_null(model, *field_names)
+    > migrator.drop_not_null(model, *field_names)
+    > migrator.add_default(model, field_name, default)
+
+"""
+
+import datetime as dt
+import peewee as pw
+from decimal import ROUND_HALF_EVEN
+
+try:
+    import playhouse.postgres_ext as pw_pext
+except ImportError:
+    pass
+
+SQL = pw.SQL
+
+
+def migrate(migrator, database, fake=False, **kwargs):
+    """Write your migrations here."""
+    database = getattr(database, "obj", database)  # Unwrap the database proxy
+    if isinstance(database, pw.MySQLDatabase):
+        # MySQL wants an extra pair of parentheses around index expressions.
+        migrator.sql("CREATE INDEX sub_name_lower ON `sub` ((LOWER(name)))")
+        migrator.sql("CREATE INDEX user_name_lower ON `user` ((LOWER(name)))")
+    else:
+        migrator.sql('CREATE INDEX sub_name_lower ON "sub" (LOWER(name))')
+        migrator.sql('CREATE INDEX user_name_lower ON "user" (LOWER(name))')
+
+
+def rollback(migrator, database, fake=False, **kwargs):
+    """Write your rollback migrations here."""
+    database = getattr(database, "obj", database)
+    if isinstance(database, pw.MySQLDatabase):
+        migrator.sql("DROP INDEX sub_name_lower ON `sub`")
+        migrator.sql("DROP INDEX user_name_lower ON `user`")
+    else:
+        migrator.sql("DROP INDEX sub_name_lower")
+        migrator.sql("DROP INDEX user_name_lower")
@@ -1,7 +1,7 @@
 from bs4 import BeautifulSoup
 from flask import url_for
 from peewee import fn
-from app import mail
+from app import mail, misc
 from app.auth import email_validation_is_required
 from app.models import User, UserMetadata
 
@@ -118,4 +118,5 @@ def promote_user_to_admin(client, user_info):
     log_out_current_user(client)
     admin = User.get(fn.Lower(User.name) == user_info["username"])
     UserMetadata.create(uid=admin.uid, key="admin", value="1")
+    misc.invalidate_user_snapshot(admin.uid)
     log_in_user(client, user_info)
@@ -1,8 +1,13 @@
+import json
+import os
+import time
+import uuid
 import pytest
 import pyotp
-from flask import url_for
+from flask import current_app, url_for
 
-from app.models import UserMetadata, User
+from app import jobs, offload, profiler
+from app.models import UserMetadata, User, rconn
 from test.utilities import register_user, promote_user_to_admin, csrf_token
 
 
@@ -60,3 +65,125 @@ def test_get_totp_image(client, user_info, test_config):
     rv = client.get(url_for("admin.get_totp_image"))
     assert rv.status_code == 200
     assert rv.content_type == "image/png"
+
+
+@pytest.mark.parametrize("test_config", [{"profiler": {"enabled": True}}])
+def test_query_profiler(client, user_info, test_config):
+    register_user(client, user_info)
+    promote_user_to_admin(client, user_info)
+    profiler.reset()
+    client.get(url_for("home.index"))
+
+    rv = client.get(url_for("admin.queries"))
+    assert rv.status_code == 200
+    report = rv.get_json()
+    assert "home.index" in [x["endpoint"] for x in report["endpoints"]]
+    assert report["queries"] and all(x["calls"] > 0 for x in report["queries"])
+    assert client.get(url_for("admin.queries", sort="nope")).status_code == 400
+
+
+def offload_echo(data):
+    return data
+
+
+def offload_fail(value):
+    raise ValueError(value)
+
+
+def offload_sleep(seconds):
+    time.sleep(seconds)
+
+
+@pytest.mark.parametrize(
+    "test_config", [{"offload": {"workers": 2, "max_queue": 5, "timeout": 1}}]
+)
+def test_offload_pool(app, client, user_info, monkeypatch, test_config):
+    # Turn testing off so the jobs go through real processes.
+    monkeypatch.setitem(app.config["THROAT_CONFIG"].app, "testing", False)
+    pool = offload.ProcessPool()
+    rconn.delete(offload.STATS_KEY)
+
+    # Processes are reused, and results larger than a pipe's buffer arrive whole.
+    assert [pool.run(pow, 2, i) for i in range(6)] == [1, 2, 4, 8, 16, 32]
+    big = b"x" * (6 * 1024 * 1024)
+    assert pool.run(offload_echo, big) == big
+    assert pool.idle.qsize() == 1
+
+    with pytest.raises(ValueError):
+        pool.run(offload_fail, "nope")
+    with pytest.raises(offload.OffloadError):
+        pool.run(offload_echo, lambda: None)
+    with pytest.raises(offload.OffloadTimeout):
+        pool.run(offload_sleep, 5)
+    # The process that timed out was replaced.
+    assert pool.run(pow, 3, 2) == 9
+
+    # With testing set, the jobs run inline even with workers configured.
+    monkeypatch.undo()
+    assert offload.pool.run(os.getpid) == os.getpid()
+    register_user(client, user_info)
+    promote_user_to_admin(client, user_info)
+    stats = client.get(url_for("admin.offload_stats")).get_json()
+    rconn.delete(offload.STATS_KEY)
+    assert stats["builtins.pow"]["completed"] == 7
+    assert stats[f"{__name__}.offload_fail"]["failed"] == 1
+    assert stats[f"{__name__}.offload_sleep"]["timeouts"] == 1
+
+
+TEST_QUEUE = "test-" + uuid.uuid4().hex
+job_calls = []
+
+
+@jobs.job(TEST_QUEUE, retries=1)
+def record_job(value):
+    job_calls.append(value)
+    if value == "fail":
+        raise ValueError(value)
+
+
+@pytest.mark.parametrize("test_config", [{"jobs": {"enabled": True}}])
+def test_job_queue(client, user_info, test_config):
+    register_user(client, user_info)
+    promote_user_to_admin(client, user_info)
+    jobs.enqueue(record_job, "ok")
+    jobs.enqueue(record_job, "fail")
+    assert job_calls == []
+
+    worker = jobs.Worker(client.application, [TEST_QUEUE])
+    worker.backoff = 0
+    while worker.work_once():
+        pass
+    # The failing job is retried once and then given up on.
+    assert job_calls == ["ok", "fail", "fail"]
+
+    rv = client.get(url_for("admin.job_stats"))
+    assert rv.status_code == 200
+    stats = rv.get_json()["queues"][TEST_QUEUE]
+    assert stats["depth"] == 0
+    assert (stats["processed"], stats["failed"]) == (1, 2)
+    assert (stats["retried"], stats["dead"]) == (1, 1)
+
+    # Leave nothing behind for `flask jobs retry-dead` to find.
+    for payload in rconn.lrange("jobs:dead", 0, -1):
+        if json.loads(payload)["queue"] == TEST_QUEUE:
+            rconn.lrem("jobs:dead", 1, payload)
+    rconn.delete(f"jobs:stats:{TEST_QUEUE}")
+
+
+@jobs.job(TEST_QUEUE)
+def recovered_job(seconds):
+    # Another worker starting while this one is busy finds it alive.
+    time.sleep(seconds)
+    jobs.Worker(current_app._get_current_object(), [TEST_QUEUE]).recover()
+    job_calls.append(rconn.llen(f"jobs:queue:{TEST_QUEUE}"))
+
+
+@pytest.mark.parametrize("test_config", [{"jobs": {"enabled": True}}])
+def test_job_heartbeat(client, test_config):
+    del job_calls[:]
+    worker = jobs.Worker(client.application, [TEST_QUEUE])
+    worker.heartbeat_ttl = 1
+    jobs.enqueue(recovered_job, 1.5)
+    assert worker.work_once()
+    assert job_calls == [0]
+    rconn.delete(f"jobs:stats:{TEST_QUEUE}")
@@ -1,9 +1,20 @@
 import datetime
+import json
 import re
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
 import pytest
 from flask import url_for
 from test.utilities import register_user, csrf_token, create_sub
-from app.models import Sub, SubMetadata
+from test.utilities import log_in_user, log_out_current_user
+from test.utilities import promote_user_to_admin
+from app import misc
+from app.models import db, Sub, SubMetadata, SubPost, SubPostComment, SubPostVote
+from app.models import SiteMetadata, User, rconn
+from app.fetch import fetcher
+from app.search import NameIndex, search_engine
 
 
 def get_error(data):
@@ -101,7 +112,11 @@ def test_submit_text_post(client, user_info, test_config):
     assert b"Testing! |  test" in rv.data
 
 
-@pytest.mark.parametrize("test_config", [{"site": {"sub_creation_min_level": 0}}])
+# Without the recent activity sidebar, which would also show the title.
+@pytest.mark.parametrize(
+    "test_config",
+    [{"site": {"sub_creation_min_level": 0, "recent_activity": {"enabled": False}}}],
+)
 def test_submit_link_post(client, user_info, test_config):
     register_user(client, user_info)
     create_sub(client)
@@ -138,6 +153,21 @@ def test_submit_link_post(client, user_info, test_config):
         == b'This link was <a href="/s/test/1">recently posted</a> on this sub.'
     )
 
+    rv = client.get(url_for("home.all_domain_new", domain="Google.com"))
+    assert b"Testing link!" in rv.data
+    rv = client.get(url_for("home.all_domain_new", domain="oogle.com"))
+    assert b"Testing link!" not in rv.data
+
+    # Bans apply to subdomains too
+    SiteMetadata.create(key="banned_domain", value="google.com")
+    data["link"] = "https://www.Google.com:443/search"
+    rv = client.post(
+        url_for("subs.submit", ptype="link", sub="test"),
+        data=data,
+        follow_redirects=False,
+    )
+    assert get_error(rv.data) == b"This domain is banned."
+
 
 @pytest.mark.parametrize("test_config", [{"site": {"sub_creation_min_level": 0}}])
 def test_submit_poll_post(client, user_info, test_config):
@@ -159,6 +189,7 @@ def test_submit_poll_post(client, user_info, test_config):
     assert get_error(rv.data) == b"That post type is not allowed in this sub."
     sub = Sub.get(Sub.name == "test")
     SubMetadata.create(sid=sub.sid, key="allow_polls", value=1)
+    misc.invalidate_sub_bundle(sub.sid)
     rv = client.post(
         url_for("subs.submit", ptype="text", sub="test"),
         data=data,
@@ -237,3 +268,684 @@ def test_random_sub(client, user_info, test_config):
     rv = client.get(url_for("subs.random_sub"), follow_redirects=False)
     assert rv.status_code == 302
     assert "/s/test" == rv.location
+
+
+@pytest.mark.parametrize("test_config", [{"site": {"sub_creation_min_level": 0}}])
+def test_hot_rank_follows_votes(client, user_info, user2_info, test_config):
+    register_user(client, user_info)
+    create_sub(client)
+    for title in ["First post", "Second post"]:
+        rv = client.get(url_for("subs.submit", ptype="text", sub="test"))
+        data = {"csrf_token": csrf_token(rv.data), "title": title, "ptype": "text"}
+        rv = client.post(
+            url_for("subs.submit", ptype="text", sub="test"),
+            data=data,
+            follow_redirects=False,
+        )
+        assert rv.status_code == 302
+
+    first = SubPost.get(SubPost.title == "First post")
+    second = SubPost.get(SubPost.title == "Second post")
+    assert first.hot != 0
+    assert first.hot <= second.hot
+    rv = client.get(url_for("home.all_hot"))
+    assert rv.data.index(b"Second post") < rv.data.index(b"First post")
+
+    register_user(client, user2_info)
+    rv = client.get(url_for("home.all_hot"))
+    rv = client.post(
+        url_for("do.upvote", pid=first.pid, value="up"),
+        data={"csrf_token": csrf_token(rv.data)},
+    )
+    assert rv.status_code == 200
+    assert SubPost.get(SubPost.pid == first.pid).hot == first.hot + 20
+    rv = client.get(url_for("home.all_hot"))
+    assert rv.data.index(b"First post") < rv.data.index(b"Second post")
+
+
+@pytest.mark.parametrize(
+    "test_config",
+    [{"site": {"sub_creation_min_level": 0, "vote_write_behind": True}}],
+)
+def test_vote_write_behind(client, user_info, user2_info, test_config):
+    # Drop deltas left in Redis by other tests, so only this test's are flushed.
+    keys = list(rconn.scan_iter(misc.VOTE_DELTA_PREFIX + "*"))
+    if keys:
+        rconn.delete(*keys)
+    register_user(client, user_info)
+    create_sub(client)
+    rv = client.get(url_for("subs.submit", ptype="text", sub="test"))
+    data = {"csrf_token": csrf_token(rv.data), "title": "A post", "ptype": "text"}
+    rv = client.post(url_for("subs.submit", ptype="text", sub="test"), data=data)
+    assert rv.status_code == 302
+    post = SubPost.get(SubPost.title == "A post")
+
+    register_user(client, user2_info)
+    rv = client.get(url_for("home.all_hot"))
+    rv = client.post(
+        url_for("do.upvote", pid=post.pid, value="up"),
+        data={"csrf_token": csrf_token(rv.data)},
+    )
+    assert rv.get_json()["score"] == 2
+    assert SubPost.get(SubPost.pid == post.pid).score == 1
+
+    assert misc.flush_vote_deltas() == 3
+    flushed = SubPost.get(SubPost.pid == post.pid)
+    assert (flushed.score, flushed.upvotes) == (2, 2)
+    assert flushed.hot == post.hot + 20
+    assert User.get(User.name == user2_info["username"]).given == 1
+
+
+@pytest.mark.parametrize("test_config", [{"site": {"sub_creation_min_level": 0}}])
+def test_recent_activity(client, user_info, test_config):
+    register_user(client, user_info)
+    create_sub(client)
+    title = "Activity " + uuid.uuid4().hex
+    rv = client.get(url_for("subs.submit", ptype="text", sub="test"))
+    data = {"csrf_token": csrf_token(rv.data), "title": title, "ptype": "text"}
+    rv = client.post(url_for("subs.submit", ptype="text", sub="test"), data=data)
+    assert rv.status_code == 302
+    post = SubPost.get(SubPost.title == title)
+
+    rv = client.get(url_for("home.index"))
+    rv = client.post(
+        url_for("do.create_comment", pid=post.pid),
+        data={
+            "csrf_token": csrf_token(rv.data),
+            "post": post.pid,
+            "parent": "0",
+            "comment": "A *comment* with a >!hidden!< part",
+        },
+    )
+    reply = json.loads(rv.data)
+    assert reply["status"] == "ok"
+    cid = reply["cid"]
+    entries = misc.recent_activity(False)
+    assert [(x["type"], x["id"]) for x in entries[:2]] == [
+        ("comment", cid),
+        ("post", str(post.pid)),
+    ]
+    assert entries[0]["content"] == "A comment with a ██████ part"
+    rv = client.get(url_for("site.view_activity"))
+    assert title.encode() in rv.data and b"A comment with a" in rv.data
+    rv = client.get(url_for("home.index"))
+    assert b"A comment with a" in rv.data
+
+    rv = client.post(
+        url_for("do.delete_comment"),
+        data={"csrf_token": csrf_token(rv.data), "cid": cid},
+    )
+    assert rv.get_json()["status"] == "ok"
+    assert cid not in [x["id"] for x in misc.recent_activity(False)]
+
+    # It can always be rebuilt from the database.
+    rconn.delete(misc.RECENT_ACTIVITY_KEY, misc.RECENT_ACTIVITY_KEY + ":built")
+    entries = misc.recent_activity(False)
+    assert (entries[0]["type"], entries[0]["id"]) == ("post", str(post.pid))
+
+
+@pytest.mark.parametrize("test_config", [{"site": {"sub_creation_min_level": 0}}])
+def test_recent_activity_undelete(client, user_info, user2_info, test_config):
+    register_user(client, user_info)
+    create_sub(client)
+    promote_user_to_admin(client, user_info)
+    register_user(client, user2_info)
+    titles = ["Restored " + uuid.uuid4().hex, "Later " + uuid.uuid4().hex]
+    for title in titles:
+        rv = client.get(url_for("subs.submit", ptype="text", sub="test"))
+        data = {"csrf_token": csrf_token(rv.data), "title": title, "ptype": "text"}
+        rv = client.post(url_for("subs.submit", ptype="text", sub="test"), data=data)
+        assert rv.status_code == 302
+    pid = SubPost.get(SubPost.title == titles[0]).pid
+
+    def posts():
+        entries = misc.recent_activity(False)
+        return [x["content"] for x in entries if x["content"] in titles]
+
+    assert posts() == titles[::-1]
+    log_out_current_user(client)
+    log_in_user(client, user_info)
+    for route in ["do.delete_post", "do.undelete_post"]:
+        rv = client.get(url_for("home.index"))
+        data = {"csrf_token": csrf_token(rv.data), "post": pid, "reason": "Oops"}
+        rv = client.post(url_for(route), data=data)
+        assert rv.get_json()["status"] == "ok"
+        if route == "do.delete_post":
+            assert posts() == titles[1:]
+    # Back where it was, behind the post made after it.
+    assert posts() == titles[::-1]
+
+
+@pytest.mark.parametrize(
+    "test_config",
+    [
+        {
+            "site": {
+                "sub_creation_min_level": 0,
+                "recent_activity": {"comments_only": True},
+            }
+        }
+    ],
+)
+def test_recent_activity_comments_only(client, user_info, test_config):
+    misc.reset_recent_activity()
+    register_user(client, user_info)
+    create_sub(client)
+    rv = client.get(url_for("subs.submit", ptype="text", sub="test"))
+    data = {"csrf_token": csrf_token(rv.data), "title": "A post", "ptype": "text"}
+    rv = client.post(url_for("subs.submit", ptype="text", sub="test"), data=data)
+    assert rv.status_code == 302
+    post = SubPost.get(SubPost.title == "A post")
+    # Built from the database, before the comment.
+    assert misc.recent_activity(True) == []
+
+    rv = client.get(url_for("home.index"))
+    rv = client.post(
+        url_for("do.create_comment", pid=post.pid),
+        data={
+            "csrf_token": csrf_token(rv.data),
+            "post": post.pid,
+            "parent": "0",
+            "comment": "Only comments",
+        },
+    )
+    assert json.loads(rv.data)["status"] == "ok"
+    # The sidebar keeps its own list, so posts don't push comments out of it.
+    assert [x["content"] for x in misc.recent_activity(True)] == ["Only comments"]
+    assert misc.recent_activity(False)[0]["type"] == "comment"
+    assert misc.recent_activity(False)[1]["type"] == "post"
+    misc.reset_recent_activity()
+    assert [x["content"] for x in misc.recent_activity(True)] == ["Only comments"]
+
+
+@pytest.mark.parametrize("test_config", [{"site": {"sub_creation_min_level": 0}}])
+def test_admin_undo_votes(client, user_info, user2_info, test_config, monkeypatch):
+    register_user(client, user_info)
+    create_sub(client)
+    rv = client.get(url_for("subs.submit", ptype="text", sub="test"))
+    data = {"csrf_token": csrf_token(rv.data), "title": "A post", "ptype": "text"}
+    rv = client.post(url_for("subs.submit", ptype="text", sub="test"), data=data)
+    assert rv.status_code == 302
+    post = SubPost.get(SubPost.title == "A post")
+
+    register_user(client, user2_info)
+    rv = client.get(url_for("home.all_hot"))
+    rv = client.post(
+        url_for("do.upvote", pid=post.pid, value="up"),
+        data={"csrf_token": csrf_token(rv.data)},
+    )
+    assert rv.get_json()["score"] == 2
+    voter = User.get(User.name == user2_info["username"])
+    assert voter.given == 1
+
+    promote_user_to_admin(client, user_info)
+    rv = client.get(url_for("user.view", user=voter.name))
+    rv = client.post(
+        url_for("do.admin_undo_votes", uid=voter.uid),
+        data={"csrf_token": csrf_token(rv.data)},
+    )
+    assert rv.get_json()["status"] == "ok"
+    rv = client.get(url_for("do.admin_undo_votes_progress", uid=voter.uid))
+    assert rv.get_json() == {"status": "done", "total": 1, "done": 1}
+
+    undone = SubPost.get(SubPost.pid == post.pid)
+    assert (undone.score, undone.upvotes, undone.downvotes) == (1, 1, 0)
+    assert undone.hot == post.hot
+    assert User.get(User.uid == voter.uid).given == 0
+    assert User.get(User.name == user_info["username"]).score == 0
+    assert not SubPostVote.select().where(SubPostVote.uid == voter.uid).exists()
+
+    # A job that fails can be started again.
+    def fail(*args):
+        raise RuntimeError("database went away")
+
+    monkeypatch.setattr(misc, "_remove_votes", fail)
+    with pytest.raises(RuntimeError):
+        misc.undo_votes(voter.uid)
+    assert misc.get_undo_votes_progress(voter.uid)["status"] == "failed"
+    monkeypatch.undo()
+    rv = client.get(url_for("user.view", user=voter.name))
+    rv = client.post(
+        url_for("do.admin_undo_votes", uid=voter.uid),
+        data={"csrf_token": csrf_token(rv.data)},
+    )
+    assert rv.get_json()["status"] == "ok"
+
+
+@pytest.mark.parametrize("test_config", [{"site": {"sub_creation_min_level": 0}}])
+def test_recount(app, client, user_info, user2_info, test_config):
+    try:
+        from cli.recount import recount
+    except ImportError as e:
+        # The cli package imports peewee_migrate, which needs an older Python.
+        pytest.skip(f"cli can't be imported: {e}")
+    register_user(client, user_info)
+    create_sub(client)
+    rv = client.get(url_for("subs.submit", ptype="text", sub="test"))
+    data = {"csrf_token": csrf_token(rv.data), "title": "A post", "ptype": "text"}
+    rv = client.post(url_for("subs.submit", ptype="text", sub="test"), data=data)
+    assert rv.status_code == 302
+    post = SubPost.get(SubPost.title == "A post")
+
+    register_user(client, user2_info)
+    rv = client.get(url_for("home.index"))
+    token = csrf_token(rv.data)
+    rv = client.post(
+        url_for("do.upvote", pid=post.pid, value="up"), data={"csrf_token": token}
+    )
+    assert rv.get_json()["score"] == 2
+    data = {"csrf_token": token, "post": post.pid, "parent": "0", "comment": "Hi"}
+    rv = client.post(url_for("do.create_comment", pid=post.pid), data=data)
+    cid = json.loads(rv.data)["cid"]
+    log_out_current_user(client)
+    log_in_user(client, user_info)
+    rv = client.get(url_for("home.index"))
+    rv = client.post(
+        url_for("do.upvotecomment", cid=cid, value="down"),
+        data={"csrf_token": csrf_token(rv.data)},
+    )
+    assert rv.get_json()["score"] == -1
+
+    counters = [
+        (Sub, Sub.sid, post.sid_id, ["subscribers", "posts"]),
+        (SubPost, SubPost.pid, post.pid, ["score", "upvotes", "downvotes", "comments"]),
+        (SubPostComment, SubPostComment.cid, cid, ["score", "upvotes", "downvotes"]),
+        (User, User.uid, post.uid_id, ["score", "given"]),
+        (User, User.uid, SubPostComment.get_by_id(cid).uid_id, ["score", "given"]),
+    ]
+
+    def values():
+        # Each CLI command closes the connection when its app context ends.
+        db.connect(reuse_if_open=True)
+        return [
+            model.select(*[getattr(model, f) for f in fields])
+            .where(key == ident)
+            .tuples()
+            .get()
+            for model, key, ident, fields in counters
+        ]
+
+    correct = values()
+    for model, key, ident, fields in counters:
+        model.update({getattr(model, f): 99 for f in fields}).where(
+            key == ident
+        ).execute()
+
+    runner = app.test_cli_runner()
+    commands = ["subs", "posts", "comments", "users"]
+    for command in commands:
+        result = runner.invoke(recount, [command, "--dry-run", "--batch", "1"])
+        assert result.exit_code == 0, result.output
+        assert "Found 1 of" in result.output or "Found 2 of" in result.output
+        assert " 99 " in result.output
+    assert all(set(row) == {99} for row in values())
+
+    # Ranges that leave out the wrong rows don't touch them.
+    result = runner.invoke(recount, ["posts", "--start", str(post.pid + 1)])
+    assert "Fixed 0 of 0 posts" in result.output
+    for command in commands:
+        result = runner.invoke(recount, [command, "--batch", "1"])
+        assert result.exit_code == 0, result.output
+    assert values() == correct
+
+    Sub.update(subscribers=99).where(Sub.sid == post.sid_id).execute()
+    result = runner.invoke(recount, ["subscribers"])
+    assert "Fixed 1 of 1 subs" in result.output
+    assert values() == correct
+
+
+@pytest.mark.parametrize(
+    "test_config",
+    [
+        {
+            "site": {
+                "sub_creation_min_level": 0,
+                "daily_sub_posting_limit": 50,
+                "daily_site_posting_limit": 50,
+            }
+        }
+    ],
+)
+def test_post_list_cursor(client, user_info, test_config):
+    register_user(client, user_info)
+    create_sub(client)
+    for i in range(27):
+        rv = client.get(url_for("subs.submit", ptype="text", sub="test"))
+        data = {
+            "csrf_token": csrf_token(rv.data),
+            "title": f"Post {i:02}",
+            "ptype": "text",
+        }
+        rv = client.post(url_for("subs.submit", ptype="text", sub="test"), data=data)
+        assert rv.status_code == 302
+
+    rv = client.get(url_for("home.all_new"))
+    assert b"Post 02" in rv.data and b"Post 01" not in rv.data
+    last = SubPost.get(SubPost.title == "Post 02")
+    rv = client.get(url_for("home.all_more", sort="new", page=2, pid=last.pid))
+    assert b"Post 01" in rv.data and b"Post 00" in rv.data
+    assert b"Post 02" not in rv.data
+
+    rv = client.get(url_for("apiv3.get_post_list", target="test", sort="top"))
+    first = rv.get_json()
+    assert len(first["posts"]) == 25 and first["continues"]
+    rv = client.get(
+        url_for(
+            "apiv3.get_post_list", target="test", sort="top", cursor=first["cursor"]
+        )
+    )
+    second = rv.get_json()
+    assert not second["continues"] and second["cursor"] is None
+    pids = {p["pid"] for p in first["posts"]} | {p["pid"] for p in second["posts"]}
+    assert len(pids) == 27
+
+    rv = client.get(url_for("apiv3.get_post_list", target="test", cursor="nope"))
+    assert rv.status_code == 400
+
+
+@pytest.mark.parametrize(
+    "test_config",
+    [
+        {
+            "site": {
+                "sub_creation_min_level": 0,
+                "home_feed": {"enabled": True, "max_entries": 3},
+            }
+        }
+    ],
+)
+def test_home_feed(client, user_info, test_config):
+    for key in rconn.scan_iter(match="home-feed*"):
+        rconn.delete(key)
+    register_user(client, user_info)
+    create_sub(client)
+
+    def submit(title):
+        rv = client.get(url_for("subs.submit", ptype="text", sub="test"))
+        data = {"csrf_token": csrf_token(rv.data), "title": title, "ptype": "text"}
+        rv = client.post(url_for("subs.submit", ptype="text", sub="test"), data=data)
+        assert rv.status_code == 302
+
+    for i in range(3):
+        submit(f"Post {i:02}")
+    rv = client.get(url_for("home.new"))
+    assert b"Post 00" in rv.data and b"Post 02" in rv.data
+    assert len(list(rconn.scan_iter(match="home-feed:*:new"))) == 1
+    key = next(rconn.scan_iter(match="home-feed:*:new"))
+
+    def post_sid():
+        return Sub.get(Sub.name == "test").sid
+
+    def feed_titles():
+        pids = [int(x) for x in rconn.zrevrange(key, 0, -1)]
+        return [SubPost.get(SubPost.pid == pid).title for pid in pids]
+
+    # New posts are pushed to the feed, pushing the oldest one out of it.
+    submit("Post 03")
+    assert feed_titles() == ["Post 03", "Post 02", "Post 01"]
+    # Votes only move the posts that are in it.
+    misc.update_hot_rank(SubPost.get(SubPost.title == "Post 00").pid)
+    assert feed_titles() == ["Post 03", "Post 02", "Post 01"]
+    assert len(rconn.zrange("home-feed-digests:" + post_sid(), 0, -1)) == 1
+    # The last page reads past the end of the feed so it uses the database.
+    rv = client.get(url_for("home.new"))
+    assert b"Post 03" in rv.data and b"Post 00" in rv.data
+
+    post = SubPost.get(SubPost.title == "Post 02")
+    rv = client.post(
+        url_for("do.delete_post"),
+        data={"csrf_token": csrf_token(rv.data), "post": post.pid},
+    )
+    assert rv.get_json()["status"] == "ok"
+    assert feed_titles() == ["Post 03", "Post 01"]
+    rv = client.get(url_for("home.new"))
+    assert b"Post 02" not in rv.data and b"Post 03" in rv.data
+
+
+# Without the recent activity sidebar, which would also show the titles.
+SEARCH_SITE = {"sub_creation_min_level": 0, "recent_activity": {"enabled": False}}
+
+
+@pytest.mark.parametrize(
+    "test_config",
+    [
+        {"site": SEARCH_SITE},
+        {"site": SEARCH_SITE, "search": {"provider": "PYTHON"}},
+    ],
+)
+def test_search(client, user_info, test_config):
+    register_user(client, user_info)
+    create_sub(client)
+    for title, content in [("Bananas", "yellow fruit"), ("Apples", "red fruit")]:
+        rv = client.get(url_for("subs.submit", ptype="text", sub="test"))
+        data = {
+            "csrf_token": csrf_token(rv.data),
+            "title": title,
+            "content": content,
+            "ptype": "text",
+        }
+        rv = client.post(url_for("subs.submit", ptype="text", sub="test"), data=data)
+        assert rv.status_code == 302
+
+    rv = client.get(url_for("home.search", term="yellow"))
+    assert b"Bananas" in rv.data and b"Apples" not in rv.data
+    rv = client.get(url_for("apiv3.search", q="fruit"))
+    assert {p["title"] for p in rv.get_json()["results"]} == {"Bananas", "Apples"}
+    rv = client.get(url_for("apiv3.search", q="fruit", user="nobody"))
+    assert rv.status_code == 400
+
+    post = SubPost.get(SubPost.title == "Bananas")
+    rv = client.get(url_for("home.index"))
+    rv = client.post(
+        url_for("do.delete_post"),
+        data={"csrf_token": csrf_token(rv.data), "post": post.pid},
+    )
+    assert rv.get_json()["status"] == "ok"
+    rv = client.get(url_for("apiv3.search", q="fruit", sub="test"))
+    assert [p["title"] for p in rv.get_json()["results"]] == ["Apples"]
+
+
+@pytest.mark.parametrize("test_config", [{"site": {"sub_creation_min_level": 0}}])
+def test_name_autocomplete(client, user_info, test_config):
+    register_user(client, user_info)
+    create_sub(client)
+
+    rv = client.get(url_for("apiv3.search_sub", query="tes"))
+    assert rv.get_json()["results"] == [{"name": "test"}]
+    rv = client.get(url_for("apiv3.search_sub", query="EST"))
+    assert rv.get_json()["results"] == [{"name": "test"}]
+    rv = client.get(url_for("home.subs_search", term="es"))
+    assert b"/s/test" in rv.data
+    username = user_info["username"]
+    rv = client.get(url_for("apiv3.search_user", query=username[:2].upper()))
+    assert {"name": username} in rv.get_json()["results"]
+
+    # Other processes see new names through the change feed.
+    other = NameIndex("sub", Sub, 0)
+    assert other.complete("new") == []
+    Sub.create(sid="new", name="NewSub")
+    search_engine.sub_names.publish("NewSub")
+    assert other.complete("new") == ["NewSub"]
+    assert other.search("wsu") == ["NewSub"]
+
+    # Short or common terms are looked up with LIKE instead of a list of names.
+    assert Sub.select().where(other.condition(Sub.name, "NE")).count() == 1
+    other.max_listed = 0
+    assert Sub.select().where(other.condition(Sub.name, "wsu")).count() == 1
+
+
+class TitleHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = b"<html><head><title> A page - YouTube</title></head></html>"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class SlowHandler(TitleHandler):
+    def do_GET(self):
+        time.sleep(1)
+        super().do_GET()
+
+
+def test_grab_title(client, user_info):
+    register_user(client, user_info)
+    server = HTTPServer(("127.0.0.1", 0), TitleHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    rv = client.get(url_for("home.index"))
+    headers = {"X-CSRFToken": csrf_token(rv.data)}
+
+    def grab(url):
+        rv = client.post(url_for("do.grab_title"), json={"u": url}, headers=headers)
+        return rv.get_json()
+
+    url = f"http://127.0.0.1:{port}/{uuid.uuid4()}"
+    try:
+        assert grab(url) == {"status": "ok", "title": "A page"}
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # The title is remembered, even if the URL is written differently
+    same_url = url.replace("http://127.0.0.1", "HTTP://user@127.0.0.1") + "#top"
+    assert grab(same_url) == {"status": "ok", "title": "A page"}
+
+    # Slow responses fail, but don't count against the host.
+    rconn.delete("fetch:bad:127.0.0.1")
+    server = HTTPServer(("127.0.0.1", 0), SlowHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        with pytest.raises(ValueError):
+            fetcher.get(f"http://127.0.0.1:{server.server_address[1]}/", 0.2)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert not rconn.exists("fetch:bad:127.0.0.1")
+
+    # Hosts that can't be connected to are not tried again for a while.
+    assert grab(f"http://127.0.0.1:{port}/other") == {"status": "error"}
+    assert rconn.exists("fetch:bad:127.0.0.1")
+    rconn.delete("fetch:bad:127.0.0.1")
+
+
+@pytest.mark.parametrize("test_config", [{"site": {"sub_creation_min_level": 0}}])
+def test_sub_bundle(client, user_info, test_config):
+    register_user(client, user_info)
+    create_sub(client)
+    sub = Sub.get(Sub.name == "test")
+    rv = client.get(url_for("sub.view_sub", sub="test"), follow_redirects=True)
+    assert rv.status_code == 200
+    assert misc.getSubData(sub.sid)["rules"] == []
+    assert misc.get_sub_flair_choices(sub.sid) == []
+    assert list(misc.getSubMods(sub.sid)["owners"].values()) == [user_info["username"]]
+
+    # Changes made by the mods are seen at once.
+    token = csrf_token(rv.data)
+    rv = client.post(
+        url_for("do.create_rule", sub="test"),
+        data={"csrf_token": token, "text": "Be nice"},
+    )
+    assert json.loads(rv.data)["status"] == "ok"
+    rv = client.post(
+        url_for("do.create_user_flair", sub="test"),
+        data={"csrf_token": token, "text": "Regular"},
+    )
+    assert json.loads(rv.data)["status"] == "ok"
+    assert [r["text"] for r in misc.getSubData(sub.sid)["rules"]] == ["Be nice"]
+    assert [f["flair"] for f in misc.get_sub_flair_choices(sub.sid)] == ["Regular"]
+
+    # Changes made elsewhere wait for the bundle to expire or be invalidated.
+    SubMetadata.create(sid=sub.sid, key="restricted", value="1")
+    assert "restricted" not in misc.getSubData(sub.sid)
+    misc.invalidate_sub_bundle(sub.sid)
+    assert misc.getSubData(sub.sid)["restricted"] == "1"
+
+
+@pytest.mark.parametrize("test_config", [{"site": {"sub_creation_min_level": 0}}])
+def test_sub_stylesheet(client, user_info, test_config):
+    register_user(client, user_info)
+    create_sub(client)
+    rv = client.get(url_for("sub.view_sub", sub="test"), follow_redirects=True)
+    assert b"/stylesheet/" not in rv.data
+
+    rv = client.post(
+        url_for("do.edit_sub_css", sub="test"),
+        data={"csrf_token": csrf_token(rv.data), "css": "body { color: red }"},
+    )
+    assert json.loads(rv.data)["status"] == "ok"
+    rv = client.get(url_for("sub.view_sub", sub="test"), follow_redirects=True)
+    assert b"color: red" not in rv.data
+    href = re.search(r'href="([^"]*/stylesheet/[^"]*)"', rv.data.decode()).group(1)
+
+    rv = client.get(href)
+    assert rv.status_code == 200
+    assert rv.mimetype == "text/css"
+    assert b"color: red" in rv.data
+    assert "immutable" in rv.headers["Cache-Control"]
+    rv = client.get(href, headers={"If-None-Match": rv.headers["ETag"]})
+    assert rv.status_code == 304
+
+    # Old links lead to the current version.
+    rv = client.get(url_for("sub.view_sub_css", sub="test", digest="old"))
+    assert rv.status_code == 302
+    assert rv.headers["Location"] == href
+
+    # A user who picks the sub as their theme gets it on every page.
+    rv = client.get(url_for("home.index"))
+    assert href not in rv.data.decode()
+    rv = client.post(
+        url_for("do.edit_user"),
+        data={"csrf_token": csrf_token(rv.data), "subtheme": "test", "language": ""},
+    )
+    assert json.loads(rv.data)["status"] == "ok"
+    for page in [url_for("home.index"), url_for("wiki.welcome")]:
+        rv = client.get(page, follow_redirects=True)
+        assert rv.data.decode().count(f'href="{href}"') == 1
+
+
+@pytest.mark.parametrize("test_config", [{"site": {"sub_creation_min_level": 0}}])
+def test_fragment_cache(client, user_info, test_config):
+    from app.fragments import fragment_cache
+
+    register_user(client, user_info)
+    create_sub(client)
+    sub = Sub.get(Sub.name == "test")
+    Sub.update(sidebar="First sidebar").where(Sub.sid == sub.sid).execute()
+    misc.invalidate_sub_bundle(sub.sid)
+
+    def view_sub():
+        counts = fragment_cache.counts
+        hits, misses = counts["sub-sidebar:hits"], counts["sub-sidebar:misses"]
+        rv = client.get(url_for("sub.view_sub", sub="test"), follow_redirects=True)
+        assert rv.status_code == 200
+        counts = fragment_cache.counts
+        return (
+            rv.data,
+            counts["sub-sidebar:hits"] - hits,
+            counts["sub-sidebar:misses"] - misses,
+        )
+
+    data, hits, misses = view_sub()
+    assert b"First sidebar" in data
+    assert misses == 1
+    data, hits, misses = view_sub()
+    assert b"First sidebar" in data
+    assert hits > 0 and misses == 0
+
+    # A change to any of the dependencies renders it again.
+    Sub.update(sidebar="Second sidebar").where(Sub.sid == sub.sid).execute()
+    misc.invalidate_sub_bundle(sub.sid)
+    data, hits, misses = view_sub()
+    assert b"Second sidebar" in data and b"First sidebar" not in data
+    assert misses == 1
+
+    fragment_cache.flush()
+    promote_user_to_admin(client, user_info)
+    rv = client.get(url_for("admin.fragment_stats"))
+    assert rv.get_json()["sub-sidebar"]["misses"] >= 2
@@ -1,8 +1,110 @@
+import json
+import uuid
+import pytest
 from flask import url_for
-from test.utilities import register_user
+from app import misc
+from app.models import Message, Sub, User, rconn
+from app.pagecache import page_cache
+from test.utilities import register_user, create_sub, csrf_token
+from test.utilities import log_in_user, log_out_current_user
 
 
 def test_settings_page(client, user_info):
     register_user(client, user_info)
     username = user_info["username"]
     assert client.get(url_for("user.edit_user", user=username)).status_code == 200
+
+
+@pytest.mark.parametrize("test_config", [{"site": {"sub_creation_min_level": 0}}])
+def test_user_snapshot_follows_subscriptions(client, user_info, test_config):
+    register_user(client, user_info)
+    create_sub(client)
+    uid = User.get(User.name == user_info["username"]).uid
+    sid = Sub.get(Sub.name == "test").sid
+
+    rv = client.get(url_for("home.index"))
+    assert [x["sid"] for x in misc.get_user_snapshot(uid)["subs"]] == [sid]
+
+    rv = client.post(
+        url_for("do.block_sub", sid=sid), data={"csrf_token": csrf_token(rv.data)}
+    )
+    assert rv.get_json()["status"] == "ok"
+    rv = client.get(url_for("home.index"))
+    assert [x["status"] for x in misc.get_user_snapshot(uid)["subs"]] == [2]
+
+
+def test_unread_message_counter(client, user_info, user2_info):
+    register_user(client, user2_info)
+    log_out_current_user(client)
+    register_user(client, user_info)
+    uid = User.get(User.name == user2_info["username"]).uid
+    assert misc.get_notification_count(uid)["messages"] == 0
+
+    for subject in ["Hello", "Deleted", "Saved"]:
+        rv = client.get(url_for("home.index"))
+        rv = client.post(
+            url_for("do.create_sendmsg"),
+            data={
+                "csrf_token": csrf_token(rv.data),
+                "to": user2_info["username"],
+                "subject": subject,
+                "content": "Hi there",
+            },
+        )
+        assert json.loads(rv.data)["status"] == "ok"
+    assert misc.get_notification_count(uid)["messages"] == 3
+
+    log_out_current_user(client)
+    log_in_user(client, user2_info)
+    # Reading, deleting or saving an unread message takes it off the count.
+    for route, subject in [
+        ("do.read_pm", "Hello"),
+        ("do.delete_pm", "Deleted"),
+        ("do.save_pm", "Saved"),
+    ]:
+        rv = client.get(url_for("home.index"))
+        mid = Message.get(Message.subject == subject).mid
+        rv = client.post(
+            url_for(route, mid=mid), data={"csrf_token": csrf_token(rv.data)}
+        )
+        assert rv.get_json()["status"] == "ok"
+    assert misc.get_notification_count(uid)["messages"] == 0
+    misc.reset_counter("messages", uid)
+    assert misc.get_notification_count(uid)["messages"] == 0
+
+
+@pytest.mark.parametrize("test_config", [{"page_cache": {"enabled": True}}])
+def test_page_cache(app, client, user_info, test_config):
+    path = url_for("home.all_new", t=uuid.uuid4().hex)
+    rv = client.get(path)
+    assert rv.headers["X-Page-Cache"] == "MISS"
+    assert set(rv.vary) == {"Cookie", "Accept-Language"}
+    # The first visits set the session cookie.
+    assert rv.cache_control.private and not rv.cache_control.public
+    rv2 = client.get(path)
+    assert rv2.headers["X-Page-Cache"] == "HIT"
+    rv3 = client.get(path)
+    assert rv3.cache_control.public and "Set-Cookie" not in rv3.headers
+    assert rv2.data == rv.data
+    assert rv2.headers["ETag"] == rv.headers["ETag"]
+    rv = client.get(path, headers={"If-None-Match": rv.headers["ETag"]})
+    assert rv.status_code == 304
+
+    # Stale pages are rendered again by one request, while the others get
+    # the stale page.
+    with app.test_request_context(path):
+        key = page_cache.key()
+    rconn.hset(key, "fresh_until", 0)
+    rconn.set(key + ":lock", 1)
+    assert client.get(path).headers["X-Page-Cache"] == "STALE"
+    rconn.delete(key + ":lock")
+    assert client.get(path).headers["X-Page-Cache"] == "REFRESH"
+    assert client.get(path).headers["X-Page-Cache"] == "HIT"
+
+    # The CSRF token in cached pages is the visitor's own.
+    client.get(url_for("home.index"))
+    assert client.get(url_for("home.index")).headers["X-Page-Cache"] == "HIT"
+    register_user(client, user_info)
+    rv = client.get(path)
+    assert "X-Page-Cache" not in rv.headers
+    assert user_info["username"].encode() in rv.data